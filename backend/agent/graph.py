@@ -1,30 +1,52 @@
-from langgraph.graph import StateGraph, END
+import os
+from langgraph.graph import StateGraph, START, END
 from .schema import AgentState
-from .nodes import analyzer_node, generator_node, reflector_node
+from tools.pg_checkpointer import checkpointer
+from .nodes import analyzer_node, make_rag_prefetch_node, generator_node, speculative_generator_node, reflector_node
+
+MAX_STEPS = 2 * int(os.getenv("STOP_MAX_ROUNDS", 3))
 
 def should_continue(state: AgentState):
-    """根据执行步数和反思结果决定是否继续"""
-    # 每轮优化包含 Generator 和 Reflector 两步，3 轮优化对应 6 步（加上 Analyzer 共 7 步）
-    if state.get("iteration_count", 0) >= 6:
+    """根据停止策略的结论、执行步数和反思结果决定是否继续"""
+    if state.get("stop_reason"):
+        return END
+    # 兜底：每轮优化包含 Generator 和 Reflector 两步，默认 3 轮优化对应 6 步（加上 Analyzer 共 7 步）
+    if state.get("iteration_count", 0) >= MAX_STEPS:
         return END
     if state.get("is_perfect"):
         return END
     return "generator"
 
-def create_graph():
+def create_graph(mode=None, prefetch=None, checkpointer=None):
+    """
+    构建 Reflexion 工作流
+    :param mode: sequential 逐轮生成-评审；speculative 每轮并行生成多个候选并择优（默认读取 GRAPH_MODE）
+    :param prefetch: 是否与 Analyzer 并行预取 RAG 模板（默认读取 RAG_PREFETCH）
+    :param checkpointer: 每个节点完成后保存检查点，会话可从中断处恢复（需在 config 中提供 thread_id）
+    """
+    mode = mode or os.getenv("GRAPH_MODE", "sequential")
+    if prefetch is None:
+        prefetch = os.getenv("RAG_PREFETCH", "true").lower() == "true"
+
     # 1. 初始化图
     workflow = StateGraph(AgentState)
 
-    # 2. 添加节点
+    # 2. 添加节点（推测模式下 generator 节点负责候选生成与并行评审，节点名保持不变以兼容前端）
     workflow.add_node("analyzer", analyzer_node)
-    workflow.add_node("generator", generator_node)
+    workflow.add_node("generator", speculative_generator_node if mode == "speculative" else generator_node)
     workflow.add_node("reflector", reflector_node)
 
     # 3. 设置入口
     workflow.set_entry_point("analyzer")
 
     # 4. 构建边
-    workflow.add_edge("analyzer", "generator")
+    if prefetch:
+        # RAG 预取与 Analyzer 在同一步并行执行，两者都完成后 Generator 立即开始
+        workflow.add_node("rag_prefetch", make_rag_prefetch_node(mode))
+        workflow.add_edge(START, "rag_prefetch")
+        workflow.add_edge(["analyzer", "rag_prefetch"], "generator")
+    else:
+        workflow.add_edge("analyzer", "generator")
     workflow.add_edge("generator", "reflector")
     
     # 5. 条件边 (Router)
@@ -38,7 +60,7 @@ def create_graph():
     )
 
     # 6. 编译
-    return workflow.compile()
+    return workflow.compile(checkpointer=checkpointer)
 
-# 实例化图
-app_graph = create_graph()
+# 实例化图（CHECKPOINT_ENABLED=false 时不保存检查点）
+app_graph = create_graph(checkpointer=checkpointer)
@@ -1,15 +1,25 @@
 import os
+import asyncio
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import RunnableConfig
+from langchain_core.callbacks.manager import adispatch_custom_event
 from langchain_core.output_parsers import JsonOutputParser
+from langchain_core.outputs import ChatGeneration, Generation
+from langchain_core.messages import message_chunk_to_message
+from langchain_core.caches import BaseCache
+from langchain_core.load import dumps
 from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 from .schema import AgentState
-from llm.llm_gemini import check_gemini_available, get_gemini_llm, parse_gemini_response
-from llm.llm_deepseek import get_deepseek_llm, parse_deepseek_response
+from .stopping import stopping_policy, round_of
+from llm.llm_gemini import parse_gemini_response
+from llm.llm_deepseek import parse_deepseek_response
+from llm.router import llm_router
 from tools.pg_saver import pg_saver
 from tools.rag_tool import rag_retriever
+from tools.llm_cache import llm_cache
 from tools.logger import log
+from tools.tracing import tracer
 
 load_dotenv()
 
@@ -26,36 +36,56 @@ REFLECTOR_PROMPT = load_prompt("reflector.txt")
 class ReflectorResponse(BaseModel):
     critique: str = Field(description="对提示词的评审意见和改进建议")
     is_perfect: bool = Field(description="提示词是否已经达到行业天花板级别，无需进一步修改")
+    score: int = Field(default=0, description="提示词质量评分，0-100 的整数")
 
-# 初始化不同角色的 LLM 实例
-_use_gemini = check_gemini_available()
-if _use_gemini:
-    log("[LLM] Gemini API 可用 ✓", level="INFO")
-else:
-    log("[LLM] Gemini API 不可用，已回退至 DeepSeek", level="WARNING")
-
-def get_llm(temperature=0.7):
-    """获取 LLM 实例，策略：Gemini 优先，DeepSeek 备选"""
-    if _use_gemini:
-        return get_gemini_llm(temperature)
-    return get_deepseek_llm(temperature)
+def get_llm(temperature=0.7, cache=None):
+    """获取 LLM 实例：由路由按供应商健康状态逐次选择（默认 Gemini 优先，DeepSeek 备选），失败自动切换"""
+    return llm_router.chat_model(temperature, cache)
 
 def parse_llm_response(content):
-    """统一解析入口，根据当前使用的模型调用对应的解析实现"""
-    if _use_gemini:
+    """统一解析入口：Gemini 可能返回列表/对象格式，DeepSeek 通常直接是字符串"""
+    if isinstance(content, (list, dict)):
         return parse_gemini_response(content)
     return parse_deepseek_response(content)
 
 
-analyzer_llm = get_llm(os.getenv("ANALYZER_TEMPERATURE", 0.3))
+# Analyzer / Reflector 输出近似确定，相同输入直接复用缓存响应；Generator 需要多样性，不做缓存
+analyzer_llm = get_llm(os.getenv("ANALYZER_TEMPERATURE", 0.3), cache=llm_cache)
 generator_llm = get_llm(os.getenv("GENERATOR_TEMPERATURE", 0.7))
-reflector_llm = get_llm(os.getenv("REFLECTOR_TEMPERATURE", 0.0))
+reflector_llm = get_llm(os.getenv("REFLECTOR_TEMPERATURE", 0.0), cache=llm_cache)
+
+# 注入生成提示词的参考模板数量（仅包含超过相似度阈值的模板）
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", 1))
+
+# 推测式并行生成：每轮并发生成 N 个候选，并行评审后保留最优者
+SPECULATIVE_N = int(os.getenv("SPECULATIVE_N", 3))
+# 至少为 1，否则所有候选都会一直等待信号量
+SPECULATIVE_CONCURRENCY = max(1, int(os.getenv("SPECULATIVE_CONCURRENCY", SPECULATIVE_N)))
+
+def _speculative_temperatures():
+    """候选温度：优先读取 SPECULATIVE_TEMPERATURES，否则围绕 Generator 温度均匀展开"""
+    configured = os.getenv("SPECULATIVE_TEMPERATURES")
+    if configured:
+        return [float(t) for t in configured.split(",")][:SPECULATIVE_N]
+    base = float(os.getenv("GENERATOR_TEMPERATURE", 0.7))
+    if SPECULATIVE_N == 1:
+        return [base]
+    low, high = max(0.0, base - 0.3), min(1.5, base + 0.3)
+    return [round(low + (high - low) * i / (SPECULATIVE_N - 1), 2) for i in range(SPECULATIVE_N)]
+
+_candidate_llms = {}
+
+def get_candidate_llm(temperature):
+    """按温度复用候选生成所用的 LLM 实例"""
+    if temperature not in _candidate_llms:
+        _candidate_llms[temperature] = get_llm(temperature)
+    return _candidate_llms[temperature]
 
 async def analyzer_node(state: AgentState, config: RunnableConfig):
     """分析用户意图"""
     session_id = config.get("configurable", {}).get("thread_id", state.get("session_id", "unknown"))
     current_idx = state.get("iteration_count", 0)
-    log(f"[{session_id}] [Node: Analyzer] 分析用户意图...")
+    log("[{}] [Node: Analyzer] 分析用户意图...", session_id, session_id=session_id, node="analyzer")
     prompt = ChatPromptTemplate.from_messages([
         ("system", ANALYZER_PROMPT),
         ("user", "{original_prompt}")
@@ -66,13 +96,14 @@ async def analyzer_node(state: AgentState, config: RunnableConfig):
     # 提取文本（物理隔离：由 parse_llm_response 路由到具体实现）
     text_content = parse_llm_response(response.content)
     
-    # 保存进度到数据库
-    await pg_saver.save_step(
-        session_id=session_id,
-        original_prompt=state["original_prompt"],
-        user_intent=text_content,
-        iteration_count=current_idx
-    )
+    # 保存进度到数据库（会话首个步骤，同时写入原始提示词）
+    with tracer.span(session_id, "db_save", node="analyzer"):
+        await pg_saver.save_step(
+            session_id=session_id,
+            original_prompt=state["original_prompt"],
+            user_intent=text_content,
+            iteration_count=current_idx
+        )
     
     return {
         "user_intent": text_content,
@@ -80,29 +111,51 @@ async def analyzer_node(state: AgentState, config: RunnableConfig):
         "iteration_count": current_idx + 1
     }
 
-async def generator_node(state: AgentState, config: RunnableConfig):
-    """生成/优化 Prompt"""
-    session_id = config.get("configurable", {}).get("thread_id", state.get("session_id", "unknown"))
-    current_idx = state.get("iteration_count", 0)
-    # 计算当前是第几轮优化
-    round_idx = (current_idx + 1) // 2
-    log(f"[{session_id}] [Node: Generator] 正在进行第 {round_idx} 轮优化...")
-    
-    # 将 user_intent 转换为字符串（处理 Gemini 返回的列表格式）
-    user_intent_str = state["user_intent"]
-    if isinstance(user_intent_str, list):
-        user_intent_str = parse_llm_response(user_intent_str)
-    
-    # 1. 执行 RAG 检索：根据用户意图匹配模板
+def make_rag_prefetch_node(mode="sequential"):
+    """
+    RAG 预取节点：基于原始提示词检索模板，与 Analyzer 并行执行，检索延迟不再落在关键路径上
+    顺序模式只取 RAG_TOP_K 个模板，推测模式下各候选分别参考不同模板，需取 max(RAG_TOP_K, SPECULATIVE_N) 个
+    """
+    top_k = max(RAG_TOP_K, SPECULATIVE_N) if mode == "speculative" else RAG_TOP_K
+
+    async def rag_prefetch_node(state: AgentState, config: RunnableConfig):
+        session_id = config.get("configurable", {}).get("thread_id", state.get("session_id", "unknown"))
+        try:
+            with tracer.span(session_id, "rag_search", node="rag_prefetch"):
+                matches = await rag_retriever.asearch(state["original_prompt"], top_k)
+        except Exception as e:
+            # 预取失败时不写入状态，由 Generator 按意图重新检索
+            log("[{}] [RAG] 预取失败: {}", session_id, e, level="ERROR", session_id=session_id, node="rag_prefetch")
+            return {}
+        # 原始提示词未匹配到超过阈值的模板时同样不写入状态，由 Generator 按分析后的意图再检索一次
+        return {"rag_matches": matches} if matches else {}
+
+    return rag_prefetch_node
+
+def _intent_text(state):
+    """将 user_intent 转换为字符串（处理 Gemini 返回的列表格式）"""
+    user_intent = state["user_intent"]
+    if isinstance(user_intent, list):
+        user_intent = parse_llm_response(user_intent)
+    return user_intent
+
+async def _resolve_rag_matches(state, session_id, top_k):
+    """执行 RAG 检索：根据用户意图匹配模板（意图在各轮之间不变，首轮结果写入状态后复用）"""
+    rag_matches = state.get("rag_matches")
+    if rag_matches is None:
+        try:
+            with tracer.span(session_id, "rag_search", node="generator"):
+                rag_matches = await rag_retriever.asearch(_intent_text(state), top_k)
+        except Exception as e:
+            log("[{}] [RAG] 检索失败: {}", session_id, e, level="ERROR", session_id=session_id, node="generator")
+    return rag_matches
+
+async def _generate(state, matches, llm, tags=None):
+    """调用 LLM 生成一版优化后的提示词"""
     matched_template = "无匹配的企业级参考模板"
-    match = None
-    try:
-        match = rag_retriever.retrieve(user_intent_str)
-        if match:
-            matched_template = f"【参考行业/企业标准模板】:\n{match['template']}"
-            log(f"[{session_id}] [RAG] 已匹配模板: {match['intent']}")
-    except Exception as e:
-        log(f"[{session_id}] [RAG] 检索失败: {e}", level="ERROR")
+    if matches:
+        # 只注入超过相似度阈值的模板，无关意图不再额外消耗 Token
+        matched_template = "【参考行业/企业标准模板】:\n" + "\n\n".join(m["template"] for m in matches)
 
     # 构造上下文：如果有之前的反思意见，则加入
     critique_context = f"\n【参考反思意见进行改进】：\n{state.get('critique', '')}" if state.get('critique') else ""
@@ -112,39 +165,149 @@ async def generator_node(state: AgentState, config: RunnableConfig):
         ("user", "原始意图：{user_intent}\n原始提示词：{original_prompt}\n{matched_template}")
     ])
     
-    chain = prompt | generator_llm
+    chain = (prompt | llm).with_config(tags=tags or [])
     response = await chain.ainvoke({
-        "user_intent": user_intent_str,
+        "user_intent": _intent_text(state),
         "original_prompt": state["original_prompt"],
         "critique_context": critique_context,
         "matched_template": matched_template
     })
     
     # 提取文本内容
-    improved_text = parse_llm_response(response.content)
+    return parse_llm_response(response.content)
+
+async def generator_node(state: AgentState, config: RunnableConfig):
+    """生成/优化 Prompt"""
+    session_id = config.get("configurable", {}).get("thread_id", state.get("session_id", "unknown"))
+    current_idx = state.get("iteration_count", 0)
+    # 计算当前是第几轮优化
+    round_idx = (current_idx + 1) // 2
+    log("[{}] [Node: Generator] 正在进行第 {} 轮优化...", session_id, round_idx, session_id=session_id, node="generator")
     
-    # 保存进度到数据库
-    await pg_saver.save_step(
-        session_id=session_id,
-        original_prompt=state["original_prompt"],
-        user_intent=state["user_intent"],
-        improved_prompt=improved_text,
-        iteration_count=current_idx
-    )
+    rag_matches = await _resolve_rag_matches(state, session_id, RAG_TOP_K)
+    match = rag_matches[0] if rag_matches else None
+    if match:
+        log("[{}] [RAG] 已匹配模板: {} (score: {})", session_id, match["intent"], match.get("score"), session_id=session_id, node="generator")
+
+    improved_text = await _generate(state, rag_matches[:RAG_TOP_K] if rag_matches else [], generator_llm)
+    
+    # 保存进度到数据库（仅记录本步骤产生的字段）
+    with tracer.span(session_id, "db_save", node="generator"):
+        await pg_saver.save_step(
+            session_id=session_id,
+            improved_prompt=improved_text,
+            iteration_count=current_idx
+        )
         
     return {
         "improved_prompt": improved_text,
         "current_step": "Generator",
         "iteration_count": current_idx + 1,
-        "rag_match": match['intent'] if match else None
+        "rag_match": match['intent'] if match else None,
+        "rag_matches": rag_matches
     }
 
-async def reflector_node(state: AgentState, config: RunnableConfig):
-    """反思/模拟"""
+async def speculative_generator_node(state: AgentState, config: RunnableConfig):
+    """推测式生成：并发生成 N 个候选（不同温度/参考模板），并行评审后保留得分最高者"""
     session_id = config.get("configurable", {}).get("thread_id", state.get("session_id", "unknown"))
     current_idx = state.get("iteration_count", 0)
-    log(f"[{session_id}] [Node: Reflector] 正在评审优化后的提示词...")
-    
+    round_idx = (current_idx + 1) // 2
+    log("[{}] [Node: Generator] 正在进行第 {} 轮优化（并行候选 x{}）...", session_id, round_idx, SPECULATIVE_N, session_id=session_id, node="generator")
+
+    # 多取几个模板，供不同候选轮换参考
+    rag_matches = await _resolve_rag_matches(state, session_id, max(RAG_TOP_K, SPECULATIVE_N))
+    match = rag_matches[0] if rag_matches else None
+    temperatures = _speculative_temperatures()
+    semaphore = asyncio.Semaphore(SPECULATIVE_CONCURRENCY)
+
+    async def run_candidate(i, temperature):
+        matches = [rag_matches[i % len(rag_matches)]] if rag_matches else []
+        async with semaphore:
+            text = await _generate(state, matches, get_candidate_llm(temperature), tags=[f"candidate:{i}"])
+        async with semaphore:
+            review = await _review(text, session_id, tags=["speculative_review"])
+        return text, review
+
+    results = await asyncio.gather(
+        *(run_candidate(i, t) for i, t in enumerate(temperatures)),
+        return_exceptions=True
+    )
+    candidates = [(i, r) for i, r in enumerate(results) if not isinstance(r, Exception)]
+    if not candidates:
+        raise results[0]
+
+    # 完美优先，其次按评分选出最优候选
+    winner, (improved_text, review) = max(candidates, key=lambda c: (c[1][1].is_perfect, c[1][1].score))
+    log("[{}] [Node: Generator] 候选评分: {}，选用候选 #{} (温度: {})", session_id, [r[1].score for _, r in candidates], winner, temperatures[winner],
+        session_id=session_id, node="generator")
+
+    with tracer.span(session_id, "db_save", node="generator"):
+        await pg_saver.save_step(
+            session_id=session_id,
+            improved_prompt=improved_text,
+            iteration_count=current_idx
+        )
+
+    return {
+        "improved_prompt": improved_text,
+        "current_step": "Generator",
+        "iteration_count": current_idx + 1,
+        "rag_match": match['intent'] if match else None,
+        "rag_matches": rag_matches,
+        "winner_candidate": winner,
+        # 评审结果交由 Reflector 节点直接采用，避免重复评审
+        "speculative_review": review.model_dump()
+    }
+
+def _generation_text(generation):
+    """缓存中的生成结果转换为文本（兼容 Gemini 的列表格式）"""
+    message = getattr(generation, "message", None)
+    return parse_llm_response(message.content) if message is not None else generation.text
+
+async def _stream_review(prompt, parser, variables, tags, config):
+    """
+    流式评审：critique 每增长一段即推送 critique_delta
+    LangChain 的流式调用不读写模型缓存，这里按与 ainvoke 相同的键（序列化消息 + 模型参数串）
+    查询 llm_cache，命中时把 critique 作为一次增量回放，未命中时在解析成功后回写
+    """
+    messages = (await prompt.ainvoke(variables)).to_messages()
+    cache = reflector_llm.cache if isinstance(reflector_llm.cache, BaseCache) else None
+    key = (dumps(messages), reflector_llm._get_llm_string()) if cache else None
+    if cache:
+        cached = await cache.alookup(*key)
+        if cached:
+            result_dict = parser.parse(_generation_text(cached[0]))
+            if isinstance(result_dict.get("critique"), str) and result_dict["critique"]:
+                await adispatch_custom_event("critique_delta", {"token": result_dict["critique"]}, config=config)
+            return result_dict
+
+    full = None
+    critique = ""
+    # JsonOutputParser 对不完整的 JSON 做部分解析，每个 chunk 后取得当前的 critique
+    async for chunk in reflector_llm.astream(messages, config={"tags": tags or []}):
+        full = chunk if full is None else full + chunk
+        partial = parser.parse_result([Generation(text=parse_llm_response(full.content))], partial=True)
+        if not isinstance(partial, dict):
+            continue
+        current = partial.get("critique")
+        if isinstance(current, str) and len(current) > len(critique) and current.startswith(critique):
+            await adispatch_custom_event("critique_delta", {"token": current[len(critique):]}, config=config)
+            critique = current
+
+    if full is None:
+        raise ValueError("评审模型未返回任何内容")
+    # 完整结果严格解析，解析失败的响应不写入缓存
+    result_dict = parser.parse(parse_llm_response(full.content))
+    if cache:
+        await cache.aupdate(*key, [ChatGeneration(message=message_chunk_to_message(full))])
+    return result_dict
+
+async def _review(improved_prompt, session_id, tags=None, config=None):
+    """
+    调用 LLM 评审提示词，解析失败时降级为“不完美”
+    传入 config 时以流式方式解析 JSON，critique 每增长一段即通过自定义事件 critique_delta 推送；
+    未传入 config（推测式评审，无需推送）时使用 ainvoke，直接经由模型自身的缓存
+    """
     # 使用 JsonOutputParser 替代 with_structured_output，以提高对不同 LLM 供应商的兼容性
     parser = JsonOutputParser(pydantic_object=ReflectorResponse)
     
@@ -152,37 +315,62 @@ async def reflector_node(state: AgentState, config: RunnableConfig):
         ("system", REFLECTOR_PROMPT + "\n\n{format_instructions}"),
         ("user", "{improved_prompt}")
     ])
-    
-    chain = prompt | reflector_llm | parser
+    variables = {
+        "improved_prompt": improved_prompt,
+        "format_instructions": parser.get_format_instructions()
+    }
     
     try:
-        result_dict = await chain.ainvoke({
-            "improved_prompt": state["improved_prompt"],
-            "format_instructions": parser.get_format_instructions()
-        })
-        print(f"[DEBUG-Reflector] result_dict type: {type(result_dict)}")
-        print(f"[DEBUG-Reflector] result_dict: {result_dict}")
+        if config is None:
+            chain = (prompt | reflector_llm | parser).with_config(tags=tags or [])
+            result_dict = await chain.ainvoke(variables)
+        else:
+            result_dict = await _stream_review(prompt, parser, variables, tags, config)
+        # 完整评审结果只在 DEBUG 级别按采样率输出
+        log("[{}] [Node: Reflector] 评审结果: {}", session_id, result_dict, level="DEBUG", session_id=session_id, node="reflector")
         # 转换为 Pydantic 对象
-        result = ReflectorResponse(**result_dict)
-        log(f"[{session_id}] [Node: Reflector] 评审完成✓ (Perfect: {result.is_perfect})")
+        return ReflectorResponse(**result_dict)
     except Exception as e:
-        log(f"[{session_id}] [Node: Reflector] 结构化输出解析失败: {e}", level="ERROR")
+        log("[{}] [Node: Reflector] 结构化输出解析失败: {}", session_id, e, level="ERROR", session_id=session_id, node="reflector")
         # 降级处理：如果解析失败，默认不完美
-        result = ReflectorResponse(critique="评审服务暂时不可用，正在自动进入下一轮优化。", is_perfect=False)
+        return ReflectorResponse(critique="评审服务暂时不可用，正在自动进入下一轮优化。", is_perfect=False)
+
+async def reflector_node(state: AgentState, config: RunnableConfig):
+    """反思/模拟"""
+    session_id = config.get("configurable", {}).get("thread_id", state.get("session_id", "unknown"))
+    current_idx = state.get("iteration_count", 0)
+    log("[{}] [Node: Reflector] 正在评审优化后的提示词...", session_id, session_id=session_id, node="reflector")
     
-    # 保存进度到数据库
-    await pg_saver.save_step(
-        session_id=session_id,
-        original_prompt=state["original_prompt"],
-        user_intent=state["user_intent"],
-        improved_prompt=state["improved_prompt"],
-        critique=result.critique,
-        iteration_count=current_idx
-    )
+    if state.get("speculative_review"):
+        # 推测式生成已在选优时完成评审，直接采用
+        result = ReflectorResponse(**state["speculative_review"])
+    else:
+        # 评审意见边生成边推送，前端无需等待完整 JSON
+        result = await _review(state["improved_prompt"], session_id, config=config)
+    log("[{}] [Node: Reflector] 评审完成✓ (Perfect: {}, Score: {})", session_id, result.is_perfect, result.score,
+        session_id=session_id, node="reflector")
+
+    # 停止策略：完美、达到最大轮数、相邻两轮收敛或评分停滞时结束循环
+    stop_reason = await stopping_policy.check(state, result, round_of(current_idx + 1))
+    if stop_reason:
+        log("[{}] [Node: Reflector] 满足停止条件: {}", session_id, stop_reason, session_id=session_id, node="reflector")
+    
+    # 保存进度到数据库（仅记录本步骤产生的字段）
+    with tracer.span(session_id, "db_save", node="reflector"):
+        await pg_saver.save_step(
+            session_id=session_id,
+            critique=result.critique,
+            iteration_count=current_idx
+        )
     
     return {
         "critique": result.critique,
         "is_perfect": result.is_perfect,
         "current_step": "Reflector",
-        "iteration_count": current_idx + 1
+        "iteration_count": current_idx + 1,
+        "speculative_review": None,
+        "score": result.score,
+        "score_history": [result.score],
+        "last_reviewed_prompt": state["improved_prompt"],
+        "stop_reason": stop_reason
     }
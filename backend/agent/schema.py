@@ -1,6 +1,10 @@
 from typing import TypedDict, Annotated
 import operator
 
+def keep_latest_matches(left, right):
+    """RAG 检索结果的合并规则：新值为 None（未检索或检索失败）时保留已有结果"""
+    return left if right is None else right
+
 class AgentState(TypedDict):
     original_prompt: str    # 用户输入的原始提示词
     improved_prompt: str    # 优化后的提示词
@@ -12,3 +16,10 @@ class AgentState(TypedDict):
     session_id: str         # 会话标识
     is_perfect: bool        # 是否达到完美状态
     rag_match: str          # RAG 匹配到的模板类型
+    rag_matches: Annotated[list, keep_latest_matches]  # RAG 检索结果 (预取或首轮检索后写入，后续轮次直接复用)
+    winner_candidate: int   # 推测式生成模式下胜出的候选编号
+    speculative_review: dict  # 推测式生成模式下胜出候选的评审结果 (供 Reflector 直接采用)
+    score: int              # 本轮评审评分
+    score_history: Annotated[list, operator.add]  # 各轮评审评分 (逐轮追加)
+    last_reviewed_prompt: str  # 上一次评审的提示词 (用于判断相邻两轮是否收敛)
+    stop_reason: str        # 停止策略给出的结束原因 (perfect / max_rounds / convergence / score_plateau ...)
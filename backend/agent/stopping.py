@@ -0,0 +1,162 @@
+import os
+import difflib
+from abc import ABC, abstractmethod
+import numpy as np
+from tools.rag_tool import rag_retriever
+from tools.metrics import registry
+from tools.logger import log
+
+SESSION_ROUNDS = registry.histogram("reflexion_rounds", "每个会话实际执行的优化轮数", buckets=(1, 2, 3, 4, 5, 6))
+SESSION_TOKENS = registry.histogram(
+    "reflexion_session_tokens", "每个会话消耗的 Token 数",
+    buckets=(1000, 2500, 5000, 10000, 20000, 40000, 80000)
+)
+STOPS = registry.counter("reflexion_stops_total", "优化循环结束次数", ("reason",))
+ROUNDS_SAVED = registry.counter("reflexion_rounds_saved_total", "提前停止节省的优化轮数")
+TOKENS_SAVED = registry.counter("reflexion_tokens_saved_estimate_total", "提前停止节省的 Token 数（按会话平均每轮消耗估算）")
+
+def round_of(iteration_count):
+    """由步数换算已完成的优化轮数（Analyzer 占 1 步，每轮 Generator + Reflector 占 2 步）"""
+    return max(0, (iteration_count - 1) // 2)
+
+class StoppingPolicy(ABC):
+    """
+    停止策略基类：每轮评审完成后调用 check，返回停止原因表示结束循环，返回 None 表示继续
+    子类必须实现 check，未实现时在实例化（构建策略列表）阶段即报错
+    :param state: 本轮评审前的状态（improved_prompt 为本轮生成结果）
+    :param review: 本轮评审结果（ReflectorResponse）
+    :param round_idx: 当前轮次（从 1 开始）
+    """
+    name = "base"
+
+    @abstractmethod
+    async def check(self, state, review, round_idx):
+        ...
+
+class PerfectPolicy(StoppingPolicy):
+    """评审判定为完美时停止"""
+    name = "perfect"
+
+    async def check(self, state, review, round_idx):
+        return self.name if review.is_perfect else None
+
+class MaxRoundsPolicy(StoppingPolicy):
+    """达到最大轮数时停止"""
+    name = "max_rounds"
+
+    def __init__(self, max_rounds=3):
+        self.max_rounds = max_rounds
+
+    async def check(self, state, review, round_idx):
+        return self.name if round_idx >= self.max_rounds else None
+
+class ConvergencePolicy(StoppingPolicy):
+    """
+    相邻两轮生成结果几乎一致时停止
+    method=edit 使用编辑相似度（difflib），method=embedding 使用向量余弦相似度（与 RAG 共用模型与向量缓存）
+    """
+    name = "convergence"
+
+    def __init__(self, threshold=0.95, method="edit"):
+        self.threshold = threshold
+        self.method = method
+
+    async def similarity(self, previous, current):
+        if self.method == "embedding":
+            a, b = await rag_retriever.aembed(previous), await rag_retriever.aembed(current)
+            return float(np.dot(a, b))
+        return difflib.SequenceMatcher(None, previous, current).ratio()
+
+    async def check(self, state, review, round_idx):
+        previous, current = state.get("last_reviewed_prompt"), state.get("improved_prompt")
+        if not previous or not current:
+            return None
+        try:
+            similarity = await self.similarity(previous, current)
+        except Exception as e:
+            log(f"[Stopping] 相似度计算失败，跳过收敛判断: {e}", level="WARNING")
+            return None
+        return self.name if similarity >= self.threshold else None
+
+class ScorePlateauPolicy(StoppingPolicy):
+    """
+    评分达到目标分，或相比上一轮提升不足 min_gain 时停止
+    评分为 0 视为评审降级（解析失败），不参与判断
+    """
+    name = "score_plateau"
+
+    def __init__(self, min_gain=2, target_score=0):
+        self.min_gain = min_gain
+        self.target_score = target_score
+
+    async def check(self, state, review, round_idx):
+        if review.score <= 0:
+            return None
+        if self.target_score and review.score >= self.target_score:
+            return "target_score"
+        scores = [s for s in state.get("score_history") or [] if s > 0]
+        if scores and review.score - scores[-1] < self.min_gain:
+            return self.name
+        return None
+
+class CompositePolicy(StoppingPolicy):
+    """按顺序组合多个策略，返回第一个命中的停止原因"""
+    name = "composite"
+
+    def __init__(self, policies):
+        self.policies = policies
+
+    async def check(self, state, review, round_idx):
+        for policy in self.policies:
+            reason = await policy.check(state, review, round_idx)
+            if reason:
+                return reason
+        return None
+
+def _policy_factories():
+    return {
+        "perfect": lambda: PerfectPolicy(),
+        "max_rounds": lambda: MaxRoundsPolicy(int(os.getenv("STOP_MAX_ROUNDS", 3))),
+        "convergence": lambda: ConvergencePolicy(
+            float(os.getenv("STOP_SIMILARITY_THRESHOLD", 0.95)),
+            os.getenv("STOP_SIMILARITY_METHOD", "edit")
+        ),
+        "score_plateau": lambda: ScorePlateauPolicy(
+            float(os.getenv("STOP_MIN_SCORE_GAIN", 2)),
+            float(os.getenv("STOP_TARGET_SCORE", 0))
+        )
+    }
+
+def create_stopping_policy(names=None):
+    """根据 STOP_POLICIES（逗号分隔，按顺序判断）组合停止策略"""
+    names = names or os.getenv("STOP_POLICIES", "perfect,max_rounds,convergence,score_plateau")
+    factories = _policy_factories()
+    policies = []
+    for name in (n.strip() for n in names.split(",")):
+        if not name:
+            continue
+        if name not in factories:
+            raise ValueError(f"未知的停止策略: {name}")
+        policies.append(factories[name]())
+    return CompositePolicy(policies)
+
+def record_session(session_id, iteration_count, stop_reason, usage, max_rounds=None):
+    """记录会话的实际轮数与 Token 消耗，并估算提前停止节省的轮数与 Token"""
+    rounds = round_of(iteration_count)
+    # 未经停止策略结束的会话（如关闭了 max_rounds 策略）由图的步数兜底终止
+    stop_reason = stop_reason or "max_steps"
+    max_rounds = max_rounds or int(os.getenv("STOP_MAX_ROUNDS", 3))
+    total_tokens = usage.get("total_tokens", 0)
+    saved_rounds = max(0, max_rounds - rounds)
+    saved_tokens = int(total_tokens / rounds * saved_rounds) if rounds else 0
+
+    SESSION_ROUNDS.observe(rounds)
+    SESSION_TOKENS.observe(total_tokens)
+    STOPS.inc(reason=stop_reason)
+    ROUNDS_SAVED.inc(saved_rounds)
+    TOKENS_SAVED.inc(saved_tokens)
+    log(f"[{session_id}] [Stopping] 共 {rounds} 轮 (停止原因: {stop_reason})，消耗 {total_tokens} tokens，"
+        f"节省 {saved_rounds} 轮 / 约 {saved_tokens} tokens")
+
+# 全局单例
+stopping_policy = create_stopping_policy()
@@ -0,0 +1,62 @@
+"""
+ANN 索引召回率/延迟基准测试（合成模板向量，无需加载嵌入模型）
+
+用法（在 backend/ 目录下）：
+    python -m bench.ann_benchmark --sizes 1000 100000 1000000
+"""
+import argparse
+import time
+import numpy as np
+from tools.rag_index import INDEX_TYPES, create_index, apply_search_params, normalize
+
+def synthetic_templates(n, dimension, clusters=256, seed=0):
+    """生成带簇结构的合成向量，模拟按部门/领域聚集的模板意图"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dimension)).astype("float32")
+    labels = rng.integers(0, clusters, n)
+    vectors = centers[labels] + 0.35 * rng.standard_normal((n, dimension)).astype("float32")
+    return normalize(vectors)
+
+def recall_at_k(result, truth, k):
+    hits = sum(len(set(r[:k]) & set(t[:k])) for r, t in zip(result, truth))
+    return hits / (len(truth) * k)
+
+def timed_search(index, queries, k):
+    # 逐条检索，贴近线上单请求场景
+    start = time.perf_counter()
+    indices = [index.search(q.reshape(1, -1), k)[1][0] for q in queries]
+    elapsed = time.perf_counter() - start
+    return np.array(indices), elapsed / len(queries) * 1000
+
+def run(sizes, dimension, num_queries, k, index_types):
+    sweeps = {
+        "flat": [{}],
+        "ivf": [{"nprobe": p} for p in (1, 4, 16, 64)],
+        "ivfpq": [{"nprobe": p} for p in (1, 4, 16, 64)],
+        "hnsw": [{"ef_search": ef} for ef in (16, 32, 64, 128)]
+    }
+    print(f"{'size':>9} {'index':>6} {'param':>14} {'build(s)':>9} {'recall@'+str(k):>9} {'ms/query':>9}")
+    for n in sizes:
+        data = synthetic_templates(n, dimension)
+        queries = synthetic_templates(num_queries, dimension, seed=1)
+        # 以精确检索结果作为召回率基准
+        truth = create_index(data, "flat").search(queries, k)[1]
+        for index_type in index_types:
+            start = time.perf_counter()
+            index = create_index(data, index_type, nlist=int(4 * np.sqrt(n)), pq_m=dimension // 16)
+            build_time = time.perf_counter() - start
+            for params in sweeps[index_type]:
+                apply_search_params(index, **params)
+                result, latency = timed_search(index, queries, k)
+                label = ",".join(f"{key}={value}" for key, value in params.items()) or "-"
+                print(f"{n:>9} {index_type:>6} {label:>14} {build_time:>9.2f} {recall_at_k(result, truth, k):>9.3f} {latency:>9.3f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="RAG ANN 索引召回率/延迟基准测试")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000, 1000000])
+    parser.add_argument("--dim", type=int, default=768, help="向量维度（text2vec-base-chinese 为 768）")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--types", nargs="+", default=list(INDEX_TYPES), choices=INDEX_TYPES)
+    args = parser.parse_args()
+    run(args.sizes, args.dim, args.queries, args.k, args.types)
@@ -0,0 +1,90 @@
+"""
+工作流端到端延迟基准：对比 RAG 预取（与 Analyzer 并行）开启前后的整图耗时
+
+LLM 与检索均以固定延迟模拟，不访问外部服务与数据库，结果只反映图结构本身带来的差异
+用法（在 backend/ 目录下）：
+    python -m bench.graph_latency --llm-ms 800 --rag-ms 150 --runs 5
+"""
+import os
+import time
+import json
+import asyncio
+import argparse
+import numpy as np
+
+# 基准不调用真实模型，但节点模块导入时需要可用的 API Key
+os.environ.setdefault("DEEPSEEK_API_KEY", "bench")
+
+from typing import Any, List, Optional
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from agent import nodes
+from agent.graph import create_graph
+
+class DelayedFakeChatModel(BaseChatModel):
+    """按固定延迟返回固定内容的模拟模型"""
+    content: str
+    delay: float
+
+    @property
+    def _llm_type(self):
+        return "delayed-fake"
+
+    def _result(self):
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.content))])
+
+    def _generate(self, messages: List[Any], stop: Optional[List[str]] = None, run_manager=None, **kwargs):
+        time.sleep(self.delay)
+        return self._result()
+
+    async def _agenerate(self, messages: List[Any], stop: Optional[List[str]] = None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.delay)
+        return self._result()
+
+def patch_nodes(llm_delay, rag_delay):
+    """替换节点模块中的 LLM、检索与持久化，使各环节耗时可控"""
+    nodes.analyzer_llm = DelayedFakeChatModel(content="用户希望编写一段后端接口代码", delay=llm_delay)
+    nodes.generator_llm = DelayedFakeChatModel(content="# Role\n资深后端工程师\n# Task\n...", delay=llm_delay)
+    # 始终判定为“不完美”，保证每次运行都完整执行 3 轮
+    review = json.dumps({"critique": "可以补充约束条件", "is_perfect": False, "score": 80}, ensure_ascii=False)
+    nodes.reflector_llm = DelayedFakeChatModel(content=review, delay=llm_delay)
+
+    async def asearch(query, top_k=1):
+        await asyncio.sleep(rag_delay)
+        return [{"id": "backend", "intent": "后端开发", "template": "...", "score": 0.8}][:top_k]
+
+    async def save_step(*args, **kwargs):
+        return None
+
+    nodes.rag_retriever.asearch = asearch
+    nodes.pg_saver.save_step = save_step
+
+async def measure(graph, runs):
+    latencies = []
+    for i in range(runs):
+        start = time.perf_counter()
+        await graph.ainvoke(
+            {"original_prompt": "帮我写一个用户注册接口", "iteration_count": 0, "session_id": f"bench-{i}"},
+            config={"configurable": {"thread_id": f"bench-{i}"}}
+        )
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+async def main():
+    parser = argparse.ArgumentParser(description="工作流端到端延迟基准")
+    parser.add_argument("--llm-ms", type=float, default=800, help="单次 LLM 调用的模拟延迟（毫秒）")
+    parser.add_argument("--rag-ms", type=float, default=150, help="单次 RAG 检索的模拟延迟（毫秒）")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--mode", default="sequential", choices=["sequential", "speculative"])
+    args = parser.parse_args()
+
+    patch_nodes(args.llm_ms / 1000, args.rag_ms / 1000)
+    print(f"{'prefetch':<10}{'mean_ms':>10}{'p50_ms':>10}{'p95_ms':>10}")
+    for prefetch in (False, True):
+        latencies = await measure(create_graph(mode=args.mode, prefetch=prefetch), args.runs)
+        print(f"{str(prefetch):<10}{np.mean(latencies):>10.1f}"
+              f"{np.percentile(latencies, 50):>10.1f}{np.percentile(latencies, 95):>10.1f}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,58 @@
+"""
+冷启动导入耗时基准：在全新的子进程中分别导入各模块，统计导入耗时的中位数
+
+用法（在 backend/ 目录下）：
+    python -m bench.import_time --runs 5
+    python -m bench.import_time --modules main --detail 15   # 附带 -X importtime 耗时最多的子模块
+"""
+import os
+import sys
+import argparse
+import subprocess
+import statistics
+
+DEFAULT_MODULES = ["tools.rag_tool", "llm.router", "agent.nodes", "agent.graph", "main"]
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def measure(module):
+    code = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+    result = subprocess.run([sys.executable, "-c", code], cwd=BACKEND_DIR, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr else f"导入 {module} 失败")
+    return float(result.stdout.strip().splitlines()[-1]) * 1000
+
+def detail(module, top):
+    """解析 -X importtime 输出（微秒），按累计耗时列出最慢的子模块"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=BACKEND_DIR, capture_output=True, text=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, self_us, cumulative_us, name = [part.strip() for part in line[len("import time:"):].split("|")]
+        rows.append((int(cumulative_us), int(self_us), name.strip()))
+    rows.sort(reverse=True)
+    print(f"\n{module} 累计耗时最多的 {top} 个导入:")
+    for cumulative_us, self_us, name in rows[:top]:
+        print(f"  {cumulative_us / 1000:>9.1f} ms  (self {self_us / 1000:>7.1f} ms)  {name}")
+
+def main():
+    parser = argparse.ArgumentParser(description="冷启动导入耗时基准")
+    parser.add_argument("--modules", nargs="+", default=DEFAULT_MODULES)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--detail", type=int, default=0, help="输出 -X importtime 中累计耗时最多的前 N 个导入")
+    args = parser.parse_args()
+
+    print(f"{'module':<20}{'median_ms':>12}{'min_ms':>10}{'max_ms':>10}")
+    for module in args.modules:
+        try:
+            samples = [measure(module) for _ in range(args.runs)]
+        except RuntimeError as e:
+            print(f"{module:<20}  失败: {e}")
+            continue
+        print(f"{module:<20}{statistics.median(samples):>12.1f}{min(samples):>10.1f}{max(samples):>10.1f}")
+        if args.detail:
+            detail(module, args.detail)
+
+if __name__ == "__main__":
+    main()
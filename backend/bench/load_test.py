@@ -0,0 +1,216 @@
+"""
+/api/optimize 离线压测：N 个并发 SSE 客户端，统计吞吐、首 token 耗时（TTFT）与端到端耗时的 p50/p99
+
+默认自动启动 LLM 桩服务（bench.stub_llm_server）与使用桩数据库的后端（bench.serve），不访问付费模型
+停止策略固定为 max_rounds，每个会话都执行 --rounds 轮，结果只随桩服务的延迟参数变化，可重复对比
+传入 --url 时直接压测已运行的服务；--baseline 与历史结果对比，超出容差时以非零状态码退出（用于性能回归）
+用法（在 backend/ 目录下）：
+    python -m bench.load_test --clients 16 --sessions 64 --ttft-ms 400 --tokens-per-sec 60 --output bench/results.json
+    python -m bench.load_test --clients 16 --sessions 64 --baseline bench/results.json --tolerance 0.15
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import subprocess
+import numpy as np
+import httpx
+from .stub_llm_server import add_stub_arguments, stub_argv
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 越小越好的指标；throughput_rps 越大越好
+LATENCY_KEYS = ("ttft_p50_ms", "ttft_p99_ms", "e2e_p50_ms", "e2e_p99_ms")
+
+def bench_env(stub_url, rounds, max_concurrent, postgres_url=None):
+    """后端子进程的环境变量：只启用指向桩服务的 DeepSeek，关闭各级缓存与持久化"""
+    env = dict(os.environ)
+    env.update({
+        "DEEPSEEK_BASE_URL": stub_url,
+        "DEEPSEEK_API_KEY": "bench",
+        "LLM_PROVIDERS": "deepseek",
+        "LLM_CACHE_ENABLED": "false",
+        "RESULT_CACHE_ENABLED": "false",
+        "SSE_EVENT_PERSIST": "false",
+        "STOP_POLICIES": "max_rounds",
+        "STOP_MAX_ROUNDS": str(rounds),
+        "SCHED_MAX_CONCURRENT": str(max_concurrent),
+        "SCHED_MAX_QUEUE": "100000",
+        "SCHED_QUEUE_TIMEOUT": "3600",
+        # 压测客户端均来自本机，信任本机转发的 X-Client-Id 以模拟多个客户端
+        "SCHED_TRUSTED_PROXIES": "127.0.0.1",
+    })
+    if postgres_url:
+        env["POSTGRES_URL"] = postgres_url
+    return env
+
+def spawn(module, argv, env=None):
+    return subprocess.Popen([sys.executable, "-m", module, *argv], cwd=BACKEND_DIR, env=env)
+
+def start_stub(args, port):
+    """启动 LLM 桩服务子进程并等待就绪，返回 (进程, 地址)"""
+    proc = spawn("bench.stub_llm_server", ["--port", str(port), *stub_argv(args)])
+    url = f"http://127.0.0.1:{port}"
+    wait_http(f"{url}/models", proc)
+    return proc, url
+
+def wait_http(url, proc, timeout=60, ready=lambda r: r.status_code == 200):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"子进程已退出 (code {proc.returncode})")
+        try:
+            response = httpx.get(url, timeout=2)
+            if ready(response):
+                return response
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"等待 {url} 超时")
+
+def backend_warmed(response):
+    """LLM 已就绪且没有仍在加载的组件即可开始（桩数据库下 database 组件会是 failed）"""
+    if response.status_code not in (200, 503):
+        return False
+    components = response.json().get("components", {})
+    return components.get("llm", {}).get("status") == "ready" and \
+        not any(c["status"] in ("pending", "loading") for c in components.values())
+
+async def run_session(client, url, prompt, client_id):
+    """执行一次优化会话，返回各阶段耗时（秒）"""
+    result = {"ttft": None, "e2e": None, "error": None}
+    start = time.perf_counter()
+    try:
+        async with client.stream("POST", f"{url}/api/optimize", json={"prompt": prompt, "no_cache": True},
+                                 headers={"X-Client-Id": client_id}) as response:
+            if response.status_code != 200:
+                result["error"] = f"HTTP {response.status_code}"
+                return result
+            async for line in response.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                content = line[6:]
+                if content == "[DONE]":
+                    result["e2e"] = time.perf_counter() - start
+                    break
+                data = json.loads(content)
+                if data.get("error"):
+                    result["error"] = data["error"]
+                    break
+                # 首 token：用户看到的第一段优化结果（Generator 的流式输出）
+                if result["ttft"] is None and data.get("status") == "token" and data.get("node") == "generator":
+                    result["ttft"] = time.perf_counter() - start
+    except httpx.HTTPError as e:
+        result["error"] = type(e).__name__
+    if result["e2e"] is None and result["error"] is None:
+        result["error"] = "incomplete"
+    return result
+
+def percentile_ms(values, q):
+    return round(float(np.percentile(values, q)) * 1000, 1) if values else None
+
+def summarize(results, wall):
+    """汇总会话结果：吞吐（完成会话数/秒）与 TTFT、端到端耗时分位数"""
+    ok = [r for r in results if not r["error"]]
+    ttft = [r["ttft"] for r in ok if r["ttft"] is not None]
+    e2e = [r["e2e"] for r in ok]
+    errors = {}
+    for r in results:
+        if r["error"]:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+    return {
+        "sessions": len(results),
+        "completed": len(ok),
+        "errors": errors,
+        "wall_seconds": round(wall, 2),
+        "throughput_rps": round(len(ok) / wall, 3) if wall else 0,
+        "ttft_p50_ms": percentile_ms(ttft, 50),
+        "ttft_p99_ms": percentile_ms(ttft, 99),
+        "e2e_p50_ms": percentile_ms(e2e, 50),
+        "e2e_p99_ms": percentile_ms(e2e, 99),
+    }
+
+def compare(summary, baseline, tolerance):
+    """与基线对比，返回退化的指标列表：延迟高于基线 (1 + tolerance) 倍，或吞吐低于 (1 - tolerance) 倍"""
+    regressions = []
+    for key in LATENCY_KEYS:
+        if summary.get(key) is not None and baseline.get(key) and summary[key] > baseline[key] * (1 + tolerance):
+            regressions.append(f"{key}: {baseline[key]} -> {summary[key]}")
+    if baseline.get("throughput_rps") and summary["throughput_rps"] < baseline["throughput_rps"] * (1 - tolerance):
+        regressions.append(f"throughput_rps: {baseline['throughput_rps']} -> {summary['throughput_rps']}")
+    if summary["completed"] < summary["sessions"]:
+        regressions.append(f"errors: {summary['errors']}")
+    return regressions
+
+def report(summary, args):
+    """打印汇总，写入结果文件，并在指定基线时检查退化；返回进程退出码"""
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(summary, json.load(f), args.tolerance)
+        if regressions:
+            print("性能退化:\n  " + "\n  ".join(regressions))
+            return 1
+        print(f"未超出基线容差 ({args.tolerance:.0%})✓")
+    return 0
+
+def add_run_arguments(parser):
+    parser.add_argument("--sessions", type=int, default=32, help="总会话数")
+    parser.add_argument("--clients", type=int, default=8, help="并发客户端数")
+    parser.add_argument("--rounds", type=int, default=2, help="每个会话的优化轮数（STOP_MAX_ROUNDS）")
+    parser.add_argument("--prompt", default="帮我写一个用户注册接口，需要参数校验")
+    parser.add_argument("--output", help="将结果写入 JSON 文件（可作为之后的基线）")
+    parser.add_argument("--baseline", help="基线结果 JSON 文件")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允许相对基线退化的比例")
+    add_stub_arguments(parser)
+
+async def drive(url, args):
+    semaphore = asyncio.Semaphore(args.clients)
+    timeout = httpx.Timeout(connect=10, read=600, write=10, pool=None)
+    async with httpx.AsyncClient(timeout=timeout, limits=httpx.Limits(max_connections=args.clients)) as client:
+        async def one(i):
+            async with semaphore:
+                return await run_session(client, url, args.prompt, f"bench-{i % args.clients}")
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(one(i) for i in range(args.sessions)))
+        return summarize(results, time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description="/api/optimize 离线压测")
+    parser.add_argument("--url", help="压测已运行的服务（不再启动桩服务与后端）")
+    parser.add_argument("--port", type=int, default=8100, help="自动启动的后端端口")
+    parser.add_argument("--stub-port", type=int, default=9100)
+    parser.add_argument("--max-concurrent", type=int, default=8, help="后端的 SCHED_MAX_CONCURRENT")
+    parser.add_argument("--postgres-url", help="使用本地 Postgres 而非桩数据库")
+    add_run_arguments(parser)
+    args = parser.parse_args()
+
+    procs = []
+    try:
+        url = args.url
+        if not url:
+            stub, stub_url = start_stub(args, args.stub_port)
+            procs.append(stub)
+            backend_argv = ["--port", str(args.port)] + (["--postgres"] if args.postgres_url else [])
+            env = bench_env(stub_url, args.rounds, args.max_concurrent, args.postgres_url)
+            backend = spawn("bench.serve", backend_argv, env=env)
+            procs.append(backend)
+            url = f"http://127.0.0.1:{args.port}"
+            wait_http(f"{url}/api/ready", backend, timeout=300, ready=backend_warmed)
+
+        summary = asyncio.run(drive(url, args))
+        summary["config"] = {k: v for k, v in vars(args).items() if k not in ("output", "baseline", "url")}
+        sys.exit(report(summary, args))
+    finally:
+        for proc in procs:
+            proc.terminate()
+            proc.wait()
+
+if __name__ == "__main__":
+    main()
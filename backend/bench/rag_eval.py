@@ -0,0 +1,74 @@
+"""
+RAG 检索离线评估：在标注查询集上对比 vector / hybrid 模式的准确率与检索延迟
+
+标注格式：[{"query": "...", "expected": "模板 id 或 null(不应匹配任何模板)"}]
+用法（在 backend/ 目录下）：
+    python -m bench.rag_eval --modes vector hybrid --min-scores 0.35 0.45 0.55
+"""
+import os
+import json
+import time
+import argparse
+import numpy as np
+from tools.rag_tool import RAGRetriever, template_id
+
+# 离线评估始终使用本地检索器，不受 RAG_MODE=sidecar 影响
+rag_retriever = RAGRetriever()
+
+DEFAULT_QUERIES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rag_queries.json")
+
+def evaluate(samples, mode, min_score):
+    rag_retriever.retrieval_mode = mode
+    rag_retriever.min_score = min_score
+    rag_retriever.result_cache.clear()
+
+    correct = returned = should_match = rejected_ok = should_reject = 0
+    latencies = []
+    for sample in samples:
+        # 查询向量走缓存，延迟只反映检索与重排本身
+        start = time.perf_counter()
+        match = rag_retriever.retrieve(sample["query"])
+        latencies.append((time.perf_counter() - start) * 1000)
+        rag_retriever.result_cache.clear()
+
+        predicted = template_id(match) if match else None
+        if match:
+            returned += 1
+        if sample["expected"] is None:
+            should_reject += 1
+            rejected_ok += predicted is None
+        else:
+            should_match += 1
+            correct += predicted == sample["expected"]
+
+    return {
+        # precision：返回了模板的查询中命中正确模板的比例
+        "precision": correct / returned if returned else 0.0,
+        "recall": correct / should_match if should_match else 0.0,
+        "reject_acc": rejected_ok / should_reject if should_reject else 0.0,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95))
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="RAG 检索离线评估")
+    parser.add_argument("--queries", default=DEFAULT_QUERIES, help="标注查询集路径")
+    parser.add_argument("--modes", nargs="+", default=["vector", "hybrid"], choices=["vector", "hybrid"])
+    parser.add_argument("--min-scores", type=float, nargs="+", default=[rag_retriever.min_score])
+    args = parser.parse_args()
+
+    with open(args.queries, "r", encoding="utf-8") as f:
+        samples = json.load(f)
+    rag_retriever.load_resources()
+    # 预热查询向量缓存
+    for sample in samples:
+        rag_retriever.retrieve(sample["query"])
+
+    print(f"{'mode':>7} {'min_score':>9} {'precision':>9} {'recall':>7} {'reject':>7} {'p50(ms)':>8} {'p95(ms)':>8}")
+    for mode in args.modes:
+        for min_score in args.min_scores:
+            r = evaluate(samples, mode, min_score)
+            print(f"{mode:>7} {min_score:>9.2f} {r['precision']:>9.3f} {r['recall']:>7.3f} {r['reject_acc']:>7.3f} {r['p50_ms']:>8.3f} {r['p95_ms']:>8.3f}")
+
+if __name__ == "__main__":
+    main()
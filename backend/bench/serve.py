@@ -0,0 +1,33 @@
+"""
+压测用后端启动器：以桩 PostgresSaver 启动 main.app（步骤记录直接丢弃，不依赖数据库）
+传入 --postgres 时使用 POSTGRES_URL 指向的真实（本地）数据库
+LLM、调度等配置通过环境变量传入，通常由 bench.load_test 自动设置
+用法（在 backend/ 目录下）：
+    DEEPSEEK_BASE_URL=http://127.0.0.1:9100 LLM_PROVIDERS=deepseek python -m bench.serve --port 8100
+"""
+import argparse
+import uvicorn
+
+def stub_database():
+    """不建立连接池：PostgresSaver 的各方法在无连接池时直接返回"""
+    from tools.pg_saver import pg_saver
+
+    async def connect():
+        return None
+
+    pg_saver.connect = connect
+
+def main():
+    parser = argparse.ArgumentParser(description="压测用后端启动器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--postgres", action="store_true", help="使用 POSTGRES_URL 指向的真实数据库")
+    args = parser.parse_args()
+
+    if not args.postgres:
+        stub_database()
+    from main import app
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
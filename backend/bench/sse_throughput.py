@@ -0,0 +1,98 @@
+"""
+SSE 编码吞吐基准：对比逐 token json.dumps 的原始实现与 SSEStream（token 合并 + 快速序列化 + 状态增量）
+
+以合成的会话事件序列（3 轮生成/评审）在单核上编码，统计每秒处理的图事件数、写出次数与字节数
+基准在紧循环中运行，时间窗几乎不会到期，token 合并只由长度上限触发（实际运行时还会按时间窗合并）
+用法（在 backend/ 目录下）：
+    python -m bench.sse_throughput --sessions 200
+"""
+import json
+import time
+import random
+import argparse
+from tools.sse import SSEStream, DONE_FRAME, SERIALIZER
+
+def synthetic_session(rounds=3, generator_tokens=600, critique_tokens=120, seed=0):
+    """生成一次会话的图事件序列：(kind, node, data)"""
+    rng = random.Random(seed)
+    alphabet = "提示词优化角色任务约束输出格式示例abcdefghijklmnopqrstuvwxyz \n#-*"
+
+    def token():
+        return "".join(rng.choice(alphabet) for _ in range(rng.randint(1, 4)))
+
+    events = [("start", "analyzer", None), ("end", "analyzer", {"user_intent": "编写后端接口", "current_step": "Analyzer", "iteration_count": 1})]
+    rag_matches = [{"id": "backend", "intent": "后端开发", "template": "模板正文" * 200, "score": 0.8}]
+    step = 1
+    for _ in range(rounds):
+        events.append(("start", "generator", None))
+        tokens = [token() for _ in range(generator_tokens)]
+        events.extend(("token", "generator", t) for t in tokens)
+        step += 1
+        events.append(("end", "generator", {
+            "improved_prompt": "".join(tokens), "current_step": "Generator", "iteration_count": step,
+            "rag_match": "后端开发", "rag_matches": rag_matches
+        }))
+        events.append(("start", "reflector", None))
+        critique = [token() for _ in range(critique_tokens)]
+        events.extend(("token", "reflector", t) for t in critique)
+        step += 1
+        events.append(("end", "reflector", {
+            "critique": "".join(critique), "is_perfect": False, "current_step": "Reflector",
+            "iteration_count": step, "score": 80, "last_reviewed_prompt": "".join(tokens)
+        }))
+    return events
+
+def encode_baseline(events):
+    """原始实现：每个事件单独 json.dumps 并单独写出，结束事件携带完整 updates"""
+    writes = []
+    for kind, node, data in events:
+        if kind == "start":
+            writes.append(f"data: {json.dumps({'node': node, 'status': 'start'})}\n\n".encode())
+        elif kind == "token":
+            writes.append(f"data: {json.dumps({'node': node, 'status': 'token', 'token': data})}\n\n".encode())
+        else:
+            writes.append(f"data: {json.dumps({'node': node, 'status': 'end', 'updates': data})}\n\n".encode())
+    writes.append(b"data: [DONE]\n\n")
+    return writes
+
+def encode_stream(events, max_chars):
+    writes = []
+    stream = SSEStream(max_chars=max_chars)
+    for kind, node, data in events:
+        out = stream.tick()
+        if kind == "start":
+            out += stream.event({"node": node, "status": "start"})
+        elif kind == "token":
+            out += stream.token(node, data)
+        else:
+            out += stream.node_end(node, data)
+        if out:
+            writes.append(out)
+    writes.append(stream.flush() + DONE_FRAME)
+    return writes
+
+def run(name, encoder, sessions):
+    start = time.process_time()
+    writes = total_bytes = events = 0
+    for events_list in sessions:
+        out = encoder(events_list)
+        writes += len(out)
+        total_bytes += sum(len(w) for w in out)
+        events += len(events_list)
+    elapsed = time.process_time() - start
+    print(f"{name:<18}{events / elapsed:>14,.0f}{writes / len(sessions):>14.1f}{total_bytes / len(sessions) / 1024:>14.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="SSE 编码吞吐基准")
+    parser.add_argument("--sessions", type=int, default=200)
+    parser.add_argument("--max-chars", type=int, default=256, help="token 合并的长度上限")
+    args = parser.parse_args()
+
+    sessions = [synthetic_session(seed=i) for i in range(args.sessions)]
+    print(f"序列化: {SERIALIZER}，每会话 {len(sessions[0])} 个图事件")
+    print(f"{'encoder':<18}{'events/s/core':>14}{'writes/sess':>14}{'KB/sess':>14}")
+    run("baseline", encode_baseline, sessions)
+    run("sse_stream", lambda e: encode_stream(e, args.max_chars), sessions)
+
+if __name__ == "__main__":
+    main()
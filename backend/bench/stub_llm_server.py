@@ -0,0 +1,147 @@
+"""
+离线 LLM 桩服务：兼容 OpenAI Chat Completions 接口（流式与非流式），供压测与性能回归使用
+
+后端通过 DEEPSEEK_BASE_URL 指向本服务即可，无需访问付费模型
+首 token 延迟按指定分布采样，之后按固定速率逐 token 输出；评审请求（提示中包含 is_perfect）返回固定的 JSON
+每个请求使用 (seed, 请求序号) 初始化随机数，同一次运行的延迟样本集合可复现
+用法（在 backend/ 目录下）：
+    python -m bench.stub_llm_server --port 9100 --ttft-ms 400 --ttft-dist lognormal --tokens 200 --tokens-per-sec 60
+"""
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import itertools
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse, JSONResponse
+
+ALPHABET = "提示词优化角色任务约束输出格式示例步骤要求背景目标"
+
+class StubConfig:
+    def __init__(self, ttft_ms=400, ttft_dist="fixed", ttft_sigma=0.3, tokens=200, tokens_per_sec=60,
+                 error_rate=0.0, seed=0, model="deepseek-chat"):
+        self.ttft_ms = ttft_ms
+        self.ttft_dist = ttft_dist
+        self.ttft_sigma = ttft_sigma
+        self.tokens = tokens
+        self.tokens_per_sec = tokens_per_sec
+        self.error_rate = error_rate
+        self.seed = seed
+        self.model = model
+        self._counter = itertools.count()
+
+    def rng(self):
+        return random.Random(f"{self.seed}:{next(self._counter)}")
+
+    def sample_ttft(self, rng):
+        """首 token 延迟（秒）：fixed 固定值；normal 以 sigma 为相对标准差；lognormal 以 ttft_ms 为中位数"""
+        base = self.ttft_ms / 1000
+        if self.ttft_dist == "normal":
+            return max(0.0, rng.gauss(base, base * self.ttft_sigma))
+        if self.ttft_dist == "lognormal":
+            return rng.lognormvariate(0, self.ttft_sigma) * base
+        return base
+
+def _is_review(messages):
+    return any("is_perfect" in str(m.get("content", "")) for m in messages)
+
+def _completion_tokens(messages, config, rng):
+    """按请求类型生成输出内容，切分为 token 列表"""
+    if _is_review(messages):
+        text = json.dumps({"critique": "建议补充输出格式与边界条件的约束。", "is_perfect": False, "score": 80}, ensure_ascii=False)
+        return [text[i:i + 3] for i in range(0, len(text), 3)]
+    return ["".join(rng.choice(ALPHABET) for _ in range(rng.randint(1, 3))) for _ in range(config.tokens)]
+
+def _usage(messages, tokens):
+    prompt_tokens = sum(len(str(m.get("content", ""))) for m in messages) // 2
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens), "total_tokens": prompt_tokens + len(tokens)}
+
+def create_app(config):
+    app = FastAPI(title="Stub LLM")
+
+    @app.get("/models")
+    async def models():
+        return {"object": "list", "data": [{"id": config.model, "object": "model", "owned_by": "stub"}]}
+
+    @app.post("/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        messages = body.get("messages", [])
+        rng = config.rng()
+        if config.error_rate and rng.random() < config.error_rate:
+            return JSONResponse({"error": {"message": "stub injected error", "type": "server_error"}}, status_code=500)
+
+        tokens = _completion_tokens(messages, config, rng)
+        ttft = config.sample_ttft(rng)
+        interval = 1 / config.tokens_per_sec if config.tokens_per_sec > 0 else 0
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        created = int(time.time())
+
+        if not body.get("stream"):
+            await asyncio.sleep(ttft + interval * len(tokens))
+            return {
+                "id": completion_id, "object": "chat.completion", "created": created, "model": config.model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": "stop"}],
+                "usage": _usage(messages, tokens)
+            }
+
+        include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+
+        def chunk(delta, finish_reason=None, **extra):
+            payload = {
+                "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": config.model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}] if delta is not None else [],
+                **extra
+            }
+            return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+        async def stream():
+            await asyncio.sleep(ttft)
+            yield chunk({"role": "assistant", "content": ""})
+            for i, token in enumerate(tokens):
+                if i and interval:
+                    await asyncio.sleep(interval)
+                yield chunk({"content": token})
+            yield chunk({}, finish_reason="stop")
+            if include_usage:
+                yield chunk(None, usage=_usage(messages, tokens))
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    return app
+
+def add_stub_arguments(parser):
+    """桩服务参数，压测脚本复用同一组参数启动子进程"""
+    parser.add_argument("--ttft-ms", type=float, default=400, help="首 token 延迟（毫秒，lognormal 时为中位数）")
+    parser.add_argument("--ttft-dist", default="fixed", choices=["fixed", "normal", "lognormal"])
+    parser.add_argument("--ttft-sigma", type=float, default=0.3, help="normal 的相对标准差 / lognormal 的 sigma")
+    parser.add_argument("--tokens", type=int, default=200, help="每次生成的 token 数（评审请求固定为 JSON）")
+    parser.add_argument("--tokens-per-sec", type=float, default=60, help="首 token 之后的输出速率")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="按概率返回 500，用于验证故障切换")
+    parser.add_argument("--seed", type=int, default=0)
+
+def stub_argv(args):
+    return [
+        "--ttft-ms", str(args.ttft_ms), "--ttft-dist", args.ttft_dist, "--ttft-sigma", str(args.ttft_sigma),
+        "--tokens", str(args.tokens), "--tokens-per-sec", str(args.tokens_per_sec),
+        "--error-rate", str(args.error_rate), "--seed", str(args.seed)
+    ]
+
+def main():
+    import uvicorn
+    parser = argparse.ArgumentParser(description="OpenAI 兼容的离线 LLM 桩服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+    config = StubConfig(
+        ttft_ms=args.ttft_ms, ttft_dist=args.ttft_dist, ttft_sigma=args.ttft_sigma, tokens=args.tokens,
+        tokens_per_sec=args.tokens_per_sec, error_rate=args.error_rate, seed=args.seed
+    )
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
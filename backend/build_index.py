@@ -0,0 +1,34 @@
+import argparse
+from tools.rag_index import INDEX_TYPES
+from tools.rag_tool import RAGRetriever
+from tools.logger import log
+
+# 离线构建始终使用本地检索器，不受 RAG_MODE=sidecar 影响
+rag_retriever = RAGRetriever()
+
+def build(force=False):
+    """预构建 RAG 模板索引并写入 rag/index，服务启动时直接映射使用"""
+    rag_retriever.load_model()
+    templates = rag_retriever.load_templates()
+    if not templates:
+        log("模板库为空，跳过索引构建", level="WARNING")
+        return
+
+    signature = rag_retriever.index_signature()
+    if not force and rag_retriever.load_saved_index(signature):
+        log(f"索引已是最新 (签名: {signature[:12]})，无需重建✓")
+        return
+
+    log(f"开始构建索引，共 {len(templates)} 个模板...")
+    index, embeddings = rag_retriever.build_index(templates)
+    rag_retriever.save_index(index, embeddings, signature)
+    log("索引构建成功✓")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="预构建 RAG 模板索引")
+    parser.add_argument("--force", action="store_true", help="忽略签名校验，强制重建")
+    parser.add_argument("--index-type", choices=INDEX_TYPES, help="覆盖 RAG_INDEX_TYPE 配置")
+    args = parser.parse_args()
+    if args.index_type:
+        rag_retriever.index_params["index_type"] = args.index_type
+    build(force=args.force)
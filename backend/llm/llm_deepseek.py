@@ -1,13 +1,32 @@
 import os
-from langchain_openai import ChatOpenAI
 
-def get_deepseek_llm(temperature=0.7):
-    """获取 DeepSeek LLM 实例"""
+DEEPSEEK_MODEL = "deepseek-chat"
+
+def check_deepseek_available():
+    """检查 DeepSeek API 是否可用（查询模型列表，不消耗 Token）"""
+    import requests
+    try:
+        api_key = os.getenv("DEEPSEEK_API_KEY")
+        if not api_key:
+            return False
+        base_url = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com").rstrip("/")
+        response = requests.get(f"{base_url}/models", headers={"Authorization": f"Bearer {api_key}"}, timeout=5)
+        return response.status_code == 200
+    except Exception:
+        return False
+
+def get_deepseek_llm(temperature=0.7, cache=None):
+    """获取 DeepSeek LLM 实例（cache 为 LangChain 响应缓存，None 表示不缓存）"""
+    # SDK 导入较慢，延迟到首次使用该供应商时才导入
+    from langchain_openai import ChatOpenAI
     return ChatOpenAI(
-        model="deepseek-chat",
+        model=DEEPSEEK_MODEL,
         openai_api_key=os.getenv("DEEPSEEK_API_KEY"),
         openai_api_base=os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com"),
-        temperature=float(temperature)
+        temperature=float(temperature),
+        # 流式调用时同样返回 Token 用量，供会话级消耗统计
+        stream_usage=True,
+        cache=cache
     )
 
 def parse_deepseek_response(content):
@@ -1,10 +1,12 @@
 import os
-import requests
-from langchain_google_genai import ChatGoogleGenerativeAI
 from tools.logger import log
 
+def gemini_model_id():
+    return os.getenv("LLM_MODEL", "gemini-3-flash-preview")
+
 def check_gemini_available():
-    """检查 Gemini API 是否可用"""
+    """检查 Gemini API 是否可用（查询模型元数据，不消耗 Token）"""
+    import requests
     try:
         api_key = os.getenv("GOOGLE_API_KEY")
         if not api_key:
@@ -15,17 +17,16 @@ def check_gemini_available():
             proxy_url = os.getenv("HTTPS_PROXY") or os.getenv("HTTP_PROXY")
             proxies = {"http": proxy_url, "https": proxy_url}
         
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-3-flash-preview:generateContent?key={api_key}"
-        headers = {"Content-Type": "application/json"}
-        data = {"contents": [{"parts": [{"text": "test"}]}]}
-        
-        response = requests.post(url, headers=headers, json=data, proxies=proxies, timeout=5)
+        url = f"https://generativelanguage.googleapis.com/v1beta/models/{gemini_model_id()}"
+        response = requests.get(url, headers={"x-goog-api-key": api_key}, proxies=proxies, timeout=5)
         return response.status_code == 200
     except Exception:
         return False
 
-def get_gemini_llm(temperature=0.7):
-    """获取 Gemini LLM 实例"""
+def get_gemini_llm(temperature=0.7, cache=None):
+    """获取 Gemini LLM 实例（cache 为 LangChain 响应缓存，None 表示不缓存）"""
+    # SDK 导入较慢，延迟到首次使用该供应商时才导入
+    from langchain_google_genai import ChatGoogleGenerativeAI
     # 确保进程读到代理（从 .env 加载到系统环境变量）
     https_proxy = os.getenv("HTTPS_PROXY")
     http_proxy = os.getenv("HTTP_PROXY")
@@ -36,10 +37,11 @@ def get_gemini_llm(temperature=0.7):
         os.environ["HTTP_PROXY"] = http_proxy
         
     return ChatGoogleGenerativeAI(
-        model=os.getenv("LLM_MODEL", "gemini-3-flash-preview"),
+        model=gemini_model_id(),
         google_api_key=os.getenv("GOOGLE_API_KEY"),
         temperature=float(temperature),
-        transport="rest"
+        transport="rest",
+        cache=cache
     )
 
 def parse_gemini_response(content):
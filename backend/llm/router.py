@@ -0,0 +1,378 @@
+import os
+import time
+import asyncio
+from collections import deque
+from typing import Any, List, Optional
+from langchain_core.language_models.chat_models import BaseChatModel
+from pydantic import Field
+from dotenv import load_dotenv
+from tools.metrics import registry
+from tools.scheduler import rate_limiter_from_env, RATE_LIMIT_WAIT_SECONDS
+from tools.logger import log
+from .llm_gemini import check_gemini_available, get_gemini_llm, gemini_model_id
+from .llm_deepseek import check_deepseek_available, get_deepseek_llm, DEEPSEEK_MODEL
+
+load_dotenv()
+
+LLM_REQUESTS = registry.counter("llm_requests_total", "LLM 调用次数", ("provider", "result"))
+LLM_LATENCY = registry.histogram("llm_request_seconds", "LLM 调用耗时（流式调用为首个 chunk 耗时）", ("provider", "kind"))
+LLM_FAILOVERS = registry.counter("llm_failovers_total", "LLM 调用失败后切换供应商的次数", ("provider",))
+LLM_HEDGES = registry.counter("llm_hedges_total", "LLM 对冲请求次数", ("provider", "result"))
+LLM_PROVIDER_HEALTHY = registry.gauge("llm_provider_healthy", "供应商是否可用（1 可用 / 0 不可用）", ("provider",))
+LLM_PROVIDER_ERROR_RATE = registry.gauge("llm_provider_error_rate", "供应商滚动窗口内的错误率", ("provider",))
+
+def _percentile(samples, q):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+class ProviderHealth:
+    """
+    供应商健康状态：滚动窗口内的延迟与成功率，以及连续失败后的熔断
+    latency 为非流式调用的总耗时，ttft 为流式调用的首个 chunk 耗时
+    """
+
+    def __init__(self, window=100, failure_threshold=3, cooldown=30):
+        self.samples = {"latency": deque(maxlen=window), "ttft": deque(maxlen=window)}
+        self.results = deque(maxlen=window)
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        # 由后台探测更新；探测前乐观地视为可用
+        self.available = True
+
+    def record_success(self, kind, seconds):
+        self.samples[kind].append(seconds)
+        self.results.append(True)
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+
+    def record_failure(self):
+        self.results.append(False)
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.failure_threshold:
+            self.open_until = time.monotonic() + self.cooldown
+
+    def error_rate(self, min_samples=5):
+        if len(self.results) < min_samples:
+            return 0.0
+        return self.results.count(False) / len(self.results)
+
+    def percentile(self, kind, q, min_samples=1):
+        samples = self.samples[kind]
+        if len(samples) < min_samples:
+            return None
+        return _percentile(samples, q)
+
+    @property
+    def healthy(self):
+        return self.available and time.monotonic() >= self.open_until
+
+class Provider:
+    """单个 LLM 供应商：模型工厂、可用性探测与健康状态"""
+
+    def __init__(self, name, factory, probe, enabled=True, health=None, limiter=None, model_id=None):
+        self.name = name
+        # 实际调用的模型 ID，参与 LLM 响应缓存的键计算
+        self.model_id = model_id or name
+        self.factory = factory
+        self.probe = probe
+        self.enabled = enabled
+        self.health = health or ProviderHealth()
+        # 供应商级令牌桶（按每分钟请求数限流），None 表示不限流
+        self.limiter = limiter
+        self._models = {}
+
+    async def throttle(self):
+        if self.limiter:
+            RATE_LIMIT_WAIT_SECONDS.observe(await self.limiter.acquire(), provider=self.name)
+
+    def model(self, temperature):
+        # 子模型不挂缓存，缓存统一由 RoutedChatModel 负责
+        if temperature not in self._models:
+            self._models[temperature] = self.factory(temperature)
+        return self._models[temperature]
+
+class LLMRouter:
+    """
+    多供应商路由：按健康状态排序，逐次调用失败时切换到下一个供应商；
+    开启对冲后，首选供应商超过其 p95 延迟仍未返回时并发请求下一个供应商，先返回者胜出
+    """
+
+    def __init__(self, providers, strategy="priority", max_error_rate=0.5,
+                 hedge_enabled=False, hedge_delay=3.0, hedge_min_samples=20, probe_interval=60):
+        self.providers = providers
+        self.strategy = strategy
+        self.max_error_rate = max_error_rate
+        self.hedge_enabled = hedge_enabled
+        self.hedge_delay = hedge_delay
+        self.hedge_min_samples = hedge_min_samples
+        self.probe_interval = probe_interval
+        self._probe_task = None
+        self._temperatures = set()
+        for provider in providers:
+            LLM_PROVIDER_HEALTHY.set_function(lambda p=provider: int(p.enabled and p.health.healthy), provider=provider.name)
+            LLM_PROVIDER_ERROR_RATE.set_function(lambda p=provider: p.health.error_rate(), provider=provider.name)
+
+    @property
+    def models(self):
+        return [f"{p.name}:{p.model_id}" for p in self.providers if p.enabled]
+
+    def ordered(self):
+        """返回本次调用的供应商尝试顺序：健康者在前，熔断或错误率过高者作为最后手段"""
+        enabled = [p for p in self.providers if p.enabled]
+        healthy = [p for p in enabled if p.health.healthy and p.health.error_rate() <= self.max_error_rate]
+        if self.strategy == "latency":
+            # 尚无样本的供应商按 0 计，保证其有机会被探索
+            healthy.sort(key=lambda p: p.health.percentile("latency", 0.5) or p.health.percentile("ttft", 0.5) or 0.0)
+        return healthy + [p for p in enabled if p not in healthy]
+
+    def _hedge_after(self, provider, kind):
+        """对冲等待时长：样本充足时取首选供应商的 p95，否则使用配置的默认值"""
+        if not self.hedge_enabled:
+            return None
+        p95 = provider.health.percentile(kind, 0.95, self.hedge_min_samples)
+        return p95 if p95 is not None else self.hedge_delay
+
+    def chat_model(self, temperature=0.7, cache=None):
+        self._temperatures.add(float(temperature))
+        return RoutedChatModel(router=self, temperature=float(temperature), cache=cache)
+
+    async def warmup(self):
+        """预先导入 SDK 并创建各供应商的模型客户端（在线程中执行，避免首个请求承担初始化耗时）"""
+        def build():
+            for provider in self.providers:
+                if provider.enabled:
+                    for temperature in self._temperatures:
+                        provider.model(temperature)
+        await asyncio.to_thread(build)
+
+    def _candidates(self):
+        providers = self.ordered()
+        if not providers:
+            raise RuntimeError("没有可用的 LLM 供应商")
+        return providers
+
+    def generate(self, temperature, messages, stop=None, **kwargs):
+        """同步调用：仅做顺序故障切换（不经过令牌桶限流）"""
+        error = None
+        for i, provider in enumerate(self._candidates()):
+            if i:
+                LLM_FAILOVERS.inc(provider=provider.name)
+            start = time.monotonic()
+            try:
+                result = provider.model(temperature)._generate(messages, stop=stop, **kwargs)
+            except Exception as e:
+                self._record_failure(provider, e)
+                error = e
+                continue
+            self._record_success(provider, "latency", time.monotonic() - start)
+            return result
+        raise error
+
+    async def agenerate(self, temperature, messages, stop=None, **kwargs):
+        async def attempt(provider):
+            await provider.throttle()
+            start = time.monotonic()
+            try:
+                result = await provider.model(temperature)._agenerate(messages, stop=stop, **kwargs)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._record_failure(provider, e)
+                raise
+            self._record_success(provider, "latency", time.monotonic() - start)
+            return result
+
+        _, result = await self._race(attempt, "latency")
+        return result
+
+    async def astream(self, temperature, messages, stop=None, **kwargs):
+        """流式调用：故障切换与对冲只作用于首个 chunk 之前，之后直接透传胜出供应商的输出"""
+        async def attempt(provider):
+            await provider.throttle()
+            start = time.monotonic()
+            stream = provider.model(temperature)._astream(messages, stop=stop, **kwargs)
+            try:
+                first = await stream.__anext__()
+            except StopAsyncIteration:
+                first = None
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._record_failure(provider, e)
+                raise
+            self._record_success(provider, "ttft", time.monotonic() - start)
+            return first, stream
+
+        # 同时就绪的落选流直接关闭
+        provider, (first, stream) = await self._race(attempt, "ttft", discard=lambda r: asyncio.ensure_future(r[1].aclose()))
+        if first is None:
+            return
+        yield first
+        try:
+            async for chunk in stream:
+                yield chunk
+        except Exception as e:
+            # 已向下游输出内容，无法再切换供应商
+            self._record_failure(provider, e)
+            raise
+
+    async def _race(self, attempt, kind, discard=None):
+        """
+        依次尝试各供应商：当前请求失败立即切换；开启对冲时超过等待时长再并发发起下一个请求
+        返回 (胜出供应商, 结果)，其余进行中的请求被取消
+        """
+        queue = list(self._candidates())
+        pending = {}
+        errors = []
+        hedged = False
+
+        def launch(provider):
+            pending[asyncio.ensure_future(attempt(provider))] = provider
+
+        primary = queue.pop(0)
+        launch(primary)
+        try:
+            while pending:
+                timeout = None
+                if not hedged and queue and len(pending) == 1:
+                    timeout = self._hedge_after(primary, kind)
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    LLM_HEDGES.inc(provider=queue[0].name, result="launched")
+                    log(f"[LLM-Router] {primary.name} 超过 {timeout:.2f}s 未响应，对冲请求 {queue[0].name}", level="WARNING")
+                    launch(queue.pop(0))
+                    continue
+                winner = None
+                for task in done:
+                    provider = pending.pop(task)
+                    if task.exception() is not None:
+                        errors.append(task.exception())
+                    elif winner is None:
+                        winner = (provider, task.result())
+                    elif discard:
+                        discard(task.result())
+                if winner:
+                    if hedged:
+                        LLM_HEDGES.inc(provider=winner[0].name, result="won")
+                    return winner
+                if not pending and queue:
+                    LLM_FAILOVERS.inc(provider=queue[0].name)
+                    log(f"[LLM-Router] 调用失败，切换至 {queue[0].name}: {errors[-1]}", level="WARNING")
+                    launch(queue.pop(0))
+            raise errors[-1]
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def _record_success(self, provider, kind, seconds):
+        provider.health.record_success(kind, seconds)
+        LLM_REQUESTS.inc(provider=provider.name, result="success")
+        LLM_LATENCY.observe(seconds, provider=provider.name, kind=kind)
+
+    def _record_failure(self, provider, error):
+        provider.health.record_failure()
+        LLM_REQUESTS.inc(provider=provider.name, result="error")
+        log(f"[LLM-Router] {provider.name} 调用失败: {error}", level="ERROR")
+
+    async def probe_once(self):
+        """探测各供应商可用性（阻塞的 HTTP 探测放到线程中执行）"""
+        for provider in self.providers:
+            if not provider.enabled:
+                continue
+            available = await asyncio.to_thread(provider.probe)
+            if available != provider.health.available:
+                log(f"[LLM] {provider.name} API {'恢复可用 ✓' if available else '不可用'}", level="INFO" if available else "WARNING")
+            provider.health.available = available
+
+    async def _probe_loop(self):
+        while True:
+            try:
+                await self.probe_once()
+            except Exception as e:
+                log(f"[LLM-Router] 健康探测失败: {e}", level="ERROR")
+            await asyncio.sleep(self.probe_interval)
+
+    def start_probe(self):
+        """启动后台健康探测（不阻塞启动，探测完成前按可用处理）"""
+        if self._probe_task is None or self._probe_task.done():
+            self._probe_task = asyncio.get_running_loop().create_task(self._probe_loop())
+
+    async def stop_probe(self):
+        if self._probe_task:
+            self._probe_task.cancel()
+            try:
+                await self._probe_task
+            except asyncio.CancelledError:
+                pass
+            self._probe_task = None
+
+class RoutedChatModel(BaseChatModel):
+    """接入 LangChain 的路由模型：调用、流式输出与缓存行为与普通 ChatModel 一致"""
+    router: Any = Field(exclude=True)
+    temperature: float = 0.7
+
+    @property
+    def _llm_type(self):
+        return "routed"
+
+    @property
+    def _identifying_params(self):
+        # 参与 LLM 响应缓存的键计算：包含各供应商的模型 ID，更换模型后不会命中其他模型的缓存
+        return {"temperature": self.temperature, "providers": self.router.models}
+
+    def _generate(self, messages: List[Any], stop: Optional[List[str]] = None, run_manager=None, **kwargs):
+        return self.router.generate(self.temperature, messages, stop=stop, **kwargs)
+
+    async def _agenerate(self, messages: List[Any], stop: Optional[List[str]] = None, run_manager=None, **kwargs):
+        return await self.router.agenerate(self.temperature, messages, stop=stop, **kwargs)
+
+    async def _astream(self, messages: List[Any], stop: Optional[List[str]] = None, run_manager=None, **kwargs):
+        async for chunk in self.router.astream(self.temperature, messages, stop=stop, **kwargs):
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+def create_router():
+    """根据 LLM_PROVIDERS（逗号分隔，按优先级排列）构建路由"""
+    available = {
+        "gemini": Provider("gemini", get_gemini_llm, check_gemini_available, enabled=bool(os.getenv("GOOGLE_API_KEY")), model_id=gemini_model_id()),
+        "deepseek": Provider("deepseek", get_deepseek_llm, check_deepseek_available, enabled=bool(os.getenv("DEEPSEEK_API_KEY")), model_id=DEEPSEEK_MODEL)
+    }
+    names = [n.strip() for n in os.getenv("LLM_PROVIDERS", "gemini,deepseek").split(",") if n.strip()]
+    for name in names:
+        if name not in available:
+            raise ValueError(f"未知的 LLM 供应商: {name}")
+    providers = [available[n] for n in names]
+    if not any(p.enabled for p in providers):
+        # 未配置任何 API Key 时保留全部供应商，由调用时报错提示
+        for provider in providers:
+            provider.enabled = True
+
+    log(f"[LLM] 供应商优先级: {' > '.join(p.name for p in providers if p.enabled)}", level="INFO")
+
+    window = int(os.getenv("LLM_HEALTH_WINDOW", 100))
+    for provider in providers:
+        provider.limiter = rate_limiter_from_env(provider.name)
+        provider.health = ProviderHealth(
+            window=window,
+            failure_threshold=int(os.getenv("LLM_FAILURE_THRESHOLD", 3)),
+            cooldown=float(os.getenv("LLM_FAILURE_COOLDOWN", 30))
+        )
+
+    return LLMRouter(
+        providers,
+        strategy=os.getenv("LLM_ROUTER_STRATEGY", "priority"),
+        max_error_rate=float(os.getenv("LLM_MAX_ERROR_RATE", 0.5)),
+        hedge_enabled=os.getenv("LLM_HEDGE_ENABLED", "false").lower() == "true",
+        hedge_delay=float(os.getenv("LLM_HEDGE_DELAY_MS", 3000)) / 1000,
+        hedge_min_samples=int(os.getenv("LLM_HEDGE_MIN_SAMPLES", 20)),
+        probe_interval=float(os.getenv("LLM_PROBE_INTERVAL", 60))
+    )
+
+# 全局单例
+llm_router = create_router()
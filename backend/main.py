@@ -1,22 +1,65 @@
-import json
+import os
+import hmac
 import asyncio
 import uuid
+import ipaddress
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, Request
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import StreamingResponse, PlainTextResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from agent.graph import app_graph
 from agent.nodes import parse_llm_response
+from agent.stopping import record_session
+from llm.router import llm_router
 from tools.pg_saver import pg_saver
-from tools.logger import log
+from tools.rag_tool import rag_retriever
+from tools.logger import log, close_logging
+from tools.metrics import registry
+from tools.result_cache import result_cache
+from tools.usage import TokenUsageHandler
+from tools.readiness import readiness
+from tools.scheduler import scheduler, client_key, QueueFull
+from tools.sse import stream_from_env, frame, DONE_FRAME
+from tools.session_runs import run_registry, parse_last_event_id
+from tools.tracing import tracer
+from tools.pg_checkpointer import checkpointer
+from tools.pg_bus import pg_bus, TEMPLATES_CHANNEL, CHECKPOINT_CHANNEL
+
+async def warmup_database():
+    await pg_saver.connect()
+    return pg_saver.pool is not None
+
+async def warmup_rag():
+    # 映射预构建的 RAG 索引（签名不一致时重建），随后监听模板文件变化，修改 templates.json 后无需重启即可生效
+    await rag_retriever.warmup()
+    rag_retriever.start_watcher()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # 启动时连接数据库
-    await pg_saver.connect()
+    # 各组件在后台预热，服务立即开始接受连接；预热完成前的请求按需加载（首个请求会承担加载耗时）
+    # 未配置 POSTGRES_URL 时服务照常运行（步骤记录直接跳过），数据库不计入整体就绪状态；
+    # 启动时暂时不可达的数据库会在之后的就绪检查中重试连接，恢复后 /api/ready 随之恢复
+    readiness.start("database", warmup_database, required=bool(pg_saver.dsn), retry=bool(pg_saver.dsn))
+    readiness.start("rag", warmup_rag)
+    readiness.start("llm", llm_router.warmup)
+    # 预热优化结果缓存（仅在启用时，依赖数据库与嵌入模型）
+    readiness.start("result_cache", result_cache.warmup, required=False, after=("database", "rag"))
+    # LLM 供应商健康探测在后台进行，不阻塞启动
+    llm_router.start_probe()
+    # 多 worker 部署时监听其他 worker 的会话事件与缓存变更（CLUSTER_ENABLED=true）
+    await pg_bus.start()
     yield
-    # 关闭时断开连接
+    await readiness.close()
+    await run_registry.close()
+    await pg_bus.close()
+    if checkpointer:
+        await checkpointer.close(timeout=float(os.getenv("PG_DRAIN_TIMEOUT", 30)))
+    await llm_router.stop_probe()
+    # 关闭时断开连接，并停止 RAG 批量推理线程
     await pg_saver.close()
+    await rag_retriever.close()
+    # 最后排空后台日志队列
+    close_logging()
 
 app = FastAPI(title="Prompt Agent API", lifespan=lifespan)
 
@@ -26,65 +69,215 @@ app.add_middleware(
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Session-Id"],
 )
 
+# 恢复会话时下发给前端的状态字段
+CHECKPOINT_VIEW_FIELDS = ("user_intent", "improved_prompt", "critique", "iteration_count", "score", "is_perfect", "rag_match", "current_step")
+
+def checkpoint_view(values):
+    return {k: values[k] for k in CHECKPOINT_VIEW_FIELDS if k in values}
+
+async def run_graph(session_id, original_prompt, ticket, resume=None):
+    """
+    执行一次优化会话并产出 SSE 字节（在后台任务中运行，输出写入会话事件日志）
+    :param resume: 从检查点恢复时为图的 StateSnapshot，已完成的节点不再重复执行
+    """
+    initial_state = {
+        "original_prompt": original_prompt,
+        "iteration_count": 0,
+        "improved_prompt": "",
+        "critique": "",
+        "user_intent": "",
+        "current_step": "Start",
+        "session_id": session_id,
+        "is_perfect": False
+    }
+    # SSE 编码器：token 按时间/长度窗口合并，状态更新只发送变化的字段；同时记录可回放的事件序列，用于写入结果缓存
+    stream = stream_from_env()
+    # 推测模式下各候选的 token 缓冲
+    candidate_tokens = {}
+    # 从检查点恢复时以 None 作为输入，图从最近一个检查点继续执行
+    graph_input = None if resume else initial_state
+
+    try:
+        # 排队期间先推送排队位置（位置变化时更新），放行后再进入正常流程
+        try:
+            async for position in scheduler.wait(ticket):
+                yield frame({'status': 'queued', 'position': position, 'session_id': session_id})
+        except asyncio.TimeoutError:
+            log(f"[{session_id}] 排队超时，请求已取消", level="WARNING")
+            yield frame({'error': '服务繁忙，排队超时，请稍后重试'})
+            return
+
+        # 首先发送初始化信息，透传 session_id
+        yield frame({'status': 'init', 'session_id': session_id, 'resumed': bool(resume)})
+        
+        # 统计本会话的 Token 消耗，结束时与实际轮数一并记录
+        usage = TokenUsageHandler()
+        final_state = {}
+        if resume:
+            # 先下发检查点中的已有状态，之后的状态更新只发送相对它变化的字段
+            final_state.update(resume.values)
+            yield stream.event({'status': 'resume', 'state': stream.delta(checkpoint_view(resume.values))}, record=False)
+        # 追踪节点耗时、LLM 首 token 耗时与 Token 消耗（导出到 /metrics）
+        config = {"configurable": {"thread_id": session_id}, "callbacks": [usage, *tracer.begin(session_id)]}
+        # 使用 astream_events(v2) 捕捉更细粒度的事件
+        async for event in app_graph.astream_events(graph_input, config=config, version="v2"):
+            kind = event["event"]
+            # 合并窗口到期的 token 随下一个图事件写出
+            out = stream.tick()
+            
+            # 1. 捕捉节点开始执行的瞬间
+            if kind == "on_chain_start" and event.get("name") in ["analyzer", "generator", "reflector"]:
+                out += stream.event({'node': event["name"], 'status': 'start'})
+
+            # 2. 捕捉 LLM 吐字的瞬间 (实现流式吐字)
+            elif kind == "on_chat_model_stream":
+                node_name = event.get("metadata", {}).get("langgraph_node")
+                tags = event.get("tags", [])
+                # 我们只在优化阶段（generator）展示流式吐字，推测模式下的候选评审不推送
+                if node_name == "generator" and "speculative_review" not in tags:
+                    content = event["data"]["chunk"].content
+                    # 物理隔离：调用统一解析器
+                    token = parse_llm_response(content)
+                    candidate = next((t for t in tags if t.startswith("candidate:")), None)
+                    if candidate:
+                        # 推测模式：候选并发生成，先按候选缓冲，选优后只推送胜出者的内容
+                        candidate_tokens.setdefault(candidate, []).append(token)
+                    elif token:
+                        out += stream.token(node_name, token)
+
+            # 2.1 Reflector 的评审意见（流式解析 JSON 后按增量推送）
+            elif kind == "on_custom_event" and event.get("name") == "critique_delta":
+                out += stream.token("reflector", event["data"]["token"])
+
+            # 3. 捕捉节点结束并带回状态更新的瞬间
+            elif kind == "on_chain_end" and event.get("name") in ["analyzer", "generator", "reflector"]:
+                node_name = event["name"]
+                # 从输出中提取状态更新
+                output = event.get("data", {}).get("output", {})
+                if node_name == "generator" and output.get("winner_candidate") is not None:
+                    # 胜出候选缓冲的 token 按原顺序经合并窗口写出，前端收到的事件形态与顺序模式一致
+                    tokens = candidate_tokens.get(f"candidate:{output['winner_candidate']}") or [output.get("improved_prompt", "")]
+                    candidate_tokens.clear()
+                    for token in tokens:
+                        if token:
+                            out += stream.token(node_name, token)
+                if isinstance(output, dict):
+                    final_state.update(output)
+                out += stream.node_end(node_name, output)
+
+            if out:
+                yield out
+
+        out = stream.flush()
+        if out:
+            yield out
+
+        record_session(session_id, final_state.get("iteration_count", 0), final_state.get("stop_reason"), usage.snapshot())
+        # 恢复的会话缺少此前的事件，不写入结果缓存
+        if result_cache.enabled and not resume:
+            try:
+                await result_cache.store(session_id, original_prompt, stream.replay_events)
+            except Exception as e:
+                log(f"[{session_id}] [Cache] 写入失败: {e}", level="ERROR")
+
+        log(f"[{session_id}] 提示词优化任务执行完成✓")
+        yield DONE_FRAME
+    except Exception as e:
+        yield stream.flush() + frame({'error': str(e)})
+    finally:
+        # 正常结束、出错或因无人订阅被取消时归还名额（仍在排队则移出队列）
+        scheduler.cancel(ticket)
+        tracer.end(session_id)
+
 @app.post("/api/optimize")
 async def optimize_prompt(request: Request):
     data = await request.json()
     original_prompt = data.get("prompt", "")
     session_id = uuid.uuid4().hex[:8]
+    # 单次请求可通过 no_cache 跳过结果缓存（结果仍会写入缓存）
+    use_cache = result_cache.enabled and not data.get("no_cache", False)
 
-    async def event_generator():
-        initial_state = {
-            "original_prompt": original_prompt,
-            "iteration_count": 0,
-            "improved_prompt": "",
-            "critique": "",
-            "user_intent": "",
-            "current_step": "Start",
-            "session_id": session_id,
-            "is_perfect": False
-        }
+    async def replay_cached(entry, similarity):
+        # 回放事件已按节点合并，整体一次写出
+        yield frame({'status': 'init', 'session_id': session_id, 'cached': True, 'source_session': entry.session_id}) \
+            + b"".join(frame(payload) for payload in entry.events) + DONE_FRAME
+        log(f"[{session_id}] 命中优化结果缓存 (来源: {entry.session_id}, 相似度: {similarity:.3f})✓")
 
+    # 缓存命中直接回放，不占用执行名额
+    if use_cache:
         try:
-            # 首先发送初始化信息，透传 session_id
-            yield f"data: {json.dumps({'status': 'init', 'session_id': session_id})}\n\n"
-            
-            config = {"configurable": {"thread_id": session_id}}
-            # 使用 astream_events(v2) 捕捉更细粒度的事件
-            async for event in app_graph.astream_events(initial_state, config=config, version="v2"):
-                kind = event["event"]
-                
-                # 1. 捕捉节点开始执行的瞬间
-                if kind == "on_chain_start" and event.get("name") in ["analyzer", "generator", "reflector"]:
-                    node_name = event["name"]
-                    yield f"data: {json.dumps({'node': node_name, 'status': 'start'})}\n\n"
-
-                # 2. 捕捉 LLM 吐字的瞬间 (实现流式吐字)
-                elif kind == "on_chat_model_stream":
-                    node_name = event.get("metadata", {}).get("langgraph_node")
-                    # 我们只在优化阶段（generator）展示流式吐字，或者全部展示
-                    if node_name == "generator":
-                        content = event["data"]["chunk"].content
-                        # 物理隔离：调用统一解析器
-                        token = parse_llm_response(content)
-                        if token:
-                            yield f"data: {json.dumps({'node': node_name, 'status': 'token', 'token': token})}\n\n"
-
-                # 3. 捕捉节点结束并带回状态更新的瞬间
-                elif kind == "on_chain_end" and event.get("name") in ["analyzer", "generator", "reflector"]:
-                    node_name = event["name"]
-                    # 从输出中提取状态更新
-                    output = event.get("data", {}).get("output", {})
-                    yield f"data: {json.dumps({'node': node_name, 'status': 'end', 'updates': output})}\n\n"
-                
-            log(f"[{session_id}] 提示词优化任务执行完成✓")
-            yield "data: [DONE]\n\n"
+            found = await result_cache.lookup(original_prompt)
         except Exception as e:
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+            found = None
+            log(f"[{session_id}] [Cache] 查询失败: {e}", level="ERROR")
+        if found:
+            return StreamingResponse(replay_cached(*found), media_type="text/event-stream")
+
+    # 准入控制：超出并发上限的请求进入有界队列，队列已满时直接拒绝
+    try:
+        ticket = scheduler.enqueue(client_key(request))
+    except QueueFull as e:
+        return JSONResponse({"error": str(e)}, status_code=429, headers={"Retry-After": "5"})
+
+    # 全新会话不存在历史检查点，登记后首次读取无需查询数据库
+    if checkpointer:
+        checkpointer.start_thread(session_id)
+    # 图在后台执行并写入会话事件日志，客户端断开不影响执行；本连接只是日志的第一个订阅者
+    run = run_registry.start(session_id, run_graph(session_id, original_prompt, ticket))
+    return StreamingResponse(run.subscribe(), media_type="text/event-stream", headers={"X-Session-Id": session_id})
+
+@app.get("/api/optimize/{session_id}/events")
+async def resume_optimize(session_id: str, request: Request):
+    """断线重连：从 Last-Event-ID 请求头（或 last_event_id 查询参数）之后续读会话事件"""
+    last_event_id = parse_last_event_id(request.headers.get("Last-Event-ID") or request.query_params.get("last_event_id"))
+    stream = await run_registry.replay(session_id, last_event_id)
+    if stream is None:
+        return JSONResponse({"error": "会话不存在或已过期"}, status_code=404)
+    log(f"[{session_id}] 客户端重连，从事件 {last_event_id} 之后续读")
+    return StreamingResponse(stream, media_type="text/event-stream", headers={"X-Session-Id": session_id})
+
+@app.post("/api/optimize/{session_id}/resume")
+async def resume_from_checkpoint(session_id: str, request: Request):
+    """从最近的检查点恢复会话（如进程重启或会话被取消后），已完成的节点不再重复调用 LLM"""
+    run = run_registry.get(session_id)
+    if run and not run.done:
+        # 仍在执行，直接订阅
+        return StreamingResponse(run.subscribe(), media_type="text/event-stream", headers={"X-Session-Id": session_id})
+    if await run_registry.running_elsewhere(session_id):
+        # 仍在其他 worker 上执行，跟随其事件而不是重复执行
+        stream = await run_registry.replay(session_id)
+        return StreamingResponse(stream, media_type="text/event-stream", headers={"X-Session-Id": session_id})
+    if not checkpointer:
+        return JSONResponse({"error": "未启用检查点"}, status_code=404)
+
+    snapshot = await app_graph.aget_state({"configurable": {"thread_id": session_id}})
+    if not snapshot.values:
+        return JSONResponse({"error": "会话不存在或没有可恢复的检查点"}, status_code=404)
+    if not snapshot.next:
+        # 会话已执行完毕，直接返回最终状态
+        async def finished():
+            yield frame({'status': 'init', 'session_id': session_id, 'resumed': True}) \
+                + frame({'status': 'resume', 'state': checkpoint_view(snapshot.values)}) + DONE_FRAME
+        return StreamingResponse(finished(), media_type="text/event-stream", headers={"X-Session-Id": session_id})
+
+    try:
+        ticket = scheduler.enqueue(client_key(request))
+    except QueueFull as e:
+        return JSONResponse({"error": str(e)}, status_code=429, headers={"Retry-After": "5"})
+    if not await run_registry.claim(session_id):
+        # 其他 worker 抢先获得了租约（并发恢复），跟随其执行
+        scheduler.cancel(ticket)
+        stream = await run_registry.replay(session_id)
+        return StreamingResponse(stream, media_type="text/event-stream", headers={"X-Session-Id": session_id})
+    log(f"[{session_id}] 从检查点恢复执行 (待执行节点: {', '.join(snapshot.next)})")
+    # 其他 worker 内存中保留的该会话检查点即将过期
+    await pg_bus.publish(CHECKPOINT_CHANNEL, {"thread_id": session_id})
+    run = run_registry.start(session_id, run_graph(session_id, snapshot.values.get("original_prompt", ""), ticket, resume=snapshot))
+    return StreamingResponse(run.subscribe(), media_type="text/event-stream", headers={"X-Session-Id": session_id})
 
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
-    
 @app.post("/api/save_prompt")
 async def save_prompt(request: Request):
     data = await request.json()
@@ -99,6 +292,82 @@ async def save_prompt(request: Request):
     success = await pg_saver.save_to_library(title, content, session_id, tags)
     return {"success": success, "message": "保存成功" if success else "保存失败"}
 
+@app.get("/api/ready")
+async def ready():
+    """就绪检查：所有必需组件预热完成时返回 200，否则返回 503 及各组件状态"""
+    readiness.refresh()
+    report = readiness.report()
+    report["rag_index_version"] = rag_retriever.index_version
+    report["llm_providers"] = {
+        p.name: {"healthy": p.health.healthy, "error_rate": p.health.error_rate()}
+        for p in llm_router.providers if p.enabled
+    }
+    return JSONResponse(report, status_code=200 if report["ready"] else 503)
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus 文本格式的进程内指标"""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+def check_admin(request: Request):
+    """管理接口鉴权：要求请求头 X-Admin-Token 与 ADMIN_TOKEN 一致；未配置 ADMIN_TOKEN 时仅允许本机回环地址访问"""
+    token = os.getenv("ADMIN_TOKEN")
+    if token:
+        if not hmac.compare_digest(request.headers.get("X-Admin-Token", ""), token):
+            raise HTTPException(status_code=403, detail="无权访问管理接口")
+        return
+    host = request.client.host if request.client else ""
+    try:
+        loopback = ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        loopback = False
+    if not loopback:
+        raise HTTPException(status_code=403, detail="未配置 ADMIN_TOKEN，管理接口仅允许本机访问")
+
+@app.get("/api/admin/templates")
+async def list_templates(request: Request):
+    check_admin(request)
+    return {"success": True, "version": rag_retriever.index_version, "templates": rag_retriever.templates}
+
+@app.put("/api/admin/templates/{template_id}")
+async def upsert_template(template_id: str, request: Request):
+    check_admin(request)
+    data = await request.json()
+    if not data.get("intent") or not data.get("template"):
+        return {"success": False, "message": "intent 与 template 不能为空"}
+
+    template = {"id": template_id, "intent": data["intent"], "template": data["template"]}
+    encoded, _ = await rag_retriever.upsert_templates([template])
+    # 同步到其他节点（同一主机上的 worker 共用模板文件或边车，重复应用不会重新编码）
+    await pg_bus.publish(TEMPLATES_CHANNEL, {"op": "upsert", "templates": [template]})
+    return {"success": True, "message": "模板已更新", "encoded": encoded, "version": rag_retriever.index_version}
+
+@app.delete("/api/admin/templates/{template_id}")
+async def delete_template(template_id: str, request: Request):
+    check_admin(request)
+    _, removed = await rag_retriever.delete_templates([template_id])
+    if not removed:
+        return {"success": False, "message": f"模板不存在: {template_id}"}
+    await pg_bus.publish(TEMPLATES_CHANNEL, {"op": "delete", "ids": [template_id]})
+    return {"success": True, "message": "模板已删除", "version": rag_retriever.index_version}
+
+@app.get("/api/admin/traces/{session_id}")
+async def get_trace(session_id: str, request: Request):
+    """会话追踪明细：各节点、LLM 调用、RAG 检索与数据库写入的耗时"""
+    check_admin(request)
+    trace = tracer.get(session_id)
+    if not trace:
+        return JSONResponse({"success": False, "message": "追踪记录不存在或已过期"}, status_code=404)
+    return {"success": True, "trace": trace.to_dict()}
+
+@app.post("/api/admin/templates/reload")
+async def reload_templates(request: Request):
+    check_admin(request)
+    encoded, removed = await rag_retriever.reload_templates()
+    return {"success": True, "encoded": encoded, "removed": removed, "version": rag_retriever.index_version}
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # 多 worker 时各进程独立导入应用（需以导入字符串启动）；建议同时启用 RAG_MODE=sidecar 与 CLUSTER_ENABLED
+    workers = int(os.getenv("WEB_WORKERS", 1))
+    uvicorn.run("main:app" if workers > 1 else app, host="0.0.0.0", port=8000, workers=workers)
@@ -0,0 +1,84 @@
+-- ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+-- 迁移：prompt_history 全量行 → prompt_sessions + prompt_iterations 差量存储
+-- 执行：psql "$POSTGRES_URL" -f migrations/001_delta_history.sql
+-- 迁移后 prompt_history 变为视图，旧表保留为 prompt_history_legacy，确认无误后可手动删除
+-- 顺序：建议先停止后端再执行迁移，然后启动新版本；新版本在迁移前已运行过也可以直接执行，
+-- 迁移前写入 prompt_iterations 的记录会整体移到旧数据 id 之后，不会与保留原 id 的旧数据冲突
+-- ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+BEGIN;
+
+ALTER TABLE prompt_history RENAME TO prompt_history_legacy;
+
+CREATE TABLE IF NOT EXISTS prompt_sessions (
+    session_id VARCHAR(50) PRIMARY KEY,
+    original_prompt TEXT NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS prompt_iterations (
+    id SERIAL PRIMARY KEY,
+    session_id VARCHAR(50) NOT NULL,
+    iteration_count INTEGER DEFAULT 0,
+    user_intent TEXT,
+    improved_prompt TEXT,
+    critique TEXT,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_iterations_session ON prompt_iterations(session_id, iteration_count);
+ALTER TABLE prompt_iterations SET (toast_tuple_target = 256);
+
+-- 每个会话只保留一份原始提示词（取最早的一步）
+INSERT INTO prompt_sessions (session_id, original_prompt, created_at)
+SELECT DISTINCT ON (session_id) session_id, original_prompt, created_at
+FROM prompt_history_legacy
+ORDER BY session_id, iteration_count, id
+ON CONFLICT (session_id) DO NOTHING;
+
+-- 新版本在迁移前已写入的记录：id 整体后移到现有最大 id 之后，为保留原 id 的旧数据让出位置
+-- （偏移量取两表最大 id 中较大者，逐行更新时新旧 id 不会重叠）
+UPDATE prompt_iterations
+SET id = id + (SELECT GREATEST(
+    (SELECT COALESCE(MAX(id), 0) FROM prompt_history_legacy),
+    (SELECT COALESCE(MAX(id), 0) FROM prompt_iterations)
+));
+
+-- 与上一步相同的字段置空，只保留变化量；保留原 id 以兼容外部引用
+INSERT INTO prompt_iterations (id, session_id, iteration_count, user_intent, improved_prompt, critique, created_at)
+SELECT
+    id,
+    session_id,
+    iteration_count,
+    CASE WHEN user_intent IS DISTINCT FROM LAG(user_intent) OVER w THEN user_intent END,
+    CASE WHEN improved_prompt IS DISTINCT FROM LAG(improved_prompt) OVER w THEN improved_prompt END,
+    critique,
+    created_at
+FROM prompt_history_legacy
+WINDOW w AS (PARTITION BY session_id ORDER BY iteration_count, id);
+
+SELECT setval(pg_get_serial_sequence('prompt_iterations', 'id'), COALESCE((SELECT MAX(id) FROM prompt_iterations), 1));
+
+CREATE OR REPLACE VIEW prompt_history AS
+SELECT
+    i.id,
+    i.session_id,
+    s.original_prompt,
+    COALESCE(i.user_intent, (
+        SELECT p.user_intent FROM prompt_iterations p
+        WHERE p.session_id = i.session_id AND p.iteration_count < i.iteration_count AND p.user_intent IS NOT NULL
+        ORDER BY p.iteration_count DESC LIMIT 1
+    )) AS user_intent,
+    COALESCE(i.improved_prompt, (
+        SELECT p.improved_prompt FROM prompt_iterations p
+        WHERE p.session_id = i.session_id AND p.iteration_count < i.iteration_count AND p.improved_prompt IS NOT NULL
+        ORDER BY p.iteration_count DESC LIMIT 1
+    )) AS improved_prompt,
+    i.critique,
+    i.iteration_count,
+    i.created_at
+FROM prompt_iterations i
+JOIN prompt_sessions s ON s.session_id = i.session_id;
+
+COMMIT;
+
+-- 迁移完成后回收旧表空间（可选）：
+-- DROP TABLE prompt_history_legacy;
@@ -1,8 +1,24 @@
-from agent.graph import app_graph
+"""
+工作流调试与性能回归脚本（在 backend/ 目录下运行）
+
+    python test_graph.py "帮我写一个 vue 表格"                  # 使用 .env 中配置的真实模型执行一次并打印各节点输出
+    python test_graph.py --perf --sessions 32 --concurrency 8    # 使用 LLM 桩服务与桩数据库，统计 TTFT 与端到端耗时
+    python test_graph.py --perf --output bench/graph_perf.json   # 保存结果，之后以 --baseline 对比
+    python test_graph.py --perf --baseline bench/graph_perf.json --tolerance 0.15
+
+性能模式在进程内直接执行图（不经过 HTTP/SSE），桩服务参数与 bench.load_test 相同
+"""
+import os
 import sys
+import time
+import uuid
 import asyncio
+import argparse
 
 async def run_test(prompt: str):
+    from agent.graph import app_graph
+    from tools.pg_saver import pg_saver
+
     # 初始化状态
     initial_state = {
         "original_prompt": prompt,
@@ -19,7 +35,9 @@ async def run_test(prompt: str):
 
     # 运行图
     final_prompt = ""
-    async for output in app_graph.astream(initial_state):
+    # 图启用了检查点，需要提供 thread_id
+    config = {"configurable": {"thread_id": f"test-{uuid.uuid4().hex[:8]}"}}
+    async for output in app_graph.astream(initial_state, config=config):
         for node_name, state_update in output.items():
             print(f"\n>>> 节点 [{node_name}] 执行完毕")
             # 打印关键更新
@@ -37,13 +55,71 @@ async def run_test(prompt: str):
     print(final_prompt if final_prompt else "未生成结果")
     print("="*50)
 
+    # 等待写入队列中的步骤记录落库
+    await pg_saver.close()
+
+async def run_perf_session(graph, prompt, session_id):
+    """执行一次会话：TTFT 为 Generator 首个非空 token 的耗时"""
+    result = {"ttft": None, "e2e": None, "error": None}
+    start = time.perf_counter()
+    config = {"configurable": {"thread_id": session_id}}
+    try:
+        async for event in graph.astream_events({"original_prompt": prompt, "iteration_count": 0, "session_id": session_id},
+                                                config=config, version="v2"):
+            if result["ttft"] is None and event["event"] == "on_chat_model_stream" \
+                    and event.get("metadata", {}).get("langgraph_node") == "generator" and event["data"]["chunk"].content:
+                result["ttft"] = time.perf_counter() - start
+        result["e2e"] = time.perf_counter() - start
+    except Exception as e:
+        result["error"] = type(e).__name__
+    return result
+
+async def run_perf(args):
+    from agent.graph import app_graph
+    from bench.load_test import summarize
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one(i):
+        async with semaphore:
+            return await run_perf_session(app_graph, args.prompt, f"perf-{i}")
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(one(i) for i in range(args.sessions)))
+    return summarize(results, time.perf_counter() - start)
+
+def perf_main(args):
+    from bench.load_test import start_stub, bench_env, report
+    from bench.serve import stub_database
+
+    stub, stub_url = start_stub(args, args.stub_port)
+    try:
+        # 图模块在导入时读取配置，需先设置好环境变量
+        os.environ.update(bench_env(stub_url, args.rounds, args.concurrency))
+        stub_database()
+        summary = asyncio.run(run_perf(args))
+        summary["config"] = {k: v for k, v in vars(args).items() if k not in ("output", "baseline", "prompt_arg", "perf")}
+        return report(summary, args)
+    finally:
+        stub.terminate()
+        stub.wait()
+
 if __name__ == "__main__":
-    test_prompt = "帮我写一个 vue 表格，带分页功能"
-    if len(sys.argv) > 1:
-        test_prompt = sys.argv[1]
-    
+    parser = argparse.ArgumentParser(description="工作流调试与性能回归")
+    parser.add_argument("prompt_arg", nargs="?", default="帮我写一个 vue 表格，带分页功能")
+    parser.add_argument("--perf", action="store_true", help="性能回归模式（LLM 桩服务 + 桩数据库）")
+    parser.add_argument("--concurrency", type=int, default=8, help="并发会话数")
+    parser.add_argument("--stub-port", type=int, default=9100)
+    args, _ = parser.parse_known_args()
+
+    if args.perf:
+        from bench.load_test import add_run_arguments
+        add_run_arguments(parser)
+        args = parser.parse_args()
+        sys.exit(perf_main(args))
+
     try:
-        asyncio.run(run_test(test_prompt))
+        asyncio.run(run_test(args.prompt_arg))
     except Exception as e:
         print(f"\n[ERROR] 运行失败: {e}")
         print("提示：请确保 d:/Python/agent/prompt_agent/backend/.env 中配置了正确的 DEEPSEEK_API_KEY")
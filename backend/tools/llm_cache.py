@@ -0,0 +1,141 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from langchain_core.caches import BaseCache
+from langchain_core.load import dumps, loads
+from .cache import TTLCache
+from .metrics import registry
+from .logger import log
+
+LLM_CACHE_LOOKUPS = registry.counter("llm_cache_lookups_total", "LLM 响应缓存查询次数", ("result",))
+LLM_CACHE_SAVED_TOKENS = registry.counter("llm_cache_saved_tokens_total", "LLM 响应缓存命中节省的 Token 数")
+
+def _saved_tokens(generations):
+    total = 0
+    for generation in generations:
+        usage = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+        total += usage.get("total_tokens", 0)
+    return total
+
+class LLMResponseCache(BaseCache):
+    """
+    LLM 响应精确匹配缓存（接入 LangChain 的 cache 扩展点）
+    缓存键由 LangChain 传入：prompt 为完整渲染后的消息序列（含格式说明），
+    llm_string 包含模型名称、温度等调用参数，任一不同即视为不同请求
+    内存 LRU 为一级缓存，可选 SQLite 文件为二级缓存（进程重启后仍可命中）
+    """
+
+    def __init__(self, max_size=1024, ttl=86400, sqlite_path=None):
+        self.memory = TTLCache(max_size, ttl)
+        self.ttl = float(ttl)
+        self.sqlite_path = sqlite_path
+        self._conn = None
+        self._lock = threading.Lock()
+        if sqlite_path:
+            self._conn = sqlite3.connect(sqlite_path, check_same_thread=False)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    generations TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
+            self._conn.commit()
+
+    @staticmethod
+    def _key(prompt, llm_string):
+        return hashlib.sha256(f"{llm_string}\x00{prompt}".encode("utf-8")).hexdigest()
+
+    def _record(self, generations):
+        if generations is None:
+            LLM_CACHE_LOOKUPS.inc(result="miss")
+            return None
+        LLM_CACHE_LOOKUPS.inc(result="hit")
+        saved = _saved_tokens(generations)
+        LLM_CACHE_SAVED_TOKENS.inc(saved)
+        hits, misses = LLM_CACHE_LOOKUPS.value(result="hit"), LLM_CACHE_LOOKUPS.value(result="miss")
+        log(f"[LLM-Cache] 命中响应缓存，节省 {saved} tokens (命中率: {hits / (hits + misses):.1%}, 累计节省: {LLM_CACHE_SAVED_TOKENS.value()} tokens)")
+        return generations
+
+    def _lookup_disk(self, key):
+        if not self._conn:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT generations FROM llm_cache WHERE cache_key = ? AND created_at > ?",
+                (key, time.time() - self.ttl)
+            ).fetchone()
+        if not row:
+            return None
+        generations = [loads(item) for item in json.loads(row[0])]
+        # 回填内存层
+        self.memory.set(key, generations)
+        return generations
+
+    def _update_disk(self, key, generations):
+        if not self._conn:
+            return
+        try:
+            payload = json.dumps([dumps(generation) for generation in generations])
+        except Exception as e:
+            log(f"[LLM-Cache] 响应序列化失败，跳过持久化: {e}", level="WARNING")
+            return
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (cache_key, generations, created_at) VALUES (?, ?, ?)",
+                (key, payload, time.time())
+            )
+            self._conn.commit()
+
+    def lookup(self, prompt, llm_string):
+        key = self._key(prompt, llm_string)
+        generations = self.memory.get(key)
+        if generations is None:
+            generations = self._lookup_disk(key)
+        return self._record(generations)
+
+    def update(self, prompt, llm_string, return_val):
+        key = self._key(prompt, llm_string)
+        self.memory.set(key, return_val)
+        self._update_disk(key, return_val)
+
+    def clear(self, **kwargs):
+        self.memory.clear()
+        if self._conn:
+            with self._lock:
+                self._conn.execute("DELETE FROM llm_cache")
+                self._conn.commit()
+
+    async def alookup(self, prompt, llm_string):
+        # 内存层直接在 Event Loop 上查询，只有磁盘层放到线程中执行
+        key = self._key(prompt, llm_string)
+        generations = self.memory.get(key)
+        if generations is None and self._conn:
+            generations = await asyncio.to_thread(self._lookup_disk, key)
+        return self._record(generations)
+
+    async def aupdate(self, prompt, llm_string, return_val):
+        key = self._key(prompt, llm_string)
+        self.memory.set(key, return_val)
+        if self._conn:
+            await asyncio.to_thread(self._update_disk, key, return_val)
+
+    async def aclear(self, **kwargs):
+        await asyncio.to_thread(self.clear)
+
+def create_llm_cache():
+    """根据环境变量创建 LLM 响应缓存，未启用时返回 None"""
+    if os.getenv("LLM_CACHE_ENABLED", "true").lower() != "true":
+        return None
+    return LLMResponseCache(
+        max_size=int(os.getenv("LLM_CACHE_MAX_SIZE", 1024)),
+        ttl=float(os.getenv("LLM_CACHE_TTL", 86400)),
+        sqlite_path=os.getenv("LLM_CACHE_SQLITE_PATH") or None
+    )
+
+# 全局单例（仅用于确定性较强的 Analyzer / Reflector）
+llm_cache = create_llm_cache()
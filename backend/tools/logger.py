@@ -1,7 +1,17 @@
 import sys
 import os
+import json
+import random
 from loguru import logger
 
+# 日志格式：text（彩色文本，默认）/ json（每行一个 JSON 对象，便于日志平台采集）
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# 单条日志消息与每个字段的最大字符数，超出部分截断，避免大段提示词在每个步骤都被完整序列化
+LOG_MAX_CHARS = int(os.getenv("LOG_MAX_CHARS", 2000))
+# DEBUG 级别日志的采样率（0~1），高频调试事件只输出其中一部分
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", 0.1))
+
 # 移除默认的控制台输出
 logger.remove()
 
@@ -11,14 +21,50 @@ logger.level("DEBUG", color="<blue>")
 logger.level("WARNING", color="<yellow>")
 logger.level("ERROR", color="<red>")
 
-# 配置控制台输出（带颜色，模仿 Java Spring Boot 风格）
-# 格式：日期 时间.毫秒  级别(带颜色)  消息
-logger.add(
-    sys.stdout,
-    colorize=True,
-    format="{time:YYYY-MM-DD HH:mm:ss.SSS}  <level>{level: <8}</level> {message}",
-    level="INFO"
-)
+def _cap(text, limit=None):
+    limit = limit or LOG_MAX_CHARS
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}...(+{len(text) - limit} chars)"
+
+class _Capped:
+    """延迟格式化参数：只有日志实际输出时才转换为字符串，并截断到 LOG_MAX_CHARS"""
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __format__(self, spec):
+        return _cap(format(self.value, spec))
+
+def _json_format(record):
+    """JSON 行格式：固定字段 + 调用方传入的结构化字段"""
+    payload = {
+        "ts": record["time"].isoformat(timespec="milliseconds"),
+        "level": record["level"].name,
+        "msg": _cap(record["message"]),
+    }
+    for key, value in record["extra"].items():
+        if not key.startswith("_"):
+            payload[key] = value if isinstance(value, (int, float, bool)) or value is None else _cap(str(value))
+    record["extra"]["_json"] = json.dumps(payload, ensure_ascii=False)
+    return "{extra[_json]}\n"
+
+def _text_format(record):
+    # 格式：日期 时间.毫秒  级别(带颜色)  消息
+    record["extra"]["_message"] = _cap(record["message"])
+    return "{time:YYYY-MM-DD HH:mm:ss.SSS}  <level>{level: <8}</level> {extra[_message]}\n"
+
+def _file_format(record):
+    record["extra"]["_message"] = _cap(record["message"])
+    return "{time:YYYY-MM-DD HH:mm:ss.SSS}  {level: <8} {extra[_message]}\n"
+
+# 配置控制台输出：enqueue 使写入在后台线程进行，不阻塞事件循环
+if LOG_FORMAT == "json":
+    logger.add(sys.stdout, format=_json_format, level=LOG_LEVEL, enqueue=True, colorize=False)
+else:
+    # 带颜色，模仿 Java Spring Boot 风格
+    logger.add(sys.stdout, format=_text_format, level=LOG_LEVEL, enqueue=True, colorize=True)
 
 # 配置文件输出（自动按天切割，保留 7 天）
 log_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "logs")
@@ -30,24 +76,31 @@ logger.add(
     rotation="00:00",
     retention="7 days",
     enqueue=True,
-    format="{time:YYYY-MM-DD HH:mm:ss.SSS}  {level: <8} {message}",
-    level="INFO"
+    format=_json_format if LOG_FORMAT == "json" else _file_format,
+    level=LOG_LEVEL
 )
 
-def log(message, level="INFO"):
+def log(message, *args, level="INFO", sample=None, **fields):
     """
     分级日志输出
-    :param message: 日志内容
+    :param message: 日志内容；传入 args 时作为 str.format 模板，仅在日志实际输出时才格式化
     :param level: 日志级别 (INFO, ERROR, WARNING, DEBUG)
+    :param sample: 采样率（0~1），DEBUG 级别默认使用 LOG_DEBUG_SAMPLE_RATE
+    :param fields: 结构化字段（JSON 模式下作为独立字段输出，如 session_id、node）
     """
     level = level.upper()
-    if level == "INFO":
-        logger.info(message)
-    elif level == "ERROR":
-        logger.error(message)
-    elif level == "WARNING":
-        logger.warning(message)
-    elif level == "DEBUG":
-        logger.debug(message)
+    if level not in ("INFO", "ERROR", "WARNING", "DEBUG"):
+        level = "INFO"
+    if sample is None and level == "DEBUG":
+        sample = LOG_DEBUG_SAMPLE_RATE
+    if sample is not None and sample < 1 and random.random() >= sample:
+        return
+    target = logger.bind(**fields) if fields else logger
+    if args:
+        target.log(level, message, *(_Capped(a) for a in args))
     else:
-        logger.info(message)
+        target.log(level, message)
+
+def close_logging():
+    """关闭时等待后台队列中的日志写完"""
+    logger.remove()
@@ -0,0 +1,127 @@
+import os
+import json
+import socket
+import asyncio
+import asyncpg
+from .pg_saver import pg_saver
+from .metrics import registry
+from .logger import log
+
+# 频道名称（多个 worker / 节点共用同一数据库时彼此可见）
+SESSION_EVENTS_CHANNEL = "prompt_agent_session_events"
+SESSION_ATTACH_CHANNEL = "prompt_agent_session_attach"
+RESULT_CACHE_CHANNEL = "prompt_agent_result_cache"
+TEMPLATES_CHANNEL = "prompt_agent_templates"
+CHECKPOINT_CHANNEL = "prompt_agent_checkpoints"
+
+# NOTIFY 负载上限为 8000 字节，留出余量
+MAX_PAYLOAD_BYTES = 7900
+
+BUS_CONNECTED = registry.gauge("pg_bus_connected", "LISTEN 专用连接是否可用")
+BUS_MESSAGES = registry.counter("pg_bus_messages_total", "跨进程消息数", ("channel", "direction"))
+
+class PgBus:
+    """
+    基于 Postgres LISTEN/NOTIFY 的跨进程消息总线
+    LISTEN 需要独占连接，每个进程单独维护一条连接（断开后自动重连），发布则经 PostgresSaver 连接池执行 pg_notify
+    消息为 JSON 对象并附带发布者的 node_id，进程会忽略自己发出的消息
+    负载上限约 8000 字节，较大的数据只发送标识，由接收方回查数据库
+    """
+
+    def __init__(self, enabled=False, dsn=None, reconnect_interval=5.0):
+        self.enabled = enabled and bool(dsn)
+        self.dsn = dsn
+        self.reconnect_interval = reconnect_interval
+        self.node_id = f"{socket.gethostname()}-{os.getpid()}"
+        self.handlers = {}
+        self._conn = None
+        self._listener = None
+
+    def subscribe(self, channel, handler):
+        """登记频道的处理函数（普通函数或协程函数，参数为消息 dict）；需在 start 之前调用"""
+        self.handlers.setdefault(channel, []).append(handler)
+
+    async def start(self):
+        if not self.enabled or (self._listener and not self._listener.done()):
+            return
+        self._listener = asyncio.get_running_loop().create_task(self._listen())
+
+    async def _listen(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                self._conn = await asyncpg.connect(self.dsn)
+                closed = loop.create_future()
+                self._conn.add_termination_listener(lambda _: closed.done() or closed.set_result(None))
+                for channel in self.handlers:
+                    await self._conn.add_listener(channel, self._dispatch)
+                BUS_CONNECTED.set(1)
+                log(f"[Bus] 已监听 {len(self.handlers)} 个频道 (node: {self.node_id})✓")
+                await closed
+                log("[Bus] 监听连接已断开，稍后重连", level="WARNING")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log(f"[ERROR] 监听连接建立失败: {e}", level="ERROR")
+            finally:
+                BUS_CONNECTED.set(0)
+                if self._conn and not self._conn.is_closed():
+                    self._conn.terminate()
+                self._conn = None
+            await asyncio.sleep(self.reconnect_interval)
+
+    def _dispatch(self, connection, pid, channel, payload):
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            return
+        if message.get("origin") == self.node_id:
+            return
+        BUS_MESSAGES.inc(channel=channel, direction="in")
+        for handler in self.handlers.get(channel, ()):
+            try:
+                result = handler(message)
+                if asyncio.iscoroutine(result):
+                    asyncio.get_running_loop().create_task(self._run(channel, result))
+            except Exception as e:
+                log(f"[ERROR] 频道 {channel} 消息处理失败: {e}", level="ERROR")
+
+    @staticmethod
+    async def _run(channel, coro):
+        try:
+            await coro
+        except Exception as e:
+            log(f"[ERROR] 频道 {channel} 消息处理失败: {e}", level="ERROR")
+
+    async def publish(self, channel, message):
+        """发布消息，未启用、数据库不可用或负载超限时返回 False（调用方不依赖送达）"""
+        if not self.enabled or not pg_saver.pool:
+            return False
+        payload = json.dumps({**message, "origin": self.node_id}, ensure_ascii=False)
+        if len(payload.encode("utf-8")) > MAX_PAYLOAD_BYTES:
+            log(f"[Bus] 消息超过 {MAX_PAYLOAD_BYTES} 字节，未发布到 {channel}", level="WARNING")
+            return False
+        try:
+            async with pg_saver.acquire() as conn, pg_saver.timed("notify"):
+                await conn.execute("SELECT pg_notify($1, $2)", channel, payload)
+        except Exception as e:
+            log(f"[ERROR] 消息发布失败 ({channel}): {e}", level="ERROR")
+            return False
+        BUS_MESSAGES.inc(channel=channel, direction="out")
+        return True
+
+    async def close(self):
+        if self._listener:
+            self._listener.cancel()
+            await asyncio.gather(self._listener, return_exceptions=True)
+            self._listener = None
+
+def create_pg_bus():
+    return PgBus(
+        enabled=os.getenv("CLUSTER_ENABLED", "false").lower() == "true",
+        dsn=os.getenv("POSTGRES_URL"),
+        reconnect_interval=float(os.getenv("PG_RECONNECT_INTERVAL", 5))
+    )
+
+# 全局单例
+pg_bus = create_pg_bus()
@@ -0,0 +1,285 @@
+import os
+import asyncio
+from collections import OrderedDict
+from langgraph.checkpoint.base import (
+    BaseCheckpointSaver, CheckpointTuple, WRITES_IDX_MAP, copy_checkpoint, get_checkpoint_id
+)
+from .pg_saver import pg_saver
+from .pg_bus import pg_bus, CHECKPOINT_CHANNEL
+from .metrics import registry
+from .write_behind import WriteBehindQueue
+from .logger import log
+
+CHECKPOINT_QUEUE = registry.gauge("checkpoint_write_queue_depth", "待写入的图检查点批次数")
+CHECKPOINT_DROPPED = registry.counter("checkpoint_writes_dropped_total", "数据库不可用时未能落库的检查点写入数")
+
+INSERT_CHECKPOINT_SQL = """
+    INSERT INTO graph_checkpoints (thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata)
+    VALUES ($1, $2, $3, $4, $5, $6, $7, $8) ON CONFLICT DO NOTHING
+"""
+INSERT_BLOB_SQL = """
+    INSERT INTO graph_checkpoint_blobs (thread_id, checkpoint_ns, channel, version, type, blob)
+    VALUES ($1, $2, $3, $4, $5, $6) ON CONFLICT DO NOTHING
+"""
+UPSERT_WRITE_SQL = """
+    INSERT INTO graph_checkpoint_writes (thread_id, checkpoint_ns, checkpoint_id, task_id, idx, channel, type, blob)
+    VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+    ON CONFLICT (thread_id, checkpoint_ns, checkpoint_id, task_id, idx) DO UPDATE
+    SET channel = EXCLUDED.channel, type = EXCLUDED.type, blob = EXCLUDED.blob
+"""
+SELECT_CHECKPOINT_SQL = """
+    SELECT checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata FROM graph_checkpoints
+    WHERE thread_id = $1 AND checkpoint_ns = $2 AND ($3::text IS NULL OR checkpoint_id = $3)
+      AND ($4::text IS NULL OR checkpoint_id < $4)
+    ORDER BY checkpoint_id DESC LIMIT $5
+"""
+SELECT_BLOBS_SQL = """
+    SELECT b.channel, b.type, b.blob FROM graph_checkpoint_blobs b
+    JOIN unnest($3::text[], $4::text[]) AS v(channel, version) ON b.channel = v.channel AND b.version = v.version
+    WHERE b.thread_id = $1 AND b.checkpoint_ns = $2
+"""
+SELECT_WRITES_SQL = """
+    SELECT task_id, channel, type, blob FROM graph_checkpoint_writes
+    WHERE thread_id = $1 AND checkpoint_ns = $2 AND checkpoint_id = $3
+    ORDER BY task_id, idx
+"""
+
+class _Thread:
+    """进程内保留的单个会话的最近检查点"""
+    __slots__ = ("checkpoints", "writes")
+
+    def __init__(self):
+        # checkpoint_id -> (checkpoint, metadata, parent_checkpoint_id)，按写入顺序排列
+        self.checkpoints = OrderedDict()
+        # checkpoint_id -> {(task_id, idx): (task_id, channel, value)}
+        self.writes = {}
+
+class PostgresCheckpointer(BaseCheckpointSaver):
+    """
+    基于 PostgresSaver 连接池的 LangGraph 异步检查点
+    1. 压缩快照：检查点本身不含通道值，每个通道的值按 (channel, version) 只在版本变化时写入一次
+    2. 写后缓冲：aput/aput_writes 只做序列化并入队，由后台任务批量落库，不增加节点耗时
+    3. 进程内保留各会话最近的检查点，读取优先命中内存；进程重启后从数据库恢复
+    数据库不可用时退化为纯内存检查点
+    """
+
+    def __init__(self, memory_threads=500, memory_depth=8, batch_size=50, flush_interval=0.2, queue_size=10000):
+        super().__init__()
+        self.memory_threads = memory_threads
+        self.memory_depth = memory_depth
+        self._threads = OrderedDict()
+        self._writes = WriteBehindQueue(self._flush, batch_size, flush_interval, queue_size, unit="批")
+        CHECKPOINT_QUEUE.set_function(self._writes.qsize)
+
+    @staticmethod
+    def _key(config):
+        configurable = config["configurable"]
+        return configurable["thread_id"], configurable.get("checkpoint_ns", "")
+
+    def _thread(self, key, create=False):
+        thread = self._threads.get(key)
+        if thread is not None:
+            self._threads.move_to_end(key)
+        elif create:
+            thread = self._threads[key] = _Thread()
+            while len(self._threads) > self.memory_threads:
+                self._threads.popitem(last=False)
+        return thread
+
+    def start_thread(self, thread_id, checkpoint_ns=""):
+        """登记全新的会话：其检查点必然不在数据库中，首次读取无需查询"""
+        self._thread((thread_id, checkpoint_ns), create=True)
+
+    def forget_thread(self, thread_id, checkpoint_ns=""):
+        """丢弃进程内保留的会话检查点，下次读取从数据库加载"""
+        self._threads.pop((thread_id, checkpoint_ns), None)
+
+    def on_remote_resume(self, message):
+        """其他 worker 从检查点恢复了该会话：本进程内的检查点已过期"""
+        self.forget_thread(message["thread_id"])
+
+    def _enqueue(self, op):
+        try:
+            self._writes.put_nowait(op)
+        except asyncio.QueueFull:
+            # 队列已满说明数据库持续不可写：丢弃本次落库（内存中仍保留），不阻塞图执行
+            CHECKPOINT_DROPPED.inc()
+
+    def _dumps(self, value):
+        return self.serde.dumps_typed(value)
+
+    def _loads(self, type_, blob):
+        return self.serde.loads_typed((type_, blob))
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        thread_id, ns = key = self._key(config)
+        parent_id = config["configurable"].get("checkpoint_id")
+        checkpoint = copy_checkpoint(checkpoint)
+        thread = self._thread(key, create=True)
+        thread.checkpoints[checkpoint["id"]] = (checkpoint, metadata, parent_id)
+        while len(thread.checkpoints) > self.memory_depth:
+            old_id, _ = thread.checkpoints.popitem(last=False)
+            thread.writes.pop(old_id, None)
+
+        # 只序列化本次版本发生变化的通道
+        values = checkpoint["channel_values"]
+        blobs = []
+        for channel, version in new_versions.items():
+            type_, blob = self._dumps(values[channel]) if channel in values else ("empty", None)
+            blobs.append((thread_id, ns, channel, str(version), type_, blob))
+        type_, data = self._dumps({**checkpoint, "channel_values": {}})
+        metadata_type, metadata_blob = self._dumps(metadata)
+        self._enqueue(("checkpoint", (thread_id, ns, checkpoint["id"], parent_id, type_, data, metadata_type, metadata_blob), blobs))
+        return {"configurable": {"thread_id": thread_id, "checkpoint_ns": ns, "checkpoint_id": checkpoint["id"]}}
+
+    async def aput_writes(self, config, writes, task_id, task_path=""):
+        thread_id, ns = key = self._key(config)
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        pending = self._thread(key, create=True).writes.setdefault(checkpoint_id, {})
+        rows = []
+        for idx, (channel, value) in enumerate(writes):
+            idx = WRITES_IDX_MAP.get(channel, idx)
+            # 普通写入以首次为准，特殊通道（错误、中断等）覆盖
+            if idx >= 0 and (task_id, idx) in pending:
+                continue
+            pending[(task_id, idx)] = (task_id, channel, value)
+            rows.append((thread_id, ns, checkpoint_id, task_id, idx, channel, *self._dumps(value)))
+        if rows:
+            self._enqueue(("writes", rows))
+
+    def _memory_tuple(self, key, thread, checkpoint_id):
+        checkpoint_id = checkpoint_id or next(reversed(thread.checkpoints), None)
+        if checkpoint_id not in thread.checkpoints:
+            return None
+        checkpoint, metadata, parent_id = thread.checkpoints[checkpoint_id]
+        return self._tuple(key, checkpoint, metadata, parent_id, list(thread.writes.get(checkpoint_id, {}).values()))
+
+    @staticmethod
+    def _tuple(key, checkpoint, metadata, parent_id, pending_writes):
+        thread_id, ns = key
+        return CheckpointTuple(
+            config={"configurable": {"thread_id": thread_id, "checkpoint_ns": ns, "checkpoint_id": checkpoint["id"]}},
+            checkpoint=checkpoint,
+            metadata=metadata,
+            parent_config={"configurable": {"thread_id": thread_id, "checkpoint_ns": ns, "checkpoint_id": parent_id}} if parent_id else None,
+            pending_writes=pending_writes
+        )
+
+    async def aget_tuple(self, config):
+        key = self._key(config)
+        checkpoint_id = get_checkpoint_id(config)
+        thread = self._thread(key)
+        if thread is not None:
+            found = self._memory_tuple(key, thread, checkpoint_id)
+            # 进程内登记过的会话只在请求更早的检查点时才需要查询数据库
+            if found or not checkpoint_id:
+                return found
+        rows = await self._load(key, checkpoint_id=checkpoint_id, limit=1)
+        if not rows:
+            return None
+        found = rows[0]
+        if not checkpoint_id:
+            # 进程重启后的首次读取：将最新检查点放回内存，后续节点直接命中
+            thread = self._thread(key, create=True)
+            thread.checkpoints[found.checkpoint["id"]] = (found.checkpoint, found.metadata, (found.parent_config or {}).get("configurable", {}).get("checkpoint_id"))
+            thread.writes[found.checkpoint["id"]] = {(w[0], i): w for i, w in enumerate(found.pending_writes)}
+        return found
+
+    async def alist(self, config, *, filter=None, before=None, limit=None):
+        if config is None:
+            return
+        key = self._key(config)
+        before_id = get_checkpoint_id(before) if before else None
+        if pg_saver.pool:
+            tuples = await self._load(key, checkpoint_id=get_checkpoint_id(config), before=before_id, limit=limit or 1000)
+        else:
+            thread = self._thread(key)
+            ids = list(reversed(thread.checkpoints)) if thread else []
+            tuples = [self._memory_tuple(key, thread, i) for i in ids if not before_id or i < before_id]
+        count = 0
+        for item in tuples:
+            if filter and not all(item.metadata.get(k) == v for k, v in filter.items()):
+                continue
+            yield item
+            count += 1
+            if limit and count >= limit:
+                return
+
+    async def _load(self, key, checkpoint_id=None, before=None, limit=1):
+        """从数据库读取检查点，并按 channel_versions 拼回完整的通道值"""
+        if not pg_saver.pool:
+            return []
+        # 先等待已入队的写入落库，保证读到最新的检查点
+        await self.flush()
+        thread_id, ns = key
+        try:
+            async with pg_saver.acquire() as conn, pg_saver.timed("load_checkpoint"):
+                rows = await conn.fetch(SELECT_CHECKPOINT_SQL, thread_id, ns, checkpoint_id, before, limit)
+                result = []
+                for row in rows:
+                    checkpoint = self._loads(row["type"], row["checkpoint"])
+                    versions = checkpoint.get("channel_versions", {})
+                    blobs = await conn.fetch(SELECT_BLOBS_SQL, thread_id, ns, list(versions), [str(v) for v in versions.values()])
+                    checkpoint["channel_values"] = {
+                        b["channel"]: self._loads(b["type"], b["blob"]) for b in blobs if b["type"] != "empty"
+                    }
+                    writes = await conn.fetch(SELECT_WRITES_SQL, thread_id, ns, row["checkpoint_id"])
+                    result.append(self._tuple(
+                        key, checkpoint, self._loads(row["metadata_type"], row["metadata"]), row["parent_checkpoint_id"],
+                        [(w["task_id"], w["channel"], self._loads(w["type"], w["blob"])) for w in writes]
+                    ))
+            return result
+        except Exception as e:
+            log(f"[ERROR] 检查点读取失败 ({thread_id}): {e}", level="ERROR")
+            return []
+
+    async def _flush(self, batch):
+        checkpoints, blobs, writes = [], [], []
+        for op in batch:
+            if op[0] == "checkpoint":
+                checkpoints.append(op[1])
+                blobs.extend(op[2])
+            else:
+                writes.extend(op[1])
+        if not pg_saver.pool:
+            await pg_saver.connect()
+        if not pg_saver.pool:
+            CHECKPOINT_DROPPED.inc(len(batch))
+            return
+        try:
+            async with pg_saver.acquire() as conn, pg_saver.timed("flush_checkpoints"):
+                async with conn.transaction():
+                    # 先写通道值，再写引用它们的检查点
+                    if blobs:
+                        await conn.executemany(INSERT_BLOB_SQL, blobs)
+                    if checkpoints:
+                        await conn.executemany(INSERT_CHECKPOINT_SQL, checkpoints)
+                    if writes:
+                        await conn.executemany(UPSERT_WRITE_SQL, writes)
+        except Exception as e:
+            CHECKPOINT_DROPPED.inc(len(batch))
+            log(f"[ERROR] 检查点写入失败 ({len(batch)} 批): {e}", level="ERROR")
+
+    async def flush(self):
+        """等待已入队的检查点全部落库"""
+        await self._writes.join()
+
+    async def close(self, timeout=None):
+        """停止写入任务并等待队列排空"""
+        await self._writes.close(timeout)
+
+def create_checkpointer():
+    """CHECKPOINT_ENABLED=false 时返回 None（图不保存检查点）"""
+    if os.getenv("CHECKPOINT_ENABLED", "true").lower() != "true":
+        return None
+    return PostgresCheckpointer(
+        memory_threads=int(os.getenv("CHECKPOINT_MEMORY_THREADS", 500)),
+        memory_depth=int(os.getenv("CHECKPOINT_MEMORY_DEPTH", 8)),
+        batch_size=int(os.getenv("CHECKPOINT_WRITE_BATCH_SIZE", 50)),
+        flush_interval=float(os.getenv("CHECKPOINT_FLUSH_MS", 200)) / 1000
+    )
+
+# 全局单例
+checkpointer = create_checkpointer()
+if checkpointer:
+    pg_bus.subscribe(CHECKPOINT_CHANNEL, checkpointer.on_remote_resume)
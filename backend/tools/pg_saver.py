@@ -1,101 +1,371 @@
 import os
+import json
+import time
+import asyncio
 import asyncpg
-from datetime import datetime
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 from .logger import log
+from .metrics import registry
+from .write_behind import WriteBehindQueue
 
 load_dotenv()
 
+# 迭代记录写入的列顺序
+ITERATION_COLUMNS = ["session_id", "iteration_count", "user_intent", "improved_prompt", "critique"]
+
+# 以旧版 prompt_history 的字段形态还原每个步骤：未变化的字段沿用此前最近一次的值
+HISTORY_VIEW_SQL = """
+    CREATE OR REPLACE VIEW prompt_history AS
+    SELECT
+        i.id,
+        i.session_id,
+        s.original_prompt,
+        COALESCE(i.user_intent, (
+            SELECT p.user_intent FROM prompt_iterations p
+            WHERE p.session_id = i.session_id AND p.iteration_count < i.iteration_count AND p.user_intent IS NOT NULL
+            ORDER BY p.iteration_count DESC LIMIT 1
+        )) AS user_intent,
+        COALESCE(i.improved_prompt, (
+            SELECT p.improved_prompt FROM prompt_iterations p
+            WHERE p.session_id = i.session_id AND p.iteration_count < i.iteration_count AND p.improved_prompt IS NOT NULL
+            ORDER BY p.iteration_count DESC LIMIT 1
+        )) AS improved_prompt,
+        i.critique,
+        i.iteration_count,
+        i.created_at
+    FROM prompt_iterations i
+    JOIN prompt_sessions s ON s.session_id = i.session_id;
+"""
+
+# 表结构 DDL：每个进程仅在首次建立连接池时执行一次，重连时不再重复执行
+SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS prompt_sessions (
+        session_id VARCHAR(50) PRIMARY KEY,
+        original_prompt TEXT NOT NULL,
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+    );
+    COMMENT ON TABLE prompt_sessions IS '提示词优化会话表（每个会话一行）';
+    COMMENT ON COLUMN prompt_sessions.session_id IS '会话唯一标识';
+    COMMENT ON COLUMN prompt_sessions.original_prompt IS '用户输入的原始提示词';
+    COMMENT ON COLUMN prompt_sessions.created_at IS '创建时间';
+
+    CREATE TABLE IF NOT EXISTS prompt_iterations (
+        id SERIAL PRIMARY KEY,
+        session_id VARCHAR(50) NOT NULL,
+        iteration_count INTEGER DEFAULT 0,
+        user_intent TEXT,
+        improved_prompt TEXT,
+        critique TEXT,
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_iterations_session ON prompt_iterations(session_id, iteration_count);
+    -- 降低 TOAST 阈值，使中等长度的提示词文本也会被压缩存储
+    ALTER TABLE prompt_iterations SET (toast_tuple_target = 256);
+    COMMENT ON TABLE prompt_iterations IS '提示词优化迭代表（仅记录本步骤产生变化的字段）';
+    COMMENT ON COLUMN prompt_iterations.session_id IS '会话唯一标识';
+    COMMENT ON COLUMN prompt_iterations.iteration_count IS '优化迭代轮次';
+    COMMENT ON COLUMN prompt_iterations.user_intent IS '意图分析结果（仅 Analyzer 步骤）';
+    COMMENT ON COLUMN prompt_iterations.improved_prompt IS '优化后的提示词（仅 Generator 步骤）';
+    COMMENT ON COLUMN prompt_iterations.critique IS '评审反馈意见（仅 Reflector 步骤）';
+    COMMENT ON COLUMN prompt_iterations.created_at IS '创建时间';
+
+    -- PostgreSQL 14+ 使用 lz4 压缩大文本，速度明显快于默认的 pglz
+    DO $$
+    BEGIN
+        IF current_setting('server_version_num')::int >= 140000 THEN
+            ALTER TABLE prompt_sessions ALTER COLUMN original_prompt SET COMPRESSION lz4;
+            ALTER TABLE prompt_iterations ALTER COLUMN user_intent SET COMPRESSION lz4;
+            ALTER TABLE prompt_iterations ALTER COLUMN improved_prompt SET COMPRESSION lz4;
+            ALTER TABLE prompt_iterations ALTER COLUMN critique SET COMPRESSION lz4;
+        END IF;
+    END $$;
+
+    CREATE TABLE IF NOT EXISTS optimization_cache (
+        session_id VARCHAR(50) PRIMARY KEY,
+        prompt_hash CHAR(64) NOT NULL,
+        original_prompt TEXT NOT NULL,
+        embedding REAL[] NOT NULL,
+        events JSONB NOT NULL,
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_cache_prompt_hash ON optimization_cache(prompt_hash);
+    CREATE INDEX IF NOT EXISTS idx_cache_created_at ON optimization_cache(created_at);
+    COMMENT ON TABLE optimization_cache IS '优化结果语义缓存（持久层）';
+    COMMENT ON COLUMN optimization_cache.session_id IS '产生该结果的会话标识';
+    COMMENT ON COLUMN optimization_cache.prompt_hash IS '归一化原始提示词的 SHA-256';
+    COMMENT ON COLUMN optimization_cache.original_prompt IS '用户输入的原始提示词';
+    COMMENT ON COLUMN optimization_cache.embedding IS '原始提示词的归一化向量';
+    COMMENT ON COLUMN optimization_cache.events IS '可回放的 SSE 事件序列';
+    COMMENT ON COLUMN optimization_cache.created_at IS '创建时间';
+
+    CREATE TABLE IF NOT EXISTS user_prompts (
+        id SERIAL PRIMARY KEY,
+        session_id VARCHAR(50),
+        title VARCHAR(255) NOT NULL,
+        content TEXT NOT NULL,
+        tags VARCHAR(255),
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+    );
+    COMMENT ON TABLE user_prompts IS '用户收藏的提示词库';
+    COMMENT ON COLUMN user_prompts.session_id IS '产生该提示词的会话标识';
+    COMMENT ON COLUMN user_prompts.title IS '提示词标题';
+    COMMENT ON COLUMN user_prompts.content IS '提示词正文内容';
+    COMMENT ON COLUMN user_prompts.tags IS '标签(逗号分隔)';
+
+    CREATE TABLE IF NOT EXISTS session_events (
+        session_id VARCHAR(50) NOT NULL,
+        event_id INTEGER NOT NULL,
+        frame TEXT NOT NULL,
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (session_id, event_id)
+    );
+    COMMENT ON TABLE session_events IS '会话 SSE 事件日志（供断线重连回放）';
+    COMMENT ON COLUMN session_events.session_id IS '会话唯一标识';
+    COMMENT ON COLUMN session_events.event_id IS '会话内单调递增的事件 ID';
+    COMMENT ON COLUMN session_events.frame IS '已编码的 SSE 帧';
+    COMMENT ON COLUMN session_events.created_at IS '创建时间';
+
+    CREATE TABLE IF NOT EXISTS session_leases (
+        session_id VARCHAR(50) PRIMARY KEY,
+        owner VARCHAR(100) NOT NULL,
+        expires_at TIMESTAMP WITH TIME ZONE NOT NULL
+    );
+    COMMENT ON TABLE session_leases IS '执行中会话的租约（共享模式下由执行方定期续期）';
+    COMMENT ON COLUMN session_leases.session_id IS '会话唯一标识';
+    COMMENT ON COLUMN session_leases.owner IS '执行该会话的 worker (node_id)';
+    COMMENT ON COLUMN session_leases.expires_at IS '租约到期时间，到期未续期视为执行方已退出';
+
+    CREATE TABLE IF NOT EXISTS graph_checkpoints (
+        thread_id VARCHAR(50) NOT NULL,
+        checkpoint_ns VARCHAR(255) NOT NULL DEFAULT '',
+        checkpoint_id VARCHAR(64) NOT NULL,
+        parent_checkpoint_id VARCHAR(64),
+        type VARCHAR(32) NOT NULL,
+        checkpoint BYTEA NOT NULL,
+        metadata_type VARCHAR(32) NOT NULL,
+        metadata BYTEA NOT NULL,
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id)
+    );
+    COMMENT ON TABLE graph_checkpoints IS 'LangGraph 检查点（不含通道值，通道值见 graph_checkpoint_blobs）';
+    COMMENT ON COLUMN graph_checkpoints.thread_id IS '会话唯一标识';
+    COMMENT ON COLUMN graph_checkpoints.checkpoint_id IS '检查点 ID（按时间有序）';
+    COMMENT ON COLUMN graph_checkpoints.parent_checkpoint_id IS '上一个检查点 ID';
+
+    CREATE TABLE IF NOT EXISTS graph_checkpoint_blobs (
+        thread_id VARCHAR(50) NOT NULL,
+        checkpoint_ns VARCHAR(255) NOT NULL DEFAULT '',
+        channel VARCHAR(255) NOT NULL,
+        version VARCHAR(64) NOT NULL,
+        type VARCHAR(32) NOT NULL,
+        blob BYTEA,
+        PRIMARY KEY (thread_id, checkpoint_ns, channel, version)
+    );
+    COMMENT ON TABLE graph_checkpoint_blobs IS 'LangGraph 通道值（每个通道仅在版本变化时写入一次）';
+
+    CREATE TABLE IF NOT EXISTS graph_checkpoint_writes (
+        thread_id VARCHAR(50) NOT NULL,
+        checkpoint_ns VARCHAR(255) NOT NULL DEFAULT '',
+        checkpoint_id VARCHAR(64) NOT NULL,
+        task_id VARCHAR(64) NOT NULL,
+        idx INTEGER NOT NULL,
+        channel VARCHAR(255) NOT NULL,
+        type VARCHAR(32),
+        blob BYTEA,
+        PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+    );
+    COMMENT ON TABLE graph_checkpoint_writes IS 'LangGraph 节点的待应用写入（节点中途失败时用于恢复）';
+"""
+
+# 热点写入语句：固定 SQL 文本由 asyncpg 以服务端预编译语句（prepared statement）缓存在每个连接上复用
+INSERT_SESSION_SQL = """
+    INSERT INTO prompt_sessions (session_id, original_prompt)
+    VALUES ($1, $2) ON CONFLICT (session_id) DO NOTHING
+"""
+INSERT_CACHE_SQL = """
+    INSERT INTO optimization_cache (session_id, prompt_hash, original_prompt, embedding, events)
+    VALUES ($1, $2, $3, $4, $5::jsonb) ON CONFLICT (session_id) DO NOTHING
+"""
+INSERT_LIBRARY_SQL = """
+    INSERT INTO user_prompts (title, content, session_id, tags)
+    VALUES ($1, $2, $3, $4)
+"""
+# 租约由原持有者续期，或在到期后被其他 worker 接管；RETURNING 只返回本次成功持有的会话
+RENEW_LEASES_SQL = """
+    INSERT INTO session_leases (session_id, owner, expires_at)
+    SELECT session_id, $2::text, now() + make_interval(secs => $3::float8) FROM unnest($1::text[]) AS s(session_id)
+    ON CONFLICT (session_id) DO UPDATE SET owner = EXCLUDED.owner, expires_at = EXCLUDED.expires_at
+    WHERE session_leases.owner = EXCLUDED.owner OR session_leases.expires_at <= now()
+    RETURNING session_id
+"""
+LEASE_HELD_ELSEWHERE_SQL = """
+    SELECT session_id FROM session_leases
+    WHERE session_id = ANY($1::text[]) AND owner IS DISTINCT FROM $2::text AND expires_at > now()
+"""
+
+# 连接池与查询指标
+DB_ACQUIRE_SECONDS = registry.histogram("pg_pool_acquire_seconds", "等待获取数据库连接的耗时")
+DB_ACQUIRE_FAILURES = registry.counter("pg_pool_acquire_failures_total", "获取数据库连接失败次数")
+DB_QUERY_SECONDS = registry.histogram("pg_query_seconds", "数据库语句执行耗时", ("query",))
+DB_QUERY_FAILURES = registry.counter("pg_query_failures_total", "数据库语句执行失败次数", ("query",))
+DB_POOL_SIZE = registry.gauge("pg_pool_size", "连接池当前连接数", ("state",))
+DB_WRITE_QUEUE = registry.gauge("pg_write_queue_depth", "待写入的步骤记录数")
+
+def _to_string(content):
+    """转换内容为字符串（处理 Gemini 返回的列表格式）"""
+    if content is None:
+        return None
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        # 如果是列表，提取 text 字段
+        texts = []
+        for item in content:
+            if isinstance(item, dict) and 'text' in item:
+                texts.append(item['text'])
+            else:
+                texts.append(str(item))
+        return ''.join(texts)
+    return str(content)
+
 class PostgresSaver:
     def __init__(self):
         self.dsn = os.getenv("POSTGRES_URL")
         self.pool = None
 
+        # 写后缓冲（write-behind）：步骤记录先入队，由后台任务按批量/时间窗批量写入
+        # 队列有界：数据库持续不可写时，入队会等待（背压），避免内存无限增长
+        self._writes = WriteBehindQueue(
+            self._flush,
+            batch_size=int(os.getenv("PG_WRITE_BATCH_SIZE", 50)),
+            flush_interval=float(os.getenv("PG_WRITE_FLUSH_MS", 200)) / 1000,
+            maxsize=int(os.getenv("PG_WRITE_QUEUE_SIZE", 10000))
+        )
+
+        # 连接池获取超时与失败后的重连冷却时间（秒）
+        self.acquire_timeout = float(os.getenv("PG_POOL_ACQUIRE_TIMEOUT", 10))
+        self.reconnect_interval = float(os.getenv("PG_RECONNECT_INTERVAL", 5))
+        self._retry_at = 0.0
+        self._schema_ready = False
+        self._connect_lock = asyncio.Lock()
+
     async def connect(self):
-        if not self.pool:
-            if not self.dsn:
-                log("[ERROR] POSTGRES_URL 未在 .env 中配置", level="ERROR")
+        if self.pool:
+            return
+        # 后台预热与首个请求可能同时触发连接，串行化避免重复建池
+        async with self._connect_lock:
+            await self._connect()
+
+    async def _connect(self):
+        if self.pool:
+            return
+        if not self.dsn:
+            log("[ERROR] POSTGRES_URL 未在 .env 中配置", level="ERROR")
+            return
+        # 连接失败后进入冷却期，避免每个步骤都在关键路径上重试
+        if time.monotonic() < self._retry_at:
+            return
+
+        try:
+            self.pool = await asyncpg.create_pool(
+                dsn=self.dsn,
+                min_size=int(os.getenv("PG_POOL_MIN_SIZE", 2)),
+                max_size=int(os.getenv("PG_POOL_MAX_SIZE", 10)),
+                max_inactive_connection_lifetime=float(os.getenv("PG_POOL_MAX_INACTIVE_LIFETIME", 300)),
+                command_timeout=float(os.getenv("PG_COMMAND_TIMEOUT", 30)),
+                # 语句缓存即每个连接上的服务端预编译语句；经 PgBouncer 事务模式连接时需设为 0
+                statement_cache_size=int(os.getenv("PG_STATEMENT_CACHE_SIZE", 100)),
+                max_cached_statement_lifetime=int(os.getenv("PG_STATEMENT_CACHE_LIFETIME", 0))
+            )
+            DB_POOL_SIZE.set_function(lambda: self.pool.get_size() if self.pool else 0, state="total")
+            DB_POOL_SIZE.set_function(lambda: self.pool.get_idle_size() if self.pool else 0, state="idle")
+            DB_WRITE_QUEUE.set_function(self._writes.qsize)
+
+            if self._schema_ready:
+                log("[DB] 数据库连接池已重建✓")
                 return
-            
-            try:
-                self.pool = await asyncpg.create_pool(dsn=self.dsn)
-                # 初始化表结构
-                async with self.pool.acquire() as conn:
-                    await conn.execute("""
-                        CREATE TABLE IF NOT EXISTS prompt_history (
-                            id SERIAL PRIMARY KEY,
-                            session_id VARCHAR(50) NOT NULL,
-                            original_prompt TEXT NOT NULL,
-                            user_intent TEXT,
-                            improved_prompt TEXT,
-                            critique TEXT,
-                            iteration_count INTEGER DEFAULT 0,
-                            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-                        );
-                        CREATE INDEX IF NOT EXISTS idx_session_id ON prompt_history(session_id);
-                                        
-                        COMMENT ON TABLE prompt_history IS '提示词优化历史记录表';
-                        COMMENT ON COLUMN prompt_history.session_id IS '会话唯一标识';
-                        COMMENT ON COLUMN prompt_history.original_prompt IS '用户输入的原始提示词';
-                        COMMENT ON COLUMN prompt_history.user_intent IS '意图分析结果';
-                        COMMENT ON COLUMN prompt_history.improved_prompt IS '优化后的提示词';
-                        COMMENT ON COLUMN prompt_history.critique IS '评审反馈意见';
-                        COMMENT ON COLUMN prompt_history.iteration_count IS '优化迭代轮次';
-                        COMMENT ON COLUMN prompt_history.created_at IS '创建时间';
-
-                        CREATE TABLE IF NOT EXISTS user_prompts (
-                            id SERIAL PRIMARY KEY,
-                            session_id VARCHAR(50),
-                            title VARCHAR(255) NOT NULL,
-                            content TEXT NOT NULL,
-                            tags VARCHAR(255),
-                            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-                        );
-                        COMMENT ON TABLE user_prompts IS '用户收藏的提示词库';
-                        COMMENT ON COLUMN user_prompts.session_id IS '产生该提示词的会话标识';
-                        COMMENT ON COLUMN user_prompts.title IS '提示词标题';
-                        COMMENT ON COLUMN user_prompts.content IS '提示词正文内容';
-                        COMMENT ON COLUMN user_prompts.tags IS '标签(逗号分隔)';
-                    """)
-                log("[DB] 数据库连接池已初始化，表结构检查完成✓")
-            except Exception as e:
-                log(f"[ERROR] 数据库连接失败: {e}", level="ERROR")
-                self.pool = None
-
-    async def save_step(self, session_id, original_prompt, user_intent=None, improved_prompt=None, critique=None, iteration_count=0):
+            # 初始化表结构
+            async with self.acquire() as conn:
+                await conn.execute(SCHEMA_SQL)
+                await self._ensure_history_view(conn)
+            self._schema_ready = True
+            log("[DB] 数据库连接池已初始化，表结构检查完成✓")
+        except Exception as e:
+            log(f"[ERROR] 数据库连接失败: {e}", level="ERROR")
+            if self.pool:
+                self.pool.terminate()
+            self.pool = None
+            self._retry_at = time.monotonic() + self.reconnect_interval
+
+    @asynccontextmanager
+    async def acquire(self):
+        """从连接池获取连接，并记录等待耗时与失败次数"""
+        start = time.perf_counter()
+        try:
+            conn = await self.pool.acquire(timeout=self.acquire_timeout)
+        except Exception:
+            DB_ACQUIRE_FAILURES.inc()
+            raise
+        DB_ACQUIRE_SECONDS.observe(time.perf_counter() - start)
+        try:
+            yield conn
+        finally:
+            await self.pool.release(conn)
+
+    @asynccontextmanager
+    async def timed(self, query):
+        """记录语句执行耗时"""
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            DB_QUERY_FAILURES.inc(query=query)
+            raise
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - start, query=query)
+
+    async def _ensure_history_view(self, conn):
+        """创建兼容旧表结构的 prompt_history 视图；旧版 prompt_history 表仍存在时提示执行迁移"""
+        legacy = await conn.fetchval("""
+            SELECT 1 FROM information_schema.tables
+            WHERE table_schema = current_schema() AND table_name = 'prompt_history' AND table_type = 'BASE TABLE'
+        """)
+        if legacy:
+            log("[DB] 检测到旧版 prompt_history 表，请执行 migrations/001_delta_history.sql 完成迁移", level="WARNING")
+            return
+        await conn.execute(HISTORY_VIEW_SQL)
+
+    async def save_step(self, session_id, original_prompt=None, user_intent=None, improved_prompt=None, critique=None, iteration_count=0):
+        """
+        记录入队后立即返回，节点耗时不再受数据库往返影响
+        仅需传入本步骤产生变化的字段；original_prompt 只在会话首个步骤传入
+        """
         if not self.pool:
             await self.connect()
-        
+
         if not self.pool:
             return
 
-        # 转换内容为字符串（处理 Gemini 返回的列表格式）
-        def _to_string(content):
-            if content is None:
-                return None
-            if isinstance(content, str):
-                return content
-            if isinstance(content, list):
-                # 如果是列表，提取 text 字段
-                texts = []
-                for item in content:
-                    if isinstance(item, dict) and 'text' in item:
-                        texts.append(item['text'])
-                    else:
-                        texts.append(str(item))
-                return ''.join(texts)
-            return str(content)
-        
-        try:
-            async with self.pool.acquire() as conn:
-                await conn.execute("""
-                    INSERT INTO prompt_history 
-                    (session_id, original_prompt, user_intent, improved_prompt, critique, iteration_count)
-                    VALUES ($1, $2, $3, $4, $5, $6)
-                """, session_id, original_prompt, _to_string(user_intent), _to_string(improved_prompt), _to_string(critique), iteration_count)
-                log(f"[DB] 记录已保存 (Session: {session_id})")
+        record = (session_id, iteration_count, _to_string(user_intent), _to_string(improved_prompt), _to_string(critique))
+        await self._writes.put((original_prompt, record))
+
+    async def _flush(self, batch):
+        sessions = [(record[0], original_prompt) for original_prompt, record in batch if original_prompt is not None]
+        iterations = [record for _, record in batch]
+        try:
+            async with self.acquire() as conn, self.timed("flush_steps"):
+                async with conn.transaction():
+                    if sessions:
+                        await conn.executemany(INSERT_SESSION_SQL, sessions)
+                    await conn.copy_records_to_table("prompt_iterations", records=iterations, columns=ITERATION_COLUMNS)
+            log(f"[DB] 批量写入 {len(batch)} 条记录 (Sessions: {', '.join(sorted({r[0] for r in iterations}))})")
         except Exception as e:
-            log(f"[ERROR] 记录保存失败: {e}", level="ERROR")
+            log(f"[ERROR] 记录保存失败 ({len(batch)} 条): {e}", level="ERROR")
+
+    async def drain(self, timeout=None):
+        """停止写入任务并等待队列中的记录全部落库"""
+        await self._writes.close(timeout)
 
     async def save_to_library(self, title, content, session_id=None, tags=""):
         if not self.pool:
@@ -103,20 +373,193 @@ class PostgresSaver:
         if not self.pool:
             return False
         try:
-            async with self.pool.acquire() as conn:
-                await conn.execute("""
-                    INSERT INTO user_prompts (title, content, session_id, tags)
-                    VALUES ($1, $2, $3, $4)
-                """, title, content, session_id, tags)
+            async with self.acquire() as conn, self.timed("save_to_library"):
+                await conn.execute(INSERT_LIBRARY_SQL, title, content, session_id, tags)
                 log(f"[DB] 提示词已存入个人库: {title} (Session: {session_id})")
                 return True
         except Exception as e:
             log(f"[ERROR] 存入个人库失败: {e}", level="ERROR")
             return False
 
+    async def save_cached_result(self, session_id, prompt_hash, original_prompt, embedding, events):
+        """写入优化结果缓存（持久层），返回是否写入成功"""
+        if not self.pool:
+            return False
+        try:
+            async with self.acquire() as conn, self.timed("save_cached_result"):
+                await conn.execute(INSERT_CACHE_SQL, session_id, prompt_hash, original_prompt, embedding, json.dumps(events, ensure_ascii=False))
+            return True
+        except Exception as e:
+            log(f"[ERROR] 结果缓存写入失败: {e}", level="ERROR")
+            return False
+
+    async def load_cached_results(self, limit, ttl):
+        """加载 TTL 内最近的缓存结果，用于启动时预热内存层"""
+        if not self.pool:
+            return []
+        try:
+            async with self.acquire() as conn, self.timed("load_cached_results"):
+                rows = await conn.fetch("""
+                    SELECT session_id, original_prompt, embedding, events, EXTRACT(EPOCH FROM created_at)::float8 AS created_at FROM optimization_cache
+                    WHERE created_at > now() - make_interval(secs => $1)
+                    ORDER BY created_at DESC LIMIT $2
+                """, ttl, limit)
+            return [dict(row, events=json.loads(row["events"])) for row in rows]
+        except Exception as e:
+            log(f"[ERROR] 结果缓存加载失败: {e}", level="ERROR")
+            return []
+
+    async def find_cached_result(self, prompt_hash, ttl):
+        """按归一化提示词哈希精确查找缓存结果（内存层未命中时的兜底）"""
+        if not self.pool:
+            return None
+        try:
+            async with self.acquire() as conn, self.timed("find_cached_result"):
+                row = await conn.fetchrow("""
+                    SELECT session_id, original_prompt, embedding, events, EXTRACT(EPOCH FROM created_at)::float8 AS created_at FROM optimization_cache
+                    WHERE prompt_hash = $1 AND created_at > now() - make_interval(secs => $2)
+                    ORDER BY created_at DESC LIMIT 1
+                """, prompt_hash, ttl)
+            return dict(row, events=json.loads(row["events"])) if row else None
+        except Exception as e:
+            log(f"[ERROR] 结果缓存查询失败: {e}", level="ERROR")
+            return None
+
+    async def get_cached_result(self, session_id):
+        """按会话标识读取缓存结果（其他实例写入后通知本实例加载）"""
+        if not self.pool:
+            return None
+        try:
+            async with self.acquire() as conn, self.timed("get_cached_result"):
+                row = await conn.fetchrow("""
+                    SELECT session_id, original_prompt, embedding, events, EXTRACT(EPOCH FROM created_at)::float8 AS created_at FROM optimization_cache
+                    WHERE session_id = $1
+                """, session_id)
+            return dict(row, events=json.loads(row["events"])) if row else None
+        except Exception as e:
+            log(f"[ERROR] 结果缓存查询失败: {e}", level="ERROR")
+            return None
+
+    async def save_session_events(self, session_id, events):
+        """
+        会话结束后一次性写入缓冲的 SSE 事件 [(事件 ID, 帧字节)]
+        从检查点恢复的会话沿用原 session_id 且事件 ID 重新从 1 开始，同一事务内先清除此前执行写入的事件
+        """
+        if not self.pool:
+            return
+        try:
+            records = [(session_id, event_id, chunk.decode("utf-8")) for event_id, chunk in events]
+            async with self.acquire() as conn, self.timed("save_session_events"):
+                async with conn.transaction():
+                    await conn.execute("DELETE FROM session_events WHERE session_id = $1", session_id)
+                    await conn.copy_records_to_table("session_events", records=records, columns=["session_id", "event_id", "frame"])
+        except Exception as e:
+            log(f"[ERROR] 会话事件写入失败: {e}", level="ERROR")
+
+    async def append_session_events(self, records, owner=None):
+        """
+        增量写入会话事件 [(session_id, 事件 ID, 帧文本)]（多 worker 共享会话时使用）
+        从检查点恢复的会话沿用原 session_id 且事件 ID 重新从 1 开始，写入首个事件前先清除旧事件；
+        会话租约仍由其他 worker 持有时不清除（其事件仍在写入），该会话的本批事件被丢弃
+        """
+        if not self.pool:
+            return False
+        restarted = [session_id for session_id, event_id, _ in records if event_id == 1]
+        try:
+            async with self.acquire() as conn, self.timed("append_session_events"):
+                async with conn.transaction():
+                    if restarted:
+                        held = {row["session_id"] for row in await conn.fetch(LEASE_HELD_ELSEWHERE_SQL, restarted, owner)}
+                        if held:
+                            log(f"[DB] 会话租约由其他 worker 持有，未覆盖其事件: {', '.join(sorted(held))}", level="WARNING")
+                            records = [record for record in records if record[0] not in held]
+                            restarted = [session_id for session_id in restarted if session_id not in held]
+                        if restarted:
+                            await conn.execute("DELETE FROM session_events WHERE session_id = ANY($1::text[])", restarted)
+                    if records:
+                        await conn.copy_records_to_table("session_events", records=records, columns=["session_id", "event_id", "frame"])
+            return True
+        except Exception as e:
+            log(f"[ERROR] 会话事件写入失败 ({len(records)} 条): {e}", level="ERROR")
+            return False
+
+    async def fetch_session_events(self, session_id, after_id=0):
+        """读取事件 ID 大于 after_id 的已持久化事件 [(事件 ID, 帧文本)]"""
+        if not self.pool:
+            return []
+        try:
+            async with self.acquire() as conn, self.timed("fetch_session_events"):
+                rows = await conn.fetch(
+                    "SELECT event_id, frame FROM session_events WHERE session_id = $1 AND event_id > $2 ORDER BY event_id",
+                    session_id, after_id
+                )
+            return [(row["event_id"], row["frame"]) for row in rows]
+        except Exception as e:
+            log(f"[ERROR] 会话事件读取失败: {e}", level="ERROR")
+            return []
+
+    async def session_event_state(self, session_id):
+        """会话最后一个事件的帧文本，无事件时返回 None"""
+        if not self.pool:
+            return None
+        try:
+            async with self.acquire() as conn, self.timed("session_event_state"):
+                return await conn.fetchval(
+                    "SELECT frame FROM session_events WHERE session_id = $1 ORDER BY event_id DESC LIMIT 1", session_id
+                )
+        except Exception as e:
+            log(f"[ERROR] 会话事件读取失败: {e}", level="ERROR")
+            return None
+
+    async def renew_session_leases(self, session_ids, owner, ttl):
+        """
+        获取或续期会话租约，返回本次由 owner 持有的 session_id 集合；数据库不可用时返回 None
+        租约已由其他 owner 持有且未到期的会话不会被抢占
+        """
+        if not self.pool:
+            await self.connect()
+        if not self.pool:
+            return None
+        try:
+            async with self.acquire() as conn, self.timed("renew_session_leases"):
+                rows = await conn.fetch(RENEW_LEASES_SQL, list(session_ids), owner, ttl)
+            return {row["session_id"] for row in rows}
+        except Exception as e:
+            log(f"[ERROR] 会话租约续期失败: {e}", level="ERROR")
+            return None
+
+    async def release_session_leases(self, session_ids, owner):
+        """释放 owner 持有的会话租约，并顺带清理已到期的租约"""
+        if not self.pool:
+            return
+        try:
+            async with self.acquire() as conn, self.timed("release_session_leases"):
+                await conn.execute(
+                    "DELETE FROM session_leases WHERE (session_id = ANY($1::text[]) AND owner = $2) OR expires_at < now()",
+                    list(session_ids), owner
+                )
+        except Exception as e:
+            log(f"[ERROR] 会话租约释放失败: {e}", level="ERROR")
+
+    async def session_lease_held(self, session_id):
+        """会话租约是否仍在有效期内（即仍有 worker 在执行该会话）"""
+        if not self.pool:
+            return False
+        try:
+            async with self.acquire() as conn, self.timed("session_lease_held"):
+                return bool(await conn.fetchval(
+                    "SELECT 1 FROM session_leases WHERE session_id = $1 AND expires_at > now()", session_id
+                ))
+        except Exception as e:
+            log(f"[ERROR] 会话租约读取失败: {e}", level="ERROR")
+            return False
+
     async def close(self):
+        # 先排空写入队列，再关闭连接池
+        await self.drain(timeout=float(os.getenv("PG_DRAIN_TIMEOUT", 30)))
         if self.pool:
             await self.pool.close()
+            self.pool = None
 
 # 全局单例
 pg_saver = PostgresSaver()
@@ -0,0 +1,89 @@
+import os
+import numpy as np
+from .logger import log
+
+def get_faiss():
+    """faiss 导入耗时较长，延迟到首次构建/加载索引时才导入"""
+    import faiss
+    return faiss
+
+# 支持的索引类型：flat 精确检索；ivf / hnsw 近似检索；ivfpq 以乘积量化压缩内存
+INDEX_TYPES = ("flat", "ivf", "hnsw", "ivfpq")
+
+def index_params_from_env():
+    """从环境变量读取索引类型与召回/延迟调优参数"""
+    return {
+        "index_type": os.getenv("RAG_INDEX_TYPE", "flat").lower(),
+        "nlist": int(os.getenv("RAG_IVF_NLIST", 1024)),
+        "nprobe": int(os.getenv("RAG_IVF_NPROBE", 16)),
+        "hnsw_m": int(os.getenv("RAG_HNSW_M", 32)),
+        "ef_construction": int(os.getenv("RAG_HNSW_EF_CONSTRUCTION", 200)),
+        "ef_search": int(os.getenv("RAG_HNSW_EF_SEARCH", 64)),
+        "pq_m": int(os.getenv("RAG_PQ_M", 48)),
+        "pq_nbits": int(os.getenv("RAG_PQ_NBITS", 8))
+    }
+
+def normalize(vectors):
+    """L2 归一化，使内积等价于余弦相似度"""
+    faiss = get_faiss()
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    faiss.normalize_L2(vectors)
+    return vectors
+
+def create_index(embeddings, index_type="flat", **params):
+    """
+    按类型构建内积索引（输入向量需已归一化）
+    :param embeddings: 归一化后的向量矩阵 (n, d)
+    :param index_type: flat / ivf / hnsw / ivfpq
+    """
+    faiss = get_faiss()
+    n, dimension = embeddings.shape
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"不支持的索引类型: {index_type}，可选: {', '.join(INDEX_TYPES)}")
+
+    # IVF 聚类中心数不能超过样本量（FAISS 建议每个中心至少 39 个训练样本）
+    nlist = max(1, min(params.get("nlist", 1024), n // 39))
+    if index_type == "ivfpq" and n < 2 ** params.get("pq_nbits", 8) * 39:
+        log(f"[RAG] 模板数量 ({n}) 不足以训练 PQ 码本，回退为 ivf 索引", level="WARNING")
+        index_type = "ivf"
+    if index_type in ("ivf", "ivfpq") and n // 39 < 2:
+        # 样本过少时聚类没有意义，直接使用精确检索
+        index_type = "flat"
+
+    if index_type == "flat":
+        index = faiss.IndexFlatIP(dimension)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dimension, params.get("hnsw_m", 32), faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = params.get("ef_construction", 200)
+    else:
+        quantizer = faiss.IndexFlatIP(dimension)
+        if index_type == "ivf":
+            index = faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss.METRIC_INNER_PRODUCT)
+        else:
+            pq_m = params.get("pq_m", 48)
+            if dimension % pq_m != 0:
+                raise ValueError(f"向量维度 {dimension} 必须能被 RAG_PQ_M={pq_m} 整除")
+            index = faiss.IndexIVFPQ(quantizer, dimension, nlist, pq_m, params.get("pq_nbits", 8), faiss.METRIC_INNER_PRODUCT)
+        index.train(embeddings)
+
+    index.add(embeddings)
+    apply_search_params(index, **params)
+    return index
+
+def apply_search_params(index, **params):
+    """设置检索期参数（nprobe / efSearch），这些参数不会随索引持久化"""
+    faiss = get_faiss()
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = min(params.get("nprobe", 16), ivf.nlist)
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = params.get("ef_search", 64)
+    return index
+
+def read_index(path):
+    """优先以内存映射方式读取索引，不支持映射的索引类型回退为普通读取"""
+    faiss = get_faiss()
+    try:
+        return faiss.read_index(path, faiss.IO_FLAG_MMAP)
+    except RuntimeError:
+        return faiss.read_index(path)
@@ -0,0 +1,52 @@
+import math
+import re
+import unicodedata
+from collections import Counter, defaultdict
+
+_ASCII_WORD = re.compile(r"[a-z0-9]+")
+_CJK_RUN = re.compile(r"[^\sa-z0-9\W_]+")
+
+def tokenize(text):
+    """分词：英文/数字按单词切分，中文按字符 unigram + bigram 切分（无需外部分词器）"""
+    text = unicodedata.normalize("NFKC", str(text or "")).lower()
+    tokens = _ASCII_WORD.findall(text)
+    for run in _CJK_RUN.findall(text):
+        tokens.extend(run)
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+class BM25Index:
+    """基于字符 n-gram 的轻量 BM25 倒排索引"""
+
+    def __init__(self, documents, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = defaultdict(list)
+        self.doc_lengths = []
+        for doc_id, doc in enumerate(documents):
+            counts = Counter(tokenize(doc))
+            self.doc_lengths.append(sum(counts.values()))
+            for term, tf in counts.items():
+                self.postings[term].append((doc_id, tf))
+        total = len(self.doc_lengths)
+        self.avgdl = sum(self.doc_lengths) / total if total else 0.0
+        self.idf = {
+            term: math.log(1 + (total - len(plist) + 0.5) / (len(plist) + 0.5))
+            for term, plist in self.postings.items()
+        }
+
+    def max_score(self, query):
+        """查询的理论得分上界（所有词项 tf 趋于无穷时），用于把 BM25 分数归一化到 [0, 1]"""
+        return sum(self.idf.get(term, 0.0) for term in set(tokenize(query))) * (self.k1 + 1)
+
+    def search(self, query, top_k=10):
+        """返回 [(文档下标, BM25 分数)]，按分数降序"""
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for doc_id, tf in self.postings[term]:
+                norm = 1 - self.b + self.b * self.doc_lengths[doc_id] / (self.avgdl or 1)
+                scores[doc_id] += idf * tf * (self.k1 + 1) / (tf + self.k1 * norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
@@ -0,0 +1,275 @@
+"""
+RAG 边车进程：嵌入模型与 FAISS 索引在每台主机上只加载一份，各 API worker 经 Unix Socket 调用
+用法（在 backend/ 目录下，先于 API worker 启动）：
+    python -m tools.rag_sidecar
+    RAG_MODE=sidecar uvicorn main:app --workers 8
+协议：4 字节大端长度前缀 + JSON；请求 {"id", "op", "args"}，响应 {"id", "result"} 或 {"id", "error"}
+一条连接上的请求可并发进行（按 id 匹配响应），边车端的批量推理会合并来自所有 worker 的并发查询
+索引版本变化时边车向所有连接推送 {"event": "index", "result": {...}}
+"""
+import os
+import json
+import base64
+import struct
+import asyncio
+import itertools
+import numpy as np
+from .cache import TTLCache
+from .logger import log
+
+DEFAULT_SOCKET = "/tmp/prompt-agent-rag.sock"
+HEADER = struct.Struct("!I")
+
+class SidecarError(RuntimeError):
+    """边车端执行请求时抛出的异常"""
+
+def encode_message(message):
+    body = json.dumps(message, ensure_ascii=False).encode("utf-8")
+    return HEADER.pack(len(body)) + body
+
+async def read_message(reader):
+    (length,) = HEADER.unpack(await reader.readexactly(HEADER.size))
+    return json.loads(await reader.readexactly(length))
+
+def encode_vector(vec):
+    """float32 向量按原始字节 base64 编码，比 JSON 数组更紧凑且无精度损失"""
+    return base64.b64encode(np.ascontiguousarray(vec, dtype="float32").tobytes()).decode("ascii")
+
+def decode_vector(text):
+    return np.frombuffer(base64.b64decode(text), dtype="float32")
+
+class RAGSidecarServer:
+    """在单个进程内持有 RAGRetriever，为本机所有 worker 提供检索、嵌入与模板管理"""
+
+    def __init__(self, retriever, path=DEFAULT_SOCKET, watch_interval=1.0):
+        self.retriever = retriever
+        self.path = path
+        self.watch_interval = watch_interval
+        self.clients = set()
+        self._version = None
+
+    async def serve(self):
+        # 模型与索引加载完成后才开始监听，worker 据此判断边车是否就绪
+        await self.retriever.warmup()
+        self.retriever.start_watcher()
+        self._version = self.retriever.index_version
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = await asyncio.start_unix_server(self._handle, path=self.path)
+        os.chmod(self.path, 0o660)
+        log(f"[RAG-Sidecar] 已就绪: {self.path} (索引版本: {self._version})✓")
+        watcher = asyncio.get_running_loop().create_task(self._watch_version())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            watcher.cancel()
+            await self.retriever.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    async def _handle(self, reader, writer):
+        self.clients.add(writer)
+        try:
+            while True:
+                message = await read_message(reader)
+                # 每个请求独立执行，同一连接上的并发查询由检索器的批处理队列合并
+                asyncio.get_running_loop().create_task(self._dispatch(message, writer))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.clients.discard(writer)
+            writer.close()
+
+    async def _dispatch(self, message, writer):
+        try:
+            reply = {"id": message["id"], "result": await self._call(message["op"], message.get("args") or {})}
+        except Exception as e:
+            reply = {"id": message.get("id"), "error": f"{type(e).__name__}: {e}"}
+        if not writer.is_closing():
+            writer.write(encode_message(reply))
+        self._broadcast_if_changed()
+
+    async def _call(self, op, args):
+        retriever = self.retriever
+        if op == "search":
+            return await retriever.asearch(args["query"], args.get("top_k", 1))
+        if op == "embed":
+            return encode_vector(await retriever.aembed(args["text"]))
+        if op == "info":
+            return self._info()
+        if op == "upsert":
+            return await retriever.upsert_templates(args["templates"])
+        if op == "delete":
+            return await retriever.delete_templates(args["ids"])
+        if op == "reload":
+            return await retriever.reload_templates()
+        if op == "stats":
+            return retriever.cache_stats()
+        raise ValueError(f"未知操作: {op}")
+
+    def _info(self):
+        return {"index_version": self.retriever.index_version, "templates": self.retriever.templates}
+
+    def _broadcast_if_changed(self):
+        version = self.retriever.index_version
+        if version == self._version:
+            return
+        self._version = version
+        data = encode_message({"event": "index", "result": self._info()})
+        for writer in list(self.clients):
+            if not writer.is_closing():
+                writer.write(data)
+        log(f"[RAG-Sidecar] 索引版本已更新为 {version}，已通知 {len(self.clients)} 个连接")
+
+    async def _watch_version(self):
+        """模板文件热加载发生在检索器内部，定期检查版本以便推送给各 worker"""
+        while True:
+            await asyncio.sleep(self.watch_interval)
+            self._broadcast_if_changed()
+
+class RemoteRAGRetriever:
+    """
+    RAG 边车的客户端，提供与 RAGRetriever 相同的异步接口（asearch / aembed / 模板管理）
+    每个 worker 与边车保持一条长连接，断开后下次调用时自动重连
+    模板列表与索引版本缓存在本地（边车主动推送更新），查询向量另有一层本地缓存以省去重复往返
+    """
+
+    def __init__(self, path=DEFAULT_SOCKET, timeout=10.0, connect_timeout=300.0, cache_size=1024, cache_ttl=3600):
+        self.path = path
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.embedding_cache = TTLCache(cache_size, cache_ttl)
+        self._info = {"index_version": None, "templates": []}
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._reader = None
+        self._writer = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def templates(self):
+        return self._info["templates"]
+
+    @property
+    def index_version(self):
+        return self._info["index_version"]
+
+    async def _connect(self):
+        if self._writer and not self._writer.is_closing():
+            return
+        async with self._lock:
+            if self._writer and not self._writer.is_closing():
+                return
+            reader, self._writer = await asyncio.open_unix_connection(self.path)
+            self._reader = asyncio.get_running_loop().create_task(self._read_loop(reader))
+
+    async def _read_loop(self, reader):
+        try:
+            while True:
+                message = await read_message(reader)
+                if message.get("event") == "index":
+                    self._info = message["result"]
+                    continue
+                future = self._pending.pop(message.get("id"), None)
+                if future is None or future.done():
+                    continue
+                if "error" in message:
+                    future.set_exception(SidecarError(message["error"]))
+                else:
+                    future.set_result(message["result"])
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            log(f"[RAG] 与边车的连接已断开: {e}", level="WARNING")
+        finally:
+            if self._writer:
+                self._writer.close()
+            self._writer = None
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("RAG 边车连接已断开"))
+            self._pending.clear()
+
+    async def _call(self, op, **args):
+        await self._connect()
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        self._writer.write(encode_message({"id": request_id, "op": op, "args": args}))
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def asearch(self, query, top_k=1):
+        return await self._call("search", query=query, top_k=top_k)
+
+    async def aretrieve(self, query, top_k=1):
+        matches = await self.asearch(query, top_k)
+        return matches[0] if matches else None
+
+    async def aembed(self, text):
+        from .rag_tool import normalize_query
+        key = normalize_query(text)
+        cached = self.embedding_cache.get(key)
+        if cached is not None:
+            return cached
+        vec = decode_vector(await self._call("embed", text=text))
+        self.embedding_cache.set(key, vec)
+        return vec
+
+    async def _mutate(self, op, **args):
+        result = tuple(await self._call(op, **args))
+        # 推送与响应之间有先后，修改后立即刷新，保证接口返回的版本是最新的
+        self._info = await self._call("info")
+        return result
+
+    async def upsert_templates(self, templates):
+        return await self._mutate("upsert", templates=templates)
+
+    async def delete_templates(self, template_ids):
+        return await self._mutate("delete", ids=list(template_ids))
+
+    async def reload_templates(self):
+        return await self._mutate("reload")
+
+    async def acache_stats(self):
+        """边车中检索器的缓存命中统计（需经 Socket 往返，仅提供异步接口）"""
+        return await self._call("stats")
+
+    async def warmup(self):
+        """等待边车就绪（边车在模型与索引加载完成后才开始监听）并获取索引信息"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.connect_timeout
+        while True:
+            try:
+                self._info = await self._call("info")
+                log(f"[RAG] 已连接 RAG 边车: {self.path} (索引版本: {self.index_version})✓")
+                return
+            except (FileNotFoundError, ConnectionError):
+                if loop.time() >= deadline:
+                    raise
+                await asyncio.sleep(0.5)
+
+    def start_watcher(self, interval=None):
+        """模板文件由边车监听，worker 端无需轮询"""
+
+    async def close(self):
+        if self._reader:
+            self._reader.cancel()
+            await asyncio.gather(self._reader, return_exceptions=True)
+            self._reader = None
+
+def main():
+    from .rag_tool import RAGRetriever
+    server = RAGSidecarServer(
+        RAGRetriever(),
+        path=os.getenv("RAG_SIDECAR_SOCKET", DEFAULT_SOCKET),
+        watch_interval=float(os.getenv("RAG_SIDECAR_WATCH_INTERVAL", 1))
+    )
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,48 @@
 import os
 import json
-import faiss
+import asyncio
+import hashlib
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from sentence_transformers import SentenceTransformer
+from .cache import TTLCache
+from .rag_index import create_index, apply_search_params, index_params_from_env, normalize, read_index, get_faiss
+from .rag_lexical import BM25Index
+from .pg_bus import pg_bus, TEMPLATES_CHANNEL
 from .logger import log
 
+def normalize_query(text):
+    """查询文本归一化：全半角统一、大小写折叠、空白压缩"""
+    text = unicodedata.normalize("NFKC", str(text or ""))
+    return " ".join(text.lower().split())
+
+def template_id(template):
+    """模板唯一标识：优先使用 id 字段，兼容旧数据时回退为 intent"""
+    return str(template.get("id") or template["intent"])
+
+class IndexSnapshot:
+    """某一版本模板库的只读快照；更新时整体替换，读路径无需加锁"""
+    __slots__ = ("templates", "embeddings", "index", "signature", "positions", "lexical")
+
+    def __init__(self, templates=None, embeddings=None, index=None, signature=None):
+        self.templates = templates or []
+        self.embeddings = embeddings
+        self.index = index
+        self.signature = signature
+        self.positions = {template_id(t): i for i, t in enumerate(self.templates)}
+        # 词法索引覆盖 intent 与模板正文，与向量索引随快照一起替换
+        self.lexical = BM25Index(f"{t['intent']} {t.get('template', '')}" for t in self.templates)
+
+    @property
+    def version(self):
+        return self.signature[:12] if self.signature else None
+
 class RAGRetriever:
     def __init__(self):
         # 定义模型在服务器上的绝对路径
         base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
         self.model_path = os.path.join(base_dir, "models", "text2vec-base-chinese")
-        
+
         # 优先检查本地路径，如果本地没找到，才回退到在线 ID
         if os.path.exists(self.model_path):
             log(f"[RAG] 使用本地模型路径: {self.model_path}")
@@ -18,60 +50,449 @@ class RAGRetriever:
         else:
             log(f"[RAG] 警告: 本地模型路径不存在 {self.model_path}，尝试使用在线 ID", level="WARNING")
             self.model_name_or_path = 'shibing624/text2vec-base-chinese'
-            
+
         self.model = None
-        self.index = None
-        self.templates = []
+        self.snapshot = IndexSnapshot()
         self.template_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "rag", "templates.json")
+        # 预构建索引目录（由 build_index.py 生成，按模板内容哈希与模型名称校验）
+        self.index_dir = os.getenv("RAG_INDEX_DIR", os.path.join(base_dir, "rag", "index"))
+        # 索引类型及调优参数（flat / ivf / hnsw / ivfpq，统一使用归一化内积打分）
+        self.index_params = index_params_from_env()
+        # 检索模式：vector 仅向量检索；hybrid 融合 BM25 词法分数
+        self.retrieval_mode = os.getenv("RAG_RETRIEVAL_MODE", "hybrid").lower()
+        # 融合权重（向量分数占比）、相似度阈值（低于阈值的模板不注入提示词）与候选集大小
+        self.hybrid_alpha = float(os.getenv("RAG_HYBRID_ALPHA", 0.7))
+        self.min_score = float(os.getenv("RAG_MIN_SCORE", 0.45))
+        self.num_candidates = int(os.getenv("RAG_NUM_CANDIDATES", 20))
+
+        # 批量推理配置：并发查询会在 max_wait 时间窗内合并为一次 encode 调用
+        self.batch_max_size = int(os.getenv("RAG_BATCH_MAX_SIZE", 32))
+        self.batch_max_wait = float(os.getenv("RAG_BATCH_MAX_WAIT_MS", 5)) / 1000
+        # 专用单线程执行器：嵌入与检索均为 CPU 密集型任务，不能占用 Event Loop
+        # 模板更新也在该线程串行执行，因此写操作之间天然互斥
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rag-embed")
+        self._queue = None
+        self._worker = None
+        self._watcher = None
+
+        # 查询缓存：向量仅依赖查询文本，检索结果还依赖模板索引版本
+        cache_size = int(os.getenv("RAG_CACHE_MAX_SIZE", 1024))
+        cache_ttl = float(os.getenv("RAG_CACHE_TTL", 3600))
+        self.embedding_cache = TTLCache(cache_size, cache_ttl)
+        self.result_cache = TTLCache(cache_size, cache_ttl)
+
+    @property
+    def templates(self):
+        return self.snapshot.templates
+
+    @property
+    def index(self):
+        return self.snapshot.index
+
+    @property
+    def index_version(self):
+        """索引版本取自索引签名，模板变化后旧版本的缓存结果随之失效"""
+        return self.snapshot.version
+
+    def template_signature(self, content):
+        """索引签名：模板文件内容哈希 + 模型名称 + 索引构建参数，任一变化都需要重建索引"""
+        # nprobe / efSearch 仅影响检索期，不参与签名
+        build_params = {k: v for k, v in self.index_params.items() if k not in ("nprobe", "ef_search")}
+        extra = f"{self.model_name}|{json.dumps(build_params, sort_keys=True)}"
+        return hashlib.sha256(content + extra.encode("utf-8")).hexdigest()
+
+    def index_signature(self):
+        with open(self.template_path, "rb") as f:
+            return self.template_signature(f.read())
+
+    @property
+    def model_name(self):
+        """与部署路径无关的模型名称（本地路径与在线 ID 取同一名称）"""
+        return os.path.basename(self.model_name_or_path.rstrip("/\\"))
+
+    def load_templates(self):
+        """读取模板库"""
+        if not os.path.exists(self.template_path):
+            log(f"[RAG] 警告: 模板文件不存在 {self.template_path}", level="WARNING")
+            return []
+        with open(self.template_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def load_model(self):
+        if not self.model:
+            log(f"[RAG] 正在加载嵌入模型: {self.model_name_or_path}...")
+            # sentence_transformers 会连带导入 torch，延迟到首次加载模型时才导入
+            from sentence_transformers import SentenceTransformer
+            self.model = SentenceTransformer(self.model_name_or_path)
+
+    def encode_templates(self, templates):
+        """编码模板 intent 字段"""
+        self.load_model()
+        return normalize(self.model.encode([t["intent"] for t in templates]))
+
+    def build_index(self, templates, embeddings=None):
+        """基于模板向量构建 FAISS 索引，返回 (索引, 向量矩阵)；已有向量时不重复编码"""
+        if embeddings is None:
+            embeddings = self.encode_templates(templates)
+        index = create_index(np.ascontiguousarray(embeddings, dtype="float32"), **self.index_params)
+        return index, embeddings
+
+    def save_index(self, index, embeddings, signature):
+        """将索引与向量写入磁盘（先写临时文件再原子替换，避免多进程读到半成品）"""
+        os.makedirs(self.index_dir, exist_ok=True)
+        index_file = os.path.join(self.index_dir, "templates.faiss")
+        get_faiss().write_index(index, index_file + ".tmp")
+        os.replace(index_file + ".tmp", index_file)
+        embeddings_file = os.path.join(self.index_dir, "embeddings.npy")
+        with open(embeddings_file + ".tmp", "wb") as f:
+            np.save(f, embeddings)
+        os.replace(embeddings_file + ".tmp", embeddings_file)
+        meta = {
+            "signature": signature,
+            "model": self.model_name,
+            "index_type": self.index_params["index_type"],
+            "count": int(index.ntotal),
+            "dimension": int(embeddings.shape[1])
+        }
+        # meta.json 最后写入，保证签名只在索引文件就绪后才生效
+        meta_file = os.path.join(self.index_dir, "meta.json")
+        with open(meta_file + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+        os.replace(meta_file + ".tmp", meta_file)
+        log(f"[RAG] 索引已持久化: {self.index_dir} (签名: {signature[:12]})")
+
+    def load_saved_index(self, signature):
+        """签名一致时以内存映射方式加载预构建索引，否则返回 None"""
+        meta_file = os.path.join(self.index_dir, "meta.json")
+        if not os.path.exists(meta_file):
+            return None
+        try:
+            with open(meta_file, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("signature") != signature:
+                log("[RAG] 预构建索引已过期（模板或模型发生变化），将重新构建", level="WARNING")
+                return None
+            index = read_index(os.path.join(self.index_dir, "templates.faiss"))
+            apply_search_params(index, **self.index_params)
+            embeddings = np.load(os.path.join(self.index_dir, "embeddings.npy"), mmap_mode="r")
+            return index, embeddings
+        except Exception as e:
+            log(f"[RAG] 预构建索引读取失败: {e}", level="WARNING")
+            return None
 
     def load_resources(self):
-        """延迟加载模型和构建索引"""
+        """加载模型和索引：优先映射磁盘上的预构建索引，签名不一致时才重建"""
         if self.model:
             return
 
-        log(f"[RAG] 正在加载嵌入模型: {self.model_name_or_path}...")
-        self.model = SentenceTransformer(self.model_name_or_path)
-        
-        if not os.path.exists(self.template_path):
-            log(f"[RAG] 警告: 模板文件不存在 {self.template_path}", level="WARNING")
+        self.load_model()
+        templates = self.load_templates()
+        if not templates:
+            log("[RAG] 警告: 模板库为空", level="WARNING")
             return
 
-        with open(self.template_path, "r", encoding="utf-8") as f:
-            self.templates = json.load(f)
+        signature = self.index_signature()
+        saved = self.load_saved_index(signature)
+        if saved:
+            index, embeddings = saved
+            log(f"[RAG] 已映射预构建索引，加载了 {len(templates)} 个模板✓")
+        else:
+            index, embeddings = self.build_index(templates)
+            try:
+                self.save_index(index, embeddings, signature)
+            except Exception as e:
+                log(f"[RAG] 索引持久化失败: {e}", level="WARNING")
+            log(f"[RAG] 索引构建完成，加载了 {len(templates)} 个模板✓")
+        self.snapshot = IndexSnapshot(templates, embeddings, index, signature)
 
-        if not self.templates:
-            log("[RAG] 警告: 模板库为空", level="WARNING")
+    def _apply_changes(self, upserts=(), deletes=(), replace_all=None, signature=None):
+        """
+        增量更新模板库（在执行器线程中运行）
+        :param upserts: 新增或更新的模板列表（按 id 匹配）
+        :param deletes: 待删除的模板 id 列表
+        :param replace_all: 完整的新模板列表（文件热加载时使用），与现有快照做差量
+        :param signature: 热加载时由文件内容计算的签名
+        :return: (新增/更新数量, 删除数量)
+        """
+        self.load_resources()
+        old = self.snapshot
+        if replace_all is not None:
+            merged = list(replace_all)
+        else:
+            merged = list(old.templates)
+            positions = dict(old.positions)
+            for t in upserts:
+                tid = template_id(t)
+                if tid in positions:
+                    merged[positions[tid]] = t
+                else:
+                    positions[tid] = len(merged)
+                    merged.append(t)
+            delete_ids = set(deletes)
+            merged = [t for t in merged if template_id(t) not in delete_ids]
+
+        # 仅对新增或 intent 发生变化的模板重新编码，其余复用旧向量
+        reused, changed = [], []
+        for i, t in enumerate(merged):
+            pos = old.positions.get(template_id(t))
+            if pos is not None and old.templates[pos]["intent"] == t["intent"]:
+                reused.append((i, pos))
+            else:
+                changed.append(i)
+        removed = len(set(old.positions) - {template_id(t) for t in merged})
+
+        if replace_all is None:
+            content = (json.dumps(merged, ensure_ascii=False, indent=2) + "\n").encode("utf-8")
+            signature = self.template_signature(content)
+        if signature == old.signature:
+            return 0, 0
+
+        if merged:
+            dimension = self.model.get_sentence_embedding_dimension()
+            embeddings = np.zeros((len(merged), dimension), dtype="float32")
+            for i, pos in reused:
+                embeddings[i] = old.embeddings[pos]
+            if changed:
+                embeddings[changed] = self.encode_templates([merged[i] for i in changed])
+            index, embeddings = self.build_index(merged, embeddings)
+        else:
+            index, embeddings = None, None
+
+        # 管理接口的修改写回模板文件，热加载时文件本身就是来源，无需回写
+        if replace_all is None:
+            tmp_path = self.template_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, self.template_path)
+        if index is not None:
+            try:
+                self.save_index(index, embeddings, signature)
+            except Exception as e:
+                log(f"[RAG] 索引持久化失败: {e}", level="WARNING")
+
+        # 原子替换快照：进行中的检索继续使用旧快照，新请求读取新快照
+        self.snapshot = IndexSnapshot(merged, embeddings, index, signature)
+        log(f"[RAG] 模板库已更新: 重新编码 {len(changed)} 个，删除 {removed} 个，当前共 {len(merged)} 个模板✓")
+        return len(changed), removed
+
+    async def upsert_templates(self, templates):
+        """新增或更新模板（按 id 匹配）"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, lambda: self._apply_changes(upserts=templates))
+
+    async def delete_templates(self, template_ids):
+        """按 id 删除模板"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, lambda: self._apply_changes(deletes=template_ids))
+
+    async def reload_templates(self):
+        """从模板文件热加载，仅对发生变化的模板重新编码"""
+        loop = asyncio.get_running_loop()
+
+        def _reload():
+            with open(self.template_path, "rb") as f:
+                content = f.read()
+            signature = self.template_signature(content)
+            if signature == self.snapshot.signature:
+                return 0, 0
+            return self._apply_changes(replace_all=json.loads(content), signature=signature)
+
+        return await loop.run_in_executor(self._executor, _reload)
+
+    def start_watcher(self, interval=None):
+        """启动模板文件监听（轮询修改时间，文件变化时热加载）"""
+        interval = float(interval or os.getenv("RAG_WATCH_INTERVAL", 5))
+        if interval <= 0 or (self._watcher and not self._watcher.done()):
             return
+        self._watcher = asyncio.get_running_loop().create_task(self._watch_templates(interval))
 
-        # 提取 intent 字段进行编码
-        intent_texts = [t["intent"] for f in [self.templates] for t in f]
-        embeddings = self.model.encode(intent_texts)
-        
-        # 构建 FAISS 索引
-        dimension = embeddings.shape[1]
-        self.index = faiss.IndexFlatL2(dimension)
-        self.index.add(embeddings.astype('float32'))
-        log(f"[RAG] 索引构建完成，加载了 {len(self.templates)} 个模板✓")
+    async def _watch_templates(self, interval):
+        last_mtime = os.path.getmtime(self.template_path) if os.path.exists(self.template_path) else None
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                mtime = os.path.getmtime(self.template_path)
+                if mtime != last_mtime:
+                    last_mtime = mtime
+                    await self.reload_templates()
+            except Exception as e:
+                log(f"[RAG] 模板热加载失败: {e}", level="ERROR")
 
-    def retrieve(self, query, top_k=1):
-        """检索最匹配的模板"""
+    def _encode_batch(self, queries):
+        """批量编码，已缓存的查询向量直接复用，仅对未命中部分调用一次 encode"""
+        keys = [normalize_query(q) for q in queries]
+        vecs = [self.embedding_cache.get(k) for k in keys]
+        missing = [i for i, v in enumerate(vecs) if v is None]
+        if missing:
+            encoded = normalize(self.model.encode([queries[i] for i in missing]))
+            for i, vec in zip(missing, encoded):
+                vecs[i] = vec
+                self.embedding_cache.set(keys[i], vec)
+        return keys, np.vstack(vecs)
+
+    def _score_candidates(self, snapshot, query, vec, vec_indices):
+        """
+        对候选模板打分：向量分数为归一化内积（余弦相似度），
+        hybrid 模式下与按理论上界归一化的 BM25 分数线性融合
+        """
+        candidates = {int(idx) for idx in vec_indices if idx != -1}
+        lexical = {}
+        if self.retrieval_mode == "hybrid":
+            upper = snapshot.lexical.max_score(query)
+            if upper > 0:
+                hits = snapshot.lexical.search(query, self.num_candidates)
+                lexical = {idx: score / upper for idx, score in hits}
+                candidates.update(lexical)
+
+        scored = []
+        for idx in candidates:
+            vec_score = float(np.dot(snapshot.embeddings[idx], vec))
+            if self.retrieval_mode == "hybrid":
+                score = self.hybrid_alpha * vec_score + (1 - self.hybrid_alpha) * lexical.get(idx, 0.0)
+            else:
+                score = vec_score
+            if score >= self.min_score:
+                scored.append((score, idx))
+        scored.sort(reverse=True)
+        return scored
+
+    def _retrieve_batch(self, queries, top_k=1):
+        """批量编码并检索，返回每个查询对应的 (向量, 带分数的匹配模板列表)"""
         if not self.model:
             self.load_resources()
-        
-        if not self.index:
-            return None
 
-        # 编码查询
-        query_vec = self.model.encode([query])
-        
-        # 搜索
-        distances, indices = self.index.search(query_vec.astype('float32'), top_k)
-        
-        # 返回结果
-        best_match_idx = indices[0][0]
-        if best_match_idx != -1:
-            return self.templates[best_match_idx]
+        keys, query_vecs = self._encode_batch(queries)
+        # 整批查询固定使用同一份快照，期间发生的模板更新不会影响本批结果
+        snapshot = self.snapshot
+        if not snapshot.index or top_k <= 0:
+            return [(vec, []) for vec in query_vecs]
+
+        # 向量检索多取一些候选，阈值过滤与融合重排后再截取 top_k
+        depth = min(max(top_k, self.num_candidates), len(snapshot.templates))
+        distances, indices = snapshot.index.search(query_vecs, depth)
+        results = []
+        for query, key, vec, row in zip(queries, keys, query_vecs, indices):
+            scored = self._score_candidates(snapshot, query, vec, row)[:top_k]
+            matches = [dict(snapshot.templates[idx], score=round(score, 4)) for score, idx in scored]
+            # 记录检索深度，较小 top_k 的后续查询可直接截取
+            self.result_cache.set((key, snapshot.version), (top_k, matches))
+            results.append((vec, matches))
+        return results
+
+    def _cached_matches(self, query, top_k):
+        cached = self.result_cache.get((normalize_query(query), self.index_version))
+        if cached and cached[0] >= top_k:
+            return cached[1][:top_k]
         return None
 
+    def retrieve(self, query, top_k=1):
+        """检索最匹配的模板（同步版本，会阻塞调用线程）"""
+        matches = self._cached_matches(query, top_k)
+        if matches is None:
+            _, matches = self._retrieve_batch([query], top_k)[0]
+        return matches[0] if matches else None
+
+    async def aretrieve(self, query, top_k=1):
+        """检索最匹配的模板（异步版本，经由批量推理线程执行，不阻塞 Event Loop）"""
+        matches = await self.asearch(query, top_k)
+        return matches[0] if matches else None
+
+    async def asearch(self, query, top_k=1):
+        """返回至多 top_k 个超过相似度阈值的模板（含 score 字段），命中缓存时不进入批处理队列"""
+        matches = self._cached_matches(query, top_k)
+        if matches is None:
+            _, matches = await self._submit(query, top_k)
+        return matches
+
+    async def aembed(self, text):
+        """获取文本的归一化向量（与检索共用批处理队列和向量缓存）"""
+        cached = self.embedding_cache.get(normalize_query(text))
+        if cached is not None:
+            return cached
+        vec, _ = await self._submit(text, 0)
+        return vec
+
+    def cache_stats(self):
+        """返回查询向量与检索结果缓存的命中统计"""
+        return {
+            "index_version": self.index_version,
+            "embedding": self.embedding_cache.stats(),
+            "result": self.result_cache.stats()
+        }
+
+    async def acache_stats(self):
+        """与 RemoteRAGRetriever 一致的异步接口"""
+        return self.cache_stats()
+
+    async def _submit(self, query, top_k):
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._batch_worker())
+        future = loop.create_future()
+        await self._queue.put((query, top_k, future))
+        return await future
+
+    async def _batch_worker(self):
+        """后台批处理协程：收集时间窗内的并发查询，合并后交给执行器"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.batch_max_wait
+            while len(batch) < self.batch_max_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            queries = [item[0] for item in batch]
+            top_k = max(item[1] for item in batch)
+            try:
+                results = await loop.run_in_executor(self._executor, self._retrieve_batch, queries, top_k)
+                for (_, k, future), (vec, matches) in zip(batch, results):
+                    if not future.done():
+                        future.set_result((vec, matches[:k]))
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    async def warmup(self):
+        """在执行器中预加载模型与索引，避免首个请求承担加载延迟"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self.load_resources)
+
+    async def close(self):
+        """停止批处理协程、文件监听并释放执行器"""
+        for task in (self._worker, self._watcher):
+            if task:
+                task.cancel()
+        self._worker = None
+        self._watcher = None
+        self._executor.shutdown(wait=False)
+
+def create_retriever():
+    """RAG_MODE=sidecar 时各 worker 共用本机 RAG 边车进程中的模型与索引（python -m tools.rag_sidecar）"""
+    if os.getenv("RAG_MODE", "local").lower() == "sidecar":
+        from .rag_sidecar import RemoteRAGRetriever, DEFAULT_SOCKET
+        return RemoteRAGRetriever(
+            path=os.getenv("RAG_SIDECAR_SOCKET", DEFAULT_SOCKET),
+            timeout=float(os.getenv("RAG_SIDECAR_TIMEOUT", 10)),
+            connect_timeout=float(os.getenv("RAG_SIDECAR_CONNECT_TIMEOUT", 300))
+        )
+    return RAGRetriever()
+
 # 全局单例
-rag_retriever = RAGRetriever()
+rag_retriever = create_retriever()
+
+async def apply_template_change(message):
+    """其他节点经管理接口修改了模板：在本节点重放同一修改（按 id 合并，重复应用时不会重新编码）"""
+    if message.get("op") == "upsert":
+        await rag_retriever.upsert_templates(message["templates"])
+    elif message.get("op") == "delete":
+        await rag_retriever.delete_templates(message["ids"])
+
+pg_bus.subscribe(TEMPLATES_CHANNEL, apply_template_change)
@@ -0,0 +1,84 @@
+import time
+import asyncio
+from .logger import log
+
+class Readiness:
+    """
+    启动阶段的组件预热状态
+    各组件在后台任务中加载，服务无需等待即可接受连接；/api/ready 据此报告哪些组件已就绪
+    """
+
+    def __init__(self):
+        self.components = {}
+        self._tasks = {}
+        # 可重试组件的预热函数：预热失败后，每次就绪检查都会在后台重新尝试
+        self._retries = {}
+        self._started = time.monotonic()
+
+    def start(self, name, warmup, required=True, after=(), retry=False):
+        """
+        启动组件的后台预热任务
+        :param warmup: 无参协程函数；返回 False 表示组件不可用（但不视为异常）
+        :param required: 是否影响整体就绪状态
+        :param after: 需要先完成预热的组件名称
+        :param retry: 预热失败后是否在就绪检查时重试（如启动时暂时不可达、之后按需重连的数据库）
+        """
+        self.components[name] = {"status": "pending", "required": required}
+        if retry:
+            self._retries[name] = warmup
+        self._tasks[name] = asyncio.get_running_loop().create_task(self._run(name, warmup, after))
+        return self._tasks[name]
+
+    async def _run(self, name, warmup, after, retrying=False):
+        deps = [self._tasks[d] for d in after if d in self._tasks]
+        if deps:
+            await asyncio.gather(*deps, return_exceptions=True)
+        component = self.components[name]
+        # 重试期间保持 failed 状态，直到确认恢复
+        if not retrying:
+            component["status"] = "loading"
+        start = time.monotonic()
+        try:
+            ok = await warmup()
+        except Exception as e:
+            if not retrying:
+                log(f"[Startup] {name} 预热失败: {e}", level="ERROR")
+            component.update(status="failed", error=str(e))
+            return
+        if ok is False:
+            component["status"] = "failed"
+            if not retrying:
+                log(f"[Startup] {name} 不可用", level="WARNING")
+            return
+        component.update(status="ready", seconds=round(time.monotonic() - start, 3),
+                         ready_after=round(time.monotonic() - self._started, 3))
+        component.pop("error", None)
+        log(f"[Startup] {name} {'已恢复' if retrying else '已就绪'} ({component['seconds']}s)✓")
+
+    def refresh(self):
+        """为预热失败的可重试组件在后台重新执行预热（每个组件同时只有一个重试任务）"""
+        for name, warmup in self._retries.items():
+            task = self._tasks.get(name)
+            if self.components[name]["status"] == "failed" and task and task.done():
+                self._tasks[name] = asyncio.get_running_loop().create_task(self._run(name, warmup, (), retrying=True))
+
+    @property
+    def ready(self):
+        return all(c["status"] == "ready" for c in self.components.values() if c["required"])
+
+    def report(self):
+        return {"ready": self.ready, "components": self.components}
+
+    async def wait(self, timeout=None):
+        """等待全部预热任务结束（主要用于脚本与测试）"""
+        if self._tasks:
+            await asyncio.wait(list(self._tasks.values()), timeout=timeout)
+
+    async def close(self):
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        self._tasks.clear()
+
+# 全局单例
+readiness = Readiness()
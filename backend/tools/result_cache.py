@@ -0,0 +1,124 @@
+import os
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+import numpy as np
+from .rag_tool import rag_retriever, normalize_query
+from .pg_saver import pg_saver
+from .pg_bus import pg_bus, RESULT_CACHE_CHANNEL
+from .metrics import registry
+from .logger import log
+
+CACHE_LOOKUPS = registry.counter("result_cache_lookups_total", "优化结果缓存查询次数", ("result",))
+
+class CacheEntry:
+    __slots__ = ("session_id", "original_prompt", "embedding", "events", "created_at")
+
+    def __init__(self, session_id, original_prompt, embedding, events, created_at=None):
+        self.session_id = session_id
+        self.original_prompt = original_prompt
+        self.embedding = np.asarray(embedding, dtype="float32")
+        self.events = events
+        self.created_at = created_at or time.time()
+
+class SemanticResultCache:
+    """
+    整轮优化结果的语义缓存：对原始提示词做向量化，
+    与历史已完成会话的相似度超过阈值时直接回放其 SSE 事件序列
+    """
+
+    def __init__(self):
+        self.enabled = os.getenv("RESULT_CACHE_ENABLED", "false").lower() == "true"
+        self.threshold = float(os.getenv("RESULT_CACHE_THRESHOLD", 0.95))
+        self.ttl = float(os.getenv("RESULT_CACHE_TTL", 86400))
+        self.max_size = int(os.getenv("RESULT_CACHE_MAX_SIZE", 5000))
+        # 是否启用 Postgres 持久层（进程重启后可恢复，多个实例之间共享）
+        self.persistent = os.getenv("RESULT_CACHE_PERSISTENT", "true").lower() == "true"
+        self._entries = OrderedDict()
+        # 向量矩阵按需重建，查询时一次矩阵乘法完成全部相似度计算
+        self._matrix = None
+        self._keys = []
+
+    @staticmethod
+    def prompt_hash(original_prompt):
+        return hashlib.sha256(normalize_query(original_prompt).encode("utf-8")).hexdigest()
+
+    def _evict_expired(self):
+        deadline = time.time() - self.ttl
+        expired = [key for key, entry in self._entries.items() if entry.created_at < deadline]
+        for key in expired:
+            del self._entries[key]
+        if expired:
+            self._matrix = None
+
+    def _put(self, entry):
+        self._entries[entry.session_id] = entry
+        self._entries.move_to_end(entry.session_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        self._matrix = None
+
+    def _search_memory(self, vec):
+        self._evict_expired()
+        if not self._entries:
+            return None
+        if self._matrix is None:
+            self._keys = list(self._entries)
+            self._matrix = np.vstack([self._entries[key].embedding for key in self._keys])
+        scores = self._matrix @ vec
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            return None
+        entry = self._entries[self._keys[best]]
+        self._entries.move_to_end(entry.session_id)
+        return entry, float(scores[best])
+
+    async def lookup(self, original_prompt):
+        """查找相似的已完成会话，返回 (缓存条目, 相似度) 或 None"""
+        vec = await rag_retriever.aembed(original_prompt)
+        found = self._search_memory(vec)
+        if found is None and self.persistent:
+            # 内存层未命中时，按归一化文本精确匹配持久层（其他实例写入的结果）
+            row = await pg_saver.find_cached_result(self.prompt_hash(original_prompt), self.ttl)
+            if row:
+                entry = CacheEntry(row["session_id"], row["original_prompt"], row["embedding"], row["events"], row["created_at"])
+                self._put(entry)
+                found = (entry, 1.0)
+        CACHE_LOOKUPS.inc(result="hit" if found else "miss")
+        return found
+
+    async def store(self, session_id, original_prompt, events):
+        """缓存已完成会话的事件序列；持久层写入在后台进行，不阻塞 SSE 结束"""
+        vec = await rag_retriever.aembed(original_prompt)
+        self._put(CacheEntry(session_id, original_prompt, vec, events))
+        if self.persistent:
+            asyncio.get_running_loop().create_task(self._persist(session_id, original_prompt, vec, events))
+
+    async def _persist(self, session_id, original_prompt, vec, events):
+        saved = await pg_saver.save_cached_result(session_id, self.prompt_hash(original_prompt), original_prompt, vec.tolist(), events)
+        # 落库后通知其他 worker 加载到各自的内存层，使语义匹配在所有 worker 上生效
+        if saved:
+            await pg_bus.publish(RESULT_CACHE_CHANNEL, {"session_id": session_id})
+
+    async def on_remote_store(self, message):
+        """其他 worker 写入了新的缓存结果：事件序列可能超出 NOTIFY 负载上限，按会话标识回查数据库"""
+        if not (self.enabled and self.persistent) or message.get("session_id") in self._entries:
+            return
+        row = await pg_saver.get_cached_result(message["session_id"])
+        if row:
+            self._put(CacheEntry(row["session_id"], row["original_prompt"], row["embedding"], row["events"], row["created_at"]))
+
+    async def warmup(self):
+        """启动时从持久层加载最近的缓存结果"""
+        if not (self.enabled and self.persistent):
+            return
+        rows = await pg_saver.load_cached_results(self.max_size, self.ttl)
+        for row in reversed(rows):
+            self._put(CacheEntry(row["session_id"], row["original_prompt"], row["embedding"], row["events"], row["created_at"]))
+        if rows:
+            log(f"[Cache] 已从数据库加载 {len(rows)} 条优化结果缓存✓")
+
+# 全局单例
+result_cache = SemanticResultCache()
+pg_bus.subscribe(RESULT_CACHE_CHANNEL, result_cache.on_remote_store)
@@ -0,0 +1,221 @@
+import os
+import time
+import asyncio
+import ipaddress
+from collections import OrderedDict, deque
+from .metrics import registry
+from .logger import log
+
+SCHED_QUEUE_DEPTH = registry.gauge("scheduler_queue_depth", "等待执行的优化请求数")
+SCHED_ACTIVE = registry.gauge("scheduler_active_runs", "正在执行的优化请求数")
+SCHED_WAIT_SECONDS = registry.histogram("scheduler_wait_seconds", "优化请求排队等待耗时")
+SCHED_REJECTED = registry.counter("scheduler_rejected_total", "被拒绝的优化请求数", ("reason",))
+RATE_LIMIT_WAIT_SECONDS = registry.histogram(
+    "llm_rate_limit_wait_seconds", "LLM 调用等待令牌桶放行的耗时", ("provider",),
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30)
+)
+
+class QueueFull(Exception):
+    """排队人数已达上限"""
+
+class TokenBucket:
+    """
+    令牌桶限流：以 rate（个/秒）持续补充令牌，最多积累 capacity 个
+    等待者按到达顺序依次放行
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1.0, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, tokens=1):
+        """获取令牌，返回等待时长（秒）"""
+        start = time.monotonic()
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return time.monotonic() - start
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+def rate_limiter_from_env(provider):
+    """读取 LLM_RATE_LIMIT_<PROVIDER>（每分钟请求数，0 或未配置表示不限流）与 LLM_RATE_BURST_<PROVIDER>"""
+    rpm = float(os.getenv(f"LLM_RATE_LIMIT_{provider.upper()}", 0))
+    if rpm <= 0:
+        return None
+    burst = os.getenv(f"LLM_RATE_BURST_{provider.upper()}")
+    return TokenBucket(rpm / 60, float(burst) if burst else None)
+
+class Ticket:
+    """一次排队请求；admitted 完成即表示获得执行名额"""
+    __slots__ = ("client", "admitted", "enqueued_at")
+
+    def __init__(self, client):
+        self.client = client
+        self.admitted = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+
+class FairScheduler:
+    """
+    优化请求准入控制：全局并发上限 + 有界等待队列
+    不同客户端之间轮询放行，单个客户端的突发请求不会饿死其他客户端
+    """
+
+    def __init__(self, max_concurrent=8, max_queue=100, max_per_client=5, queue_timeout=120):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_per_client = max_per_client
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        # 按轮询顺序排列的客户端 -> 该客户端的等待队列
+        self._queues = OrderedDict()
+        SCHED_QUEUE_DEPTH.set_function(lambda: self.depth)
+        SCHED_ACTIVE.set_function(lambda: self.active)
+
+    @property
+    def depth(self):
+        return sum(len(q) for q in self._queues.values())
+
+    def enqueue(self, client):
+        """登记请求；有空闲名额且无人排队时直接放行，队列已满时抛出 QueueFull"""
+        ticket = Ticket(client)
+        if self.active < self.max_concurrent and not self._queues:
+            self._admit(ticket)
+            return ticket
+        if self.depth >= self.max_queue:
+            SCHED_REJECTED.inc(reason="queue_full")
+            raise QueueFull("服务繁忙，排队人数已满")
+        queue = self._queues.setdefault(client, deque())
+        if len(queue) >= self.max_per_client:
+            SCHED_REJECTED.inc(reason="client_limit")
+            raise QueueFull("该客户端排队中的请求过多")
+        queue.append(ticket)
+        return ticket
+
+    def position(self, ticket):
+        """估算排队位置（从 1 开始）：按轮询顺序，排在该请求之前会被放行的请求数 + 1"""
+        if ticket.admitted.done():
+            return 0
+        queue = self._queues.get(ticket.client)
+        if not queue or ticket not in queue:
+            return 0
+        k = queue.index(ticket)
+        ahead = k
+        before = True
+        for client, other in self._queues.items():
+            if client == ticket.client:
+                before = False
+                continue
+            # 轮询中排在前面的客户端在本请求之前还能放行 k + 1 个，排在后面的能放行 k 个
+            ahead += min(len(other), k + 1 if before else k)
+        return ahead + 1
+
+    async def wait(self, ticket, interval=1.0):
+        """
+        等待放行（异步生成器）：排队期间每当位置变化时产出新位置
+        超过 queue_timeout 仍未放行时移出队列并抛出 asyncio.TimeoutError
+        """
+        deadline = ticket.enqueued_at + self.queue_timeout
+        last = None
+        while not ticket.admitted.done():
+            position = self.position(ticket)
+            if position != last:
+                last = position
+                yield position
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self._remove(ticket)
+                SCHED_REJECTED.inc(reason="timeout")
+                raise asyncio.TimeoutError("排队超时")
+            await asyncio.wait({ticket.admitted}, timeout=min(interval, remaining))
+        SCHED_WAIT_SECONDS.observe(time.monotonic() - ticket.enqueued_at)
+
+    def cancel(self, ticket):
+        """客户端断开：未放行则移出队列，已放行则归还名额"""
+        if not self._remove(ticket) and ticket.admitted.done():
+            self.release(ticket)
+
+    def release(self, ticket):
+        if ticket.client is None:
+            return
+        # 同一张票只归还一次
+        ticket.client = None
+        self.active -= 1
+        self._dispatch()
+
+    def _remove(self, ticket):
+        queue = self._queues.get(ticket.client)
+        if queue and ticket in queue:
+            queue.remove(ticket)
+            if not queue:
+                del self._queues[ticket.client]
+            return True
+        return False
+
+    def _admit(self, ticket):
+        self.active += 1
+        ticket.admitted.set_result(True)
+
+    def _dispatch(self):
+        """按客户端轮询放行等待中的请求"""
+        while self.active < self.max_concurrent and self._queues:
+            client, queue = next(iter(self._queues.items()))
+            ticket = queue.popleft()
+            # 被服务过的客户端移到轮询末尾
+            del self._queues[client]
+            if queue:
+                self._queues[client] = queue
+            self._admit(ticket)
+
+def _parse_networks(value):
+    return [ipaddress.ip_network(item.strip(), strict=False) for item in (value or "").split(",") if item.strip()]
+
+# 受信任的反向代理 / 网关（逗号分隔的 IP 或网段），只有经由它们转发的请求才采用转发头中的客户端标识
+TRUSTED_PROXIES = _parse_networks(os.getenv("SCHED_TRUSTED_PROXIES", ""))
+
+def _trusted(host):
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(address in network for network in TRUSTED_PROXIES)
+
+def client_key(request):
+    """
+    客户端标识（公平调度与单客户端排队上限的依据），默认为直连地址
+    请求头可由调用方任意伪造，仅当直连方是受信任代理时才采用其设置的 X-Client-Id（如网关鉴权后的用户标识），
+    或 X-Forwarded-For 自右向左跳过受信任代理后的第一个地址
+    """
+    host = request.client.host if request.client else "unknown"
+    if not _trusted(host):
+        return host
+    client_id = request.headers.get("X-Client-Id")
+    if client_id:
+        return client_id
+    for hop in reversed(request.headers.get("X-Forwarded-For", "").split(",")):
+        hop = hop.strip()
+        if hop and not _trusted(hop):
+            return hop
+    return host
+
+def create_scheduler():
+    scheduler = FairScheduler(
+        max_concurrent=int(os.getenv("SCHED_MAX_CONCURRENT", 8)),
+        max_queue=int(os.getenv("SCHED_MAX_QUEUE", 100)),
+        max_per_client=int(os.getenv("SCHED_MAX_PER_CLIENT", 5)),
+        queue_timeout=float(os.getenv("SCHED_QUEUE_TIMEOUT", 120))
+    )
+    log(f"[Scheduler] 并发上限: {scheduler.max_concurrent}，队列上限: {scheduler.max_queue}")
+    return scheduler
+
+# 全局单例
+scheduler = create_scheduler()
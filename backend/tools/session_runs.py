@@ -0,0 +1,400 @@
+import os
+import asyncio
+from itertools import islice
+from collections import deque
+from .logger import log
+from .metrics import registry
+from .sse import frame
+from .pg_saver import pg_saver
+from .pg_bus import pg_bus, SESSION_EVENTS_CHANNEL, SESSION_ATTACH_CHANNEL
+
+RUNS_ACTIVE = registry.gauge("session_runs_active", "仍在执行的优化会话数")
+RUN_SUBSCRIBERS = registry.gauge("session_run_subscribers", "已连接的 SSE 订阅者数")
+RUN_REATTACHES = registry.counter("session_run_reattach_total", "客户端断线重连次数", ("source",))
+RUN_ABANDONED = registry.counter("session_run_abandoned_total", "宽限期内无人订阅而被取消的会话数")
+RUN_LEASES_LOST = registry.counter("session_run_leases_lost_total", "租约被其他 worker 接管而取消的会话数")
+RUN_GAPS = registry.counter("session_run_event_gaps_total", "订阅者落后于事件缓冲区、无法补发全部事件的次数")
+
+# 共享模式下会话结束时写入的结束标记（空帧，回放时跳过）
+END_MARKER = ""
+
+def tag_event_id(chunk, event_id):
+    """在一次写出的最后一个 SSE 帧上附加 id 字段（帧以空行结尾，id 行插在空行之前）"""
+    return chunk[:-1] + f"id: {event_id}\n\n".encode()
+
+class SessionRun:
+    """
+    单个优化会话的后台执行与事件日志
+    图在后台任务中运行，与 HTTP 连接解耦；输出写入有界环形缓冲区，每次写出分配单调递增的事件 ID
+    订阅者可从任意事件 ID 之后续读，最后一个订阅者断开后超过宽限期仍无人重连才取消执行
+    """
+
+    def __init__(self, session_id, buffer_size=2000, grace=30.0):
+        self.session_id = session_id
+        self.grace = grace
+        # (事件 ID, 已附加 id 字段的 SSE 字节)
+        self.events = deque(maxlen=buffer_size)
+        self.last_id = 0
+        self.done = False
+        self.subscribers = 0
+        self.task = None
+        # 每个事件写入缓冲区后的回调 (run, 事件 ID, 帧字节)
+        self.on_event = None
+        self._changed = asyncio.Event()
+        self._expire_handle = None
+
+    def start(self, producer, on_finish=None):
+        """在后台消费 producer（产出 SSE 字节的异步生成器）"""
+        self.task = asyncio.get_running_loop().create_task(self._pump(producer, on_finish))
+        return self.task
+
+    async def _pump(self, producer, on_finish):
+        try:
+            async for chunk in producer:
+                self._append(chunk)
+        except asyncio.CancelledError:
+            log(f"[{self.session_id}] 会话已取消")
+        finally:
+            self.done = True
+            self._notify()
+            if self._expire_handle:
+                self._expire_handle.cancel()
+            if on_finish:
+                on_finish(self)
+
+    def _append(self, chunk):
+        if not chunk:
+            return
+        self.last_id += 1
+        self.events.append((self.last_id, tag_event_id(chunk, self.last_id)))
+        if self.on_event:
+            self.on_event(self, self.last_id, self.events[-1][1])
+        self._notify()
+
+    def _notify(self):
+        # 唤醒当前所有等待者，并为下一轮等待换上新的 Event
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def missed(self, last_event_id):
+        """last_event_id 之后的部分事件是否已被淘汰出缓冲区"""
+        return bool(self.events) and last_event_id < self.events[0][0] - 1
+
+    def since(self, last_event_id):
+        """返回事件 ID 大于 last_event_id 的已缓冲事件（早于缓冲区的事件已被淘汰，需先以 missed 检查）"""
+        if not self.events or last_event_id >= self.last_id:
+            return []
+        # 事件 ID 连续，直接从对应位置开始截取
+        start = max(0, last_event_id - self.events[0][0] + 1)
+        return [chunk for _, chunk in islice(self.events, start, None)]
+
+    async def subscribe(self, last_event_id=0):
+        """订阅事件流（异步生成器）：先补发 last_event_id 之后的缓冲事件，再持续推送新事件直到会话结束"""
+        self._attach()
+        try:
+            cursor = last_event_id
+            while True:
+                # 先取出 Event 再读取缓冲区，避免两者之间到达的事件丢失唤醒
+                changed = self._changed
+                pending = self.since(cursor)
+                if pending:
+                    if self.missed(cursor):
+                        # 订阅者落后于缓冲区：先发送 reset 帧说明丢失的事件范围，而不是静默跳过
+                        RUN_GAPS.inc()
+                        log(f"[{self.session_id}] 事件 {cursor + 1}~{self.events[0][0] - 1} 已淘汰出缓冲区，无法补发", level="WARNING")
+                        pending.insert(0, frame({'status': 'reset', 'missed': [cursor + 1, self.events[0][0] - 1]}))
+                    cursor = self.last_id
+                    yield b"".join(pending)
+                    continue
+                if self.done:
+                    return
+                await changed.wait()
+        finally:
+            self._detach()
+
+    def _attach(self):
+        self.subscribers += 1
+        RUN_SUBSCRIBERS.inc()
+        if self._expire_handle:
+            self._expire_handle.cancel()
+            self._expire_handle = None
+
+    def _detach(self):
+        self.subscribers -= 1
+        RUN_SUBSCRIBERS.dec()
+        if self.subscribers == 0 and not self.done:
+            log(f"[{self.session_id}] 客户端已断开，{self.grace:g}s 内无人重连将取消执行")
+            self._expire_handle = asyncio.get_running_loop().call_later(self.grace, self._expire)
+
+    def keepalive(self):
+        """其他 worker 上仍有订阅者（共享模式）：重新开始计算宽限期"""
+        if self.subscribers == 0 and not self.done:
+            if self._expire_handle:
+                self._expire_handle.cancel()
+            self._expire_handle = asyncio.get_running_loop().call_later(self.grace, self._expire)
+
+    def _expire(self):
+        self._expire_handle = None
+        if self.subscribers == 0 and not self.done and self.task:
+            RUN_ABANDONED.inc()
+            self.task.cancel()
+
+class RunRegistry:
+    """
+    进程内的会话注册表：执行中与刚结束的会话保留 retention 秒供客户端重连
+    启用持久化时，会话结束后将缓冲的事件写入 Postgres，进程内已淘汰的会话仍可回放
+    共享模式（多 worker / 多节点）下事件按时间窗批量增量写入 Postgres 并经 NOTIFY 广播，
+    客户端重连到任意 worker 都能续读；跟随方定期通知所属 worker 仍有订阅者，避免其取消执行
+    执行方为每个执行中的会话持有租约（session_leases）并每 lease/3 秒续期，其他 worker 据租约判断会话是否仍在执行，
+    而不是依据最后一个事件的时间（节点可能长时间不产生输出）
+    """
+
+    def __init__(self, buffer_size=2000, grace=30.0, retention=300.0, persist=False,
+                 shared=False, flush_interval=0.05, poll_interval=2.0, lease=15.0):
+        self.buffer_size = buffer_size
+        self.grace = grace
+        self.retention = retention
+        self.persist = persist
+        self.shared = shared
+        self.flush_interval = flush_interval
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.runs = {}
+        # 共享模式：待写入的事件、有新事件的会话，以及本进程中跟随其他 worker 会话的等待者
+        self._pending = []
+        self._dirty = {}
+        self._follows = {}
+        self._wakeup = None
+        self._flusher = None
+        # 共享模式：本进程持有租约的执行中会话，以及续期任务
+        self._leases = {}
+        self._lease_wakeup = None
+        self._renewer = None
+        RUNS_ACTIVE.set_function(lambda: sum(1 for run in self.runs.values() if not run.done))
+
+    def start(self, session_id, producer):
+        run = SessionRun(session_id, buffer_size=self.buffer_size, grace=self.grace)
+        if self.shared:
+            run.on_event = self._record
+            self._hold(run)
+        self.runs[session_id] = run
+        run.start(producer, on_finish=self._finished)
+        return run
+
+    def get(self, session_id):
+        return self.runs.get(session_id)
+
+    def _finished(self, run):
+        loop = asyncio.get_running_loop()
+        loop.call_later(self.retention, self._evict, run)
+        if self.shared:
+            # 租约已被其他 worker 接管时不再写入结束标记，以免混入对方的事件
+            if self._leases.pop(run.session_id, None) is run:
+                self._enqueue(run, run.last_id + 1, END_MARKER)
+        elif self.persist and run.events:
+            loop.create_task(pg_saver.save_session_events(run.session_id, list(run.events)))
+
+    def _record(self, run, event_id, chunk):
+        self._enqueue(run, event_id, chunk.decode("utf-8"))
+
+    def _enqueue(self, run, event_id, text):
+        self._pending.append((run.session_id, event_id, text))
+        self._dirty[run.session_id] = run
+        if self._flusher is None or self._flusher.done():
+            self._wakeup = asyncio.Event()
+            self._flusher = asyncio.get_running_loop().create_task(self._flush_worker())
+        self._wakeup.set()
+
+    async def _flush_worker(self):
+        """后台写入协程：时间窗内各会话的事件合并为一次写入，写入后再通知其他 worker"""
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            await asyncio.sleep(self.flush_interval)
+            await self._flush()
+
+    async def _flush(self):
+        records, self._pending = self._pending, []
+        dirty, self._dirty = self._dirty, {}
+        if records and await pg_saver.append_session_events(records, pg_bus.node_id):
+            # 结束标记落库后才释放租约，跟随方看到租约失效时一定能读到全部事件
+            ended = [session_id for session_id, _, text in records if text == END_MARKER]
+            if ended:
+                await pg_saver.release_session_leases(ended, pg_bus.node_id)
+        # 每条通知携带一批会话的 [session_id, 最新事件 ID]，控制在 NOTIFY 负载上限内
+        states = [[session_id, run.last_id] for session_id, run in dirty.items()]
+        for i in range(0, len(states), 100):
+            await pg_bus.publish(SESSION_EVENTS_CHANNEL, {"sessions": states[i:i + 100]})
+
+    def _hold(self, run):
+        self._leases[run.session_id] = run
+        if self._renewer is None or self._renewer.done():
+            self._lease_wakeup = asyncio.Event()
+            self._renewer = asyncio.get_running_loop().create_task(self._renew_worker())
+        self._lease_wakeup.set()
+
+    async def _renew_worker(self):
+        """后台续期协程：新会话登记后立即写入租约，之后每 lease/3 秒统一续期本进程执行中的会话"""
+        while True:
+            self._lease_wakeup.clear()
+            if self._leases:
+                owned = dict(self._leases)
+                held = await pg_saver.renew_session_leases(owned, pg_bus.node_id, self.lease)
+                # 数据库不可用时无法判断归属，保持执行，待租约恢复后再续期
+                for session_id in (owned.keys() - held if held is not None else ()):
+                    run = owned[session_id]
+                    if self._leases.get(session_id) is run and not run.done:
+                        del self._leases[session_id]
+                        RUN_LEASES_LOST.inc()
+                        log(f"[{session_id}] 会话租约已被其他 worker 接管，取消本进程的执行", level="WARNING")
+                        run.task.cancel()
+            try:
+                await asyncio.wait_for(self._lease_wakeup.wait(), self.lease / 3)
+            except asyncio.TimeoutError:
+                pass
+
+    async def claim(self, session_id):
+        """共享模式下在执行前获取会话租约，租约仍由其他 worker 持有时返回 False（应跟随而不是重复执行）"""
+        if not self.shared:
+            return True
+        held = await pg_saver.renew_session_leases([session_id], pg_bus.node_id, self.lease)
+        return held is None or session_id in held
+
+    def on_session_events(self, message):
+        """其他 worker 写入了新事件：唤醒本进程中跟随这些会话的订阅者"""
+        for session_id, _ in message.get("sessions", ()):
+            for changed in self._follows.get(session_id, ()):
+                changed.set()
+
+    def on_session_attach(self, message):
+        """其他 worker 上有客户端跟随本进程执行的会话"""
+        run = self.runs.get(message.get("session_id"))
+        if run:
+            run.keepalive()
+
+    async def running_elsewhere(self, session_id):
+        """共享模式下会话是否仍在其他 worker 上执行（其租约仍在有效期内）"""
+        if not self.shared or session_id in self.runs:
+            return False
+        return await pg_saver.session_lease_held(session_id)
+
+    async def _follow(self, session_id, last_event_id):
+        """跟随其他 worker 上的会话：回放已持久化的事件，之后按通知（或定期轮询）读取新事件"""
+        loop = asyncio.get_running_loop()
+        changed = asyncio.Event()
+        self._follows.setdefault(session_id, set()).add(changed)
+        RUN_SUBSCRIBERS.inc()
+        cursor = last_event_id
+        keepalive_at = 0.0
+        try:
+            while True:
+                changed.clear()
+                # 先检查租约再读取事件：执行方写入结束标记后才释放租约，租约失效时本次读取已包含全部事件
+                # 租约失效且没有结束标记说明所属 worker 已退出，读完现有事件即结束（客户端可改为从检查点恢复）
+                held = await pg_saver.session_lease_held(session_id)
+                rows = await pg_saver.fetch_session_events(session_id, cursor)
+                if rows:
+                    cursor = rows[-1][0]
+                    frames = "".join(text for _, text in rows)
+                    if frames:
+                        yield frames.encode("utf-8")
+                    if rows[-1][1] == END_MARKER:
+                        return
+                if not held:
+                    return
+                if loop.time() >= keepalive_at:
+                    await pg_bus.publish(SESSION_ATTACH_CHANNEL, {"session_id": session_id})
+                    keepalive_at = loop.time() + self.grace / 3
+                try:
+                    await asyncio.wait_for(changed.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            RUN_SUBSCRIBERS.dec()
+            follows = self._follows.get(session_id)
+            follows.discard(changed)
+            if not follows:
+                del self._follows[session_id]
+
+    async def _stitch(self, run, last_event_id):
+        """共享模式下淘汰出缓冲区的事件仍在 Postgres 中：先从数据库补齐缺口，再订阅内存中的事件"""
+        oldest = run.events[0][0]
+        rows = [(event_id, text) for event_id, text in await pg_saver.fetch_session_events(run.session_id, last_event_id)
+                if event_id < oldest]
+        # 数据库中的事件连续覆盖缺口时才采用，否则由 subscribe 发送 reset 帧
+        if rows and len(rows) == oldest - 1 - last_event_id:
+            yield "".join(text for _, text in rows).encode("utf-8")
+            last_event_id = oldest - 1
+        async for chunk in run.subscribe(last_event_id):
+            yield chunk
+
+    def _evict(self, run):
+        if self.runs.get(run.session_id) is run:
+            del self.runs[run.session_id]
+
+    async def replay(self, session_id, last_event_id=0):
+        """
+        重连入口：返回事件流（异步生成器），会话不存在时返回 None
+        优先订阅进程内的会话，其次跟随其他 worker 上的会话（共享模式），最后回放 Postgres 中持久化的事件
+        """
+        run = self.runs.get(session_id)
+        if run:
+            RUN_REATTACHES.inc(source="memory")
+            if self.shared and run.missed(last_event_id):
+                return self._stitch(run, last_event_id)
+            return run.subscribe(last_event_id)
+        if self.shared:
+            # 其他 worker 刚获得租约时可能尚未写入事件，同样跟随
+            if await pg_saver.session_event_state(session_id) is None and not await pg_saver.session_lease_held(session_id):
+                return None
+            RUN_REATTACHES.inc(source="cluster")
+            return self._follow(session_id, last_event_id)
+        if not self.persist:
+            return None
+        rows = await pg_saver.fetch_session_events(session_id, last_event_id)
+        if not rows:
+            return None
+        RUN_REATTACHES.inc(source="database")
+
+        async def stored():
+            yield "".join(text for _, text in rows).encode("utf-8")
+        return stored()
+
+    async def close(self):
+        runs = [run for run in self.runs.values() if run.task and not run.done]
+        for run in runs:
+            run.task.cancel()
+        await asyncio.gather(*(run.task for run in runs), return_exceptions=True)
+        if self._flusher:
+            # 写出剩余事件与结束标记
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+            await self._flush()
+        if self._renewer:
+            self._renewer.cancel()
+            await asyncio.gather(self._renewer, return_exceptions=True)
+            self._renewer = None
+
+def parse_last_event_id(value):
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return 0
+
+def create_run_registry():
+    return RunRegistry(
+        buffer_size=int(os.getenv("SSE_EVENT_BUFFER", 2000)),
+        grace=float(os.getenv("SSE_RESUME_GRACE", 30)),
+        retention=float(os.getenv("SSE_RESUME_RETENTION", 300)),
+        persist=os.getenv("SSE_EVENT_PERSIST", "false").lower() == "true",
+        shared=pg_bus.enabled,
+        flush_interval=float(os.getenv("SSE_CLUSTER_FLUSH_MS", 50)) / 1000,
+        poll_interval=float(os.getenv("SSE_CLUSTER_POLL", 2)),
+        lease=float(os.getenv("SSE_CLUSTER_LEASE", 15))
+    )
+
+# 全局单例
+run_registry = create_run_registry()
+pg_bus.subscribe(SESSION_EVENTS_CHANNEL, run_registry.on_session_events)
+pg_bus.subscribe(SESSION_ATTACH_CHANNEL, run_registry.on_session_attach)
@@ -0,0 +1,105 @@
+import os
+import json
+import time
+
+try:
+    import orjson
+    SERIALIZER = "orjson"
+
+    def dumps(payload):
+        """序列化为 UTF-8 字节（orjson 可用时使用，速度约为标准库的数倍）"""
+        return orjson.dumps(payload, default=str)
+except ImportError:
+    SERIALIZER = "json"
+    _encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"), default=str)
+
+    def dumps(payload):
+        """序列化为 UTF-8 字节（未安装 orjson 时回退到标准库，保留非 ASCII 字符以减小体积）"""
+        return _encoder.encode(payload).encode("utf-8")
+
+DONE_FRAME = b"data: [DONE]\n\n"
+
+def frame(payload):
+    """编码单个 SSE 帧"""
+    return b"data: " + dumps(payload) + b"\n\n"
+
+class SSEStream:
+    """
+    /api/optimize 的 SSE 编码器
+    1. token 合并：同一节点的连续 token 在时间窗（window 秒）或长度上限（max_chars）内合并为一个事件
+    2. 批量写出：合并后的多个事件拼接为一次写入
+    3. 状态增量：节点结束事件的 updates 只包含相比已发送状态发生变化的字段
+    """
+
+    def __init__(self, window=0.03, max_chars=256):
+        self.window = window
+        self.max_chars = max_chars
+        self._node = None
+        self._tokens = []
+        self._chars = 0
+        self._first_at = None
+        self._sent_state = {}
+        # 供结果缓存回放的事件序列（与实际发送的事件一致，token 按节点合并）
+        self.replay_events = []
+
+    def _record(self, payload):
+        last = self.replay_events[-1] if self.replay_events else None
+        if payload.get("status") == "token" and last and last.get("status") == "token" and last.get("node") == payload["node"]:
+            last["token"] += payload["token"]
+        else:
+            self.replay_events.append(dict(payload))
+
+    def _take_tokens(self):
+        if not self._tokens:
+            return b""
+        payload = {"node": self._node, "status": "token", "token": "".join(self._tokens)}
+        self._tokens, self._chars, self._first_at = [], 0, None
+        self._record(payload)
+        return frame(payload)
+
+    def token(self, node, token):
+        """缓冲一个 token；切换节点、超过长度上限或时间窗到期时返回需要写出的字节，否则返回空字节串"""
+        out = b""
+        if self._tokens and node != self._node:
+            out += self._take_tokens()
+        if not self._tokens:
+            self._node = node
+            self._first_at = time.monotonic()
+        self._tokens.append(token)
+        self._chars += len(token)
+        if self._chars >= self.max_chars or time.monotonic() - self._first_at >= self.window:
+            out += self._take_tokens()
+        return out
+
+    def tick(self):
+        """时间窗已到期时写出缓冲的 token（每收到一个图事件调用一次）"""
+        if self._first_at is not None and time.monotonic() - self._first_at >= self.window:
+            return self._take_tokens()
+        return b""
+
+    def flush(self):
+        return self._take_tokens()
+
+    def event(self, payload, record=True):
+        """编码非 token 事件：先写出缓冲的 token 以保证顺序"""
+        out = self._take_tokens()
+        if record:
+            self._record(payload)
+        return out + frame(payload)
+
+    def delta(self, updates):
+        """返回相比已发送状态发生变化的字段"""
+        if not isinstance(updates, dict):
+            return updates
+        changed = {k: v for k, v in updates.items() if k not in self._sent_state or self._sent_state[k] != v}
+        self._sent_state.update(changed)
+        return changed
+
+    def node_end(self, node, updates):
+        return self.event({"node": node, "status": "end", "updates": self.delta(updates)})
+
+def stream_from_env():
+    return SSEStream(
+        window=float(os.getenv("SSE_COALESCE_MS", 30)) / 1000,
+        max_chars=int(os.getenv("SSE_COALESCE_MAX_CHARS", 256))
+    )
@@ -0,0 +1,183 @@
+import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from langchain_core.callbacks import BaseCallbackHandler
+from .metrics import registry
+from .usage import TokenUsageHandler
+from .logger import log
+
+GRAPH_NODES = ("analyzer", "rag_prefetch", "generator", "reflector")
+
+NODE_SECONDS = registry.histogram("graph_node_seconds", "图节点执行耗时", ("node",))
+NODE_ERRORS = registry.counter("graph_node_errors_total", "图节点执行失败次数", ("node",))
+LLM_TTFT = registry.histogram(
+    "llm_ttft_seconds", "LLM 首个 token 耗时（按所在节点）", ("node",),
+    buckets=(0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 20, 30)
+)
+LLM_CALL_SECONDS = registry.histogram("llm_call_seconds", "LLM 调用总耗时（按所在节点）", ("node",))
+LLM_TOKENS = registry.counter("llm_tokens_total", "LLM Token 消耗（按所在节点）", ("node", "direction"))
+SPAN_SECONDS = registry.histogram("graph_span_seconds", "节点内关键步骤耗时（RAG 检索、数据库写入等）", ("span",))
+
+class SessionTrace:
+    """单个会话的 span 记录：(名称, 所在节点, 相对会话开始的偏移, 耗时, 附加属性)"""
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.started = time.monotonic()
+        self.finished = None
+        self.spans = []
+
+    def add(self, name, node, start, duration, **attrs):
+        self.spans.append((name, node, start - self.started, duration, attrs))
+
+    def to_dict(self):
+        return {
+            "session_id": self.session_id,
+            "seconds": round((self.finished or time.monotonic()) - self.started, 3),
+            "spans": [
+                {"name": name, "node": node, "offset": round(offset, 3), "seconds": round(duration, 3), **attrs}
+                for name, node, offset, duration, attrs in self.spans
+            ]
+        }
+
+    def summary(self):
+        """按节点汇总耗时与 Token，用于会话结束时输出一行日志"""
+        nodes = {}
+        for name, node, _, duration, attrs in self.spans:
+            item = nodes.setdefault(node, {"node": 0.0, "llm": 0, "tokens": 0})
+            if name == "node":
+                item["node"] += duration
+            elif name == "llm":
+                item["llm"] += 1
+                item["tokens"] += attrs.get("input_tokens", 0) + attrs.get("output_tokens", 0)
+        return " | ".join(
+            f"{node} {v['node']:.2f}s llm x{v['llm']} tokens {v['tokens']}" for node, v in nodes.items() if v["node"]
+        )
+
+class TracingHandler(BaseCallbackHandler):
+    """
+    图执行回调：记录节点耗时、LLM 首 token 耗时、调用耗时与 Token 消耗
+    回调在事件循环中同步执行（run_inline），只做字典读写与直方图计数，开销可忽略
+    指标始终记录；trace 为 None（关闭会话明细）时不保留 span
+    """
+    run_inline = True
+
+    def __init__(self, trace=None):
+        self.trace = trace
+        # run_id -> (节点, 开始时间)
+        self._nodes = {}
+        # run_id -> [节点, 开始时间, 首 token 时间]
+        self._llm = {}
+
+    def _add(self, name, node, start, duration, **attrs):
+        if self.trace:
+            self.trace.add(name, node, start, duration, **attrs)
+
+    def on_chain_start(self, serialized, inputs, *, run_id, metadata=None, **kwargs):
+        node = (metadata or {}).get("langgraph_node")
+        # 只记录节点本身的 run，节点内部的子链（prompt | llm 等）同样带有 langgraph_node
+        if node in GRAPH_NODES and kwargs.get("name") == node:
+            self._nodes[run_id] = (node, time.monotonic())
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        entry = self._nodes.pop(run_id, None)
+        if entry:
+            node, start = entry
+            duration = time.monotonic() - start
+            NODE_SECONDS.observe(duration, node=node)
+            self._add("node", node, start, duration)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        entry = self._nodes.pop(run_id, None)
+        if entry:
+            node, start = entry
+            NODE_ERRORS.inc(node=node)
+            self._add("node", node, start, time.monotonic() - start, error=type(error).__name__)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs):
+        self._llm[run_id] = [(metadata or {}).get("langgraph_node", "unknown"), time.monotonic(), None]
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        entry = self._llm.get(run_id)
+        if entry and entry[2] is None:
+            entry[2] = time.monotonic()
+            LLM_TTFT.observe(entry[2] - entry[1], node=entry[0])
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        entry = self._llm.pop(run_id, None)
+        if not entry:
+            return
+        node, start, first_token_at = entry
+        duration = time.monotonic() - start
+        input_tokens, output_tokens = TokenUsageHandler._usage(response)
+        LLM_CALL_SECONDS.observe(duration, node=node)
+        # 非流式调用没有逐 token 回调，首 token 耗时即整体耗时
+        if first_token_at is None:
+            LLM_TTFT.observe(duration, node=node)
+        LLM_TOKENS.inc(input_tokens, node=node, direction="input")
+        LLM_TOKENS.inc(output_tokens, node=node, direction="output")
+        self._add(
+            "llm", node, start, duration,
+            ttft=round((first_token_at or time.monotonic()) - start, 3),
+            input_tokens=input_tokens, output_tokens=output_tokens
+        )
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        entry = self._llm.pop(run_id, None)
+        if entry:
+            node, start, _ = entry
+            self._add("llm", node, start, time.monotonic() - start, error=type(error).__name__)
+
+class Tracer:
+    """按 session_id 管理会话追踪；执行中的会话与最近结束的 history 个会话可供查询"""
+
+    def __init__(self, enabled=True, history=200):
+        self.enabled = enabled
+        self.history = history
+        self.active = {}
+        self.recent = OrderedDict()
+
+    def begin(self, session_id):
+        """开始追踪会话，返回需加入 config["callbacks"] 的回调列表；未启用时仍记录指标，只是不保留会话明细"""
+        if not self.enabled:
+            return [TracingHandler()]
+        trace = SessionTrace(session_id)
+        self.active[session_id] = trace
+        return [TracingHandler(trace)]
+
+    def end(self, session_id):
+        trace = self.active.pop(session_id, None)
+        if not trace:
+            return None
+        trace.finished = time.monotonic()
+        self.recent[session_id] = trace
+        while len(self.recent) > self.history:
+            self.recent.popitem(last=False)
+        log(f"[{session_id}] [Trace] {trace.finished - trace.started:.2f}s | {trace.summary()}")
+        return trace
+
+    def get(self, session_id):
+        return self.active.get(session_id) or self.recent.get(session_id)
+
+    @contextmanager
+    def span(self, session_id, name, node=None):
+        """记录节点内的一段耗时（RAG 检索、数据库写入等）"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - start
+            SPAN_SECONDS.observe(duration, span=name)
+            trace = self.active.get(session_id)
+            if trace:
+                trace.add(name, node, start, duration)
+
+def create_tracer():
+    return Tracer(
+        enabled=os.getenv("TRACING_ENABLED", "true").lower() == "true",
+        history=int(os.getenv("TRACE_HISTORY", 200))
+    )
+
+# 全局单例
+tracer = create_tracer()
@@ -0,0 +1,45 @@
+from langchain_core.callbacks import BaseCallbackHandler
+
+class TokenUsageHandler(BaseCallbackHandler):
+    """
+    统计单个会话内所有 LLM 调用的 Token 消耗
+    通过 config["callbacks"] 传入图执行，回调会自动传递到各节点内的模型调用
+    回调在事件循环中同步执行（run_inline），不经线程池调度，计数无需加锁
+    """
+    run_inline = True
+
+    def __init__(self):
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.total_tokens = 0
+        self.calls = 0
+
+    @staticmethod
+    def _usage(response):
+        # 优先读取消息上的 usage_metadata，旧版本集成只在 llm_output 中给出 token_usage
+        input_tokens = output_tokens = 0
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                input_tokens += usage.get("input_tokens", 0)
+                output_tokens += usage.get("output_tokens", 0)
+        if not input_tokens and not output_tokens:
+            usage = (response.llm_output or {}).get("token_usage") or {}
+            input_tokens = usage.get("prompt_tokens", 0)
+            output_tokens = usage.get("completion_tokens", 0)
+        return input_tokens, output_tokens
+
+    def on_llm_end(self, response, **kwargs):
+        input_tokens, output_tokens = self._usage(response)
+        self.calls += 1
+        self.input_tokens += input_tokens
+        self.output_tokens += output_tokens
+        self.total_tokens += input_tokens + output_tokens
+
+    def snapshot(self):
+        return {
+            "calls": self.calls,
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "total_tokens": self.total_tokens
+        }
@@ -0,0 +1,81 @@
+import asyncio
+from .logger import log
+
+class WriteBehindQueue:
+    """
+    写后缓冲（write-behind）队列：调用方入队后立即返回，后台任务凑满 batch_size 或等待 flush_interval 后
+    以一批记录调用 flush(batch)；队列与写入任务在首次入队时于当前事件循环中创建，任务退出后再次入队会重新创建
+    """
+
+    def __init__(self, flush, batch_size=50, flush_interval=0.2, maxsize=10000, unit="条记录"):
+        self.flush = flush
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.maxsize = maxsize
+        self.unit = unit
+        self._queue = None
+        self._writer = None
+
+    def qsize(self):
+        return self._queue.qsize() if self._queue else 0
+
+    def _ensure_writer(self):
+        if self._writer is None or self._writer.done():
+            self._queue = asyncio.Queue(maxsize=self.maxsize)
+            self._writer = asyncio.get_running_loop().create_task(self._write_worker())
+
+    async def put(self, item):
+        """入队；队列已满时等待（背压）"""
+        self._ensure_writer()
+        await self._queue.put(item)
+
+    def put_nowait(self, item):
+        """入队；队列已满时抛出 asyncio.QueueFull，由调用方决定是否丢弃"""
+        self._ensure_writer()
+        self._queue.put_nowait(item)
+
+    async def _write_worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            batch = [item]
+            stop = False
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+
+            await self.flush(batch)
+            for _ in range(len(batch) + stop):
+                self._queue.task_done()
+            if stop:
+                return
+
+    async def join(self):
+        """等待已入队的记录全部写入"""
+        if self._writer is not None and not self._writer.done():
+            await self._queue.join()
+
+    async def close(self, timeout=None):
+        """停止写入任务并等待队列排空，超时后取消任务"""
+        if self._writer is None or self._writer.done():
+            return
+        await self._queue.put(None)
+        try:
+            await asyncio.wait_for(asyncio.shield(self._writer), timeout)
+        except asyncio.TimeoutError:
+            log(f"[ERROR] 写入队列未能在 {timeout}s 内排空，剩余 {self._queue.qsize()} {self.unit}", level="ERROR")
+            self._writer.cancel()
+        self._writer = None
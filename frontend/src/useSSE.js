@@ -1,5 +1,8 @@
 import { ref } from 'vue'
 
+// 断线后最多重连次数
+const MAX_REATTACH = 5
+
 export function useSSE() {
   const isOptimizing = ref(false)
   const steps = ref([])
@@ -7,6 +10,9 @@ export function useSSE() {
   const sessionId = ref('') // 存储当前会话 ID
   const promptVersions = ref([]) // 存储所有版本的提示词
   const error = ref('')
+  const queuePosition = ref(0) // 排队位置，0 表示未排队
+  // 服务端只发送发生变化的状态字段，这里合并出完整状态
+  let graphState = {}
 
   const optimize = async (originalPrompt) => {
     isOptimizing.value = true
@@ -15,61 +21,163 @@ export function useSSE() {
     sessionId.value = ''
     promptVersions.value = []
     error.value = ''
+    queuePosition.value = 0
+    graphState = {}
 
-    try {
-      const apiBase = `${window.location.protocol}//${window.location.hostname}:8000`
-      const response = await fetch(`${apiBase}/api/optimize`, {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({ prompt: originalPrompt }),
-      })
+    const apiBase = `${window.location.protocol}//${window.location.hostname}:8000`
+    // 最近收到的事件 ID，断线后据此从服务端事件日志续读
+    let lastEventId = 0
+    let finished = false
 
-      if (!response.ok) throw new Error('网络请求失败')
+    // 处理一个完整的 data 字段
+    const dispatch = (content) => {
+      if (content === '[DONE]') {
+        finished = true
+        isOptimizing.value = false
+        return
+      }
+      try {
+        const data = JSON.parse(content)
+        if (data.error) finished = true
+        handleEvent(data)
+      } catch (e) {
+        console.error('解析 SSE 数据失败', e)
+      }
+    }
 
+    // 读取一个 SSE 响应直到结束
+    // 服务端只在每次写出的最后一帧附带 id：之前的帧先暂存，收到带 id 的帧时一并处理，
+    // 这样中途断线时未确认的帧会在重连后完整补发，不会重复或遗漏
+    const consume = async (response) => {
       const reader = response.body.getReader()
       const decoder = new TextDecoder()
+      // 服务端会把多个事件合并为一次写入，单次读取也可能在任意位置截断，未完整的行留到下次拼接
+      let buffer = ''
+      let pending = []
+      let frameData = null
+      let frameId = null
 
       while (true) {
         const { value, done } = await reader.read()
         if (done) break
 
-        const chunk = decoder.decode(value)
-        const lines = chunk.split('\n')
+        buffer += decoder.decode(value, { stream: true })
+        const lines = buffer.split('\n')
+        buffer = lines.pop()
 
         for (const line of lines) {
           if (line.startsWith('data: ')) {
-            const content = line.slice(6)
-            if (content === '[DONE]') {
-              isOptimizing.value = false
-              continue
-            }
-
-            try {
-              const data = JSON.parse(content)
-              handleEvent(data)
-            } catch (e) {
-              console.error('解析 SSE 数据失败', e)
+            frameData = line.slice(6)
+          } else if (line.startsWith('id: ')) {
+            frameId = Number(line.slice(4))
+          } else if (line === '') {
+            // 空行表示一帧结束
+            if (frameData !== null) pending.push(frameData)
+            if (frameId !== null) {
+              pending.forEach(dispatch)
+              pending = []
+              lastEventId = frameId
             }
+            frameData = null
+            frameId = null
           }
         }
       }
+      // 缓存回放的帧不带 id，在响应正常结束时处理
+      if (!lastEventId) pending.forEach(dispatch)
+    }
+
+    try {
+      const response = await fetch(`${apiBase}/api/optimize`, {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({ prompt: originalPrompt }),
+      })
+
+      if (response.status === 429) throw new Error('服务繁忙，请稍后重试')
+      if (!response.ok) throw new Error('网络请求失败')
+
+      const sid = response.headers.get('X-Session-Id')
+      if (sid) sessionId.value = sid
+
+      // 连接中断时服务端仍在执行，携带 Last-Event-ID 重连续读，而不是重新发起优化
+      for (let attempt = 0; ; attempt++) {
+        try {
+          await consume(attempt === 0 ? response : await reattach(apiBase, lastEventId))
+        } catch (err) {
+          if (!sessionId.value || attempt >= MAX_REATTACH) throw err
+        }
+        if (finished) break
+        if (!sessionId.value || attempt >= MAX_REATTACH) throw new Error('连接已断开')
+        await new Promise(resolve => setTimeout(resolve, Math.min(1000 * 2 ** attempt, 8000)))
+      }
     } catch (err) {
       error.value = err.message
       isOptimizing.value = false
     }
   }
 
+  const reattach = async (apiBase, lastEventId) => {
+    const response = await fetch(`${apiBase}/api/optimize/${sessionId.value}/events`, {
+      headers: { 'Last-Event-ID': String(lastEventId) },
+    })
+    if (response.status === 404) {
+      // 服务端已没有该会话的事件日志（如服务重启），从最近的检查点恢复执行
+      const resumed = await fetch(`${apiBase}/api/optimize/${sessionId.value}/resume`, { method: 'POST' })
+      if (!resumed.ok) throw new Error('会话已过期，请重新优化')
+      return resumed
+    }
+    if (!response.ok) throw new Error('会话已过期，请重新优化')
+    return response
+  }
+
   const handleEvent = (data) => {
     const { node, status, updates, session_id } = data
     
+    // 服务端错误（如排队超时）
+    if (data.error) {
+      error.value = data.error
+      queuePosition.value = 0
+      isOptimizing.value = false
+      return
+    }
+
+    // 处理排队事件（位于 init 之前）
+    if (status === 'queued') {
+      queuePosition.value = data.position
+      if (session_id) sessionId.value = session_id
+      return
+    }
+
     // 处理初始化事件
     if (status === 'init') {
+      queuePosition.value = 0
       sessionId.value = session_id
       return
     }
 
+    // 从检查点恢复：合并已完成部分的状态，中断时未完成的步骤由恢复后的执行重新开始
+    if (status === 'resume') {
+      Object.assign(graphState, data.state || {})
+      if (graphState.improved_prompt) improvedPrompt.value = graphState.improved_prompt
+      steps.value.filter(s => s.status === 'process').forEach(s => {
+        s.status = 'error'
+        s.statusText = '已中断'
+      })
+      return
+    }
+
+    // 重连时落后太多，部分事件已被服务端淘汰：进行中的步骤可能缺少部分输出，之后的事件照常处理
+    if (status === 'reset') {
+      console.warn('部分 SSE 事件已丢失', data.missed)
+      steps.value.filter(s => s.status === 'process').forEach(s => {
+        s.statusText = '部分输出已丢失'
+      })
+      return
+    }
+
     const stepNameMap = {
       'analyzer': '意图分析',
       'generator': '提示词优化',
@@ -103,27 +211,32 @@ export function useSSE() {
         time: new Date().toLocaleTimeString()
       })
     } else if (status === 'end') {
+      Object.assign(graphState, updates || {})
       // 标记该节点为完成
       const step = steps.value.find(s => s.node === node && s.status === 'process')
       if (step) {
         step.status = 'success'
         step.statusText = '已完成'
         // 如果有 RAG 匹配信息，保存到步骤中
-        if (updates && updates.rag_match) {
-          step.ragMatch = updates.rag_match
+        if (node === 'generator' && graphState.rag_match) {
+          step.ragMatch = graphState.rag_match
+        }
+        // 以最终评审结果为准（缓存命中或推测模式下可能没有流式 token）
+        if (node === 'reflector' && graphState.critique) {
+          step.critique = graphState.critique
         }
       }
 
       // 更新最终结果
-      if (updates && updates.improved_prompt) {
+      if (node === 'generator' && graphState.improved_prompt) {
         if (!improvedPrompt.value) {
-          improvedPrompt.value = updates.improved_prompt
+          improvedPrompt.value = graphState.improved_prompt
         }
         // 同步更新对应的版本内容
         const roundNum = steps.value.filter(s => s.node === 'generator').length
         const versionObj = promptVersions.value.find(v => v.version === roundNum)
         if (versionObj) {
-          versionObj.content = updates.improved_prompt
+          versionObj.content = graphState.improved_prompt
         }
       }
     } else if (status === 'token') {
@@ -138,6 +251,13 @@ export function useSSE() {
         if (currentVersion) {
           currentVersion.content += data.token
         }
+      } else if (node === 'reflector') {
+        // 评审意见流式展示
+        const step = steps.value.find(s => s.node === node && s.status === 'process')
+        if (step) {
+          step.statusText = '正在评审...'
+          step.critique = (step.critique || '') + data.token
+        }
       }
     }
   }
@@ -149,6 +269,7 @@ export function useSSE() {
     sessionId,
     promptVersions,
     error,
+    queuePosition,
     optimize
   }
 }